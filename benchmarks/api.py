@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""Throughput, latency percentiles and peak RSS of the API endpoints on synthetic pages.
+
+`main.app` is driven in-process through an ASGI transport, or a running server
+over HTTP with `--url`. Every request uploads a different page so the result
+cache never answers them. Nothing is downloaded, the models must already be in
+the PaddleOCR cache and at YOLO_MODEL_PATH.
+
+    python -m benchmarks.api --endpoints ocr,table --pages text,table,mixed \\
+        --resolutions a4-100dpi,a4-150dpi --concurrency 1,4 --requests 20 --output run.json
+    python -m benchmarks.api --url http://localhost:8000 --baseline run.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import time
+import uuid
+from collections import Counter
+from importlib import metadata
+
+import cv2
+import httpx
+
+from benchmarks.synthetic import PAGES, RESOLUTIONS, encode_page, percentile
+
+ENDPOINTS = {
+    'ocr': '/ocr/predict-by-file',
+    'ocr-json': '/ocr/predict-json',
+    'layout': '/layout/predict-by-file',
+    'layout-json': '/layout/predict-json',
+    'table': '/table/predict-by-file-zip',
+    'table-json': '/table/predict-json',
+}
+
+# Settings recorded with in-process results, they change what is measured
+_SETTINGS = ('OCR_LANGUAGE', 'PRELOAD_MODELS', 'INFERENCE_WORKERS', 'INFERENCE_QUEUE_SIZE', 'YOLO_BATCH_SIZE',
+             'OCR_BATCH_SIZE', 'TABLE_PARALLELISM', 'RESULT_CACHE_BYTES', 'DETECTION_STRATEGY', 'ENGINE_BACKEND',
+             'ONNX_QUANTIZED')
+_PACKAGES = ('paddleocr', 'paddlepaddle', 'onnxruntime', 'ultralytics', 'opencv-python', 'fastapi')
+
+
+def _versions():
+    versions = {}
+    for package in _PACKAGES:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+class PageFactory:
+    """Encoded synthetic pages, each with a new seed so no two requests send the same bytes.
+
+    The seeds are the same on every run, a run id stamped in the corner keeps a
+    server that is still up from answering a new run from its cache.
+    """
+
+    def __init__(self, fmt='png'):
+        self.fmt = fmt
+        self.run_id = uuid.uuid4().hex[:8]
+        self._seed = 0
+
+    def make(self, kind, resolution, count):
+        width, height = RESOLUTIONS[resolution]
+        pages = []
+        for _ in range(count):
+            self._seed += 1
+            img = PAGES[kind](width, height, seed=self._seed)
+            cv2.putText(img, self.run_id, (10, height - 10), cv2.FONT_HERSHEY_PLAIN, 0.8, (160, 160, 160), 1)
+            pages.append((f'{kind}-{resolution}-{self._seed}.{self.fmt}', encode_page(img, self.fmt)))
+        return pages
+
+
+async def run(client, path, pages, concurrency):
+    """Send every page once from `concurrency` closed-loop clients
+
+    Returns:
+        dict: request count, status counts, throughput and latency percentiles
+    """
+    latencies = []
+    statuses = Counter()
+    pending = iter(pages)
+    media_type = 'image/png' if pages[0][0].endswith('.png') else 'image/jpeg'
+
+    async def client_loop():
+        for name, data in pending:
+            start = time.perf_counter()
+            try:
+                response = await client.post(path, files={'file': (name, data, media_type)})
+                statuses[str(response.status_code)] += 1
+            except httpx.HTTPError as exc:
+                statuses[type(exc).__name__] += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'requests': len(latencies),
+        'statuses': dict(statuses),
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 3),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+async def peak_rss(client, in_process):
+    """Peak RSS of the serving process, read from /system/models over HTTP"""
+    if in_process:
+        from utils.MemoryHelper import peak_rss_bytes
+        return peak_rss_bytes()
+    try:
+        response = await client.get('/system/models')
+        return response.json()['data']['process_peak_rss_bytes']
+    except (httpx.HTTPError, ValueError, KeyError):
+        return None
+
+
+def _key(result):
+    return result['endpoint'], result['page'], result['resolution'], result['concurrency']
+
+
+def compare(results, baseline_path):
+    """Print the throughput ratio and p95 change of each configuration against an earlier run"""
+    with open(baseline_path) as f:
+        baseline = {_key(result): result for result in json.load(f)['results']}
+    print(f"\n{'endpoint':<12} {'page':<6} {'resolution':<10} {'conc':>4} {'rps x':>7} {'p95 ms':>16}")
+    for result in results:
+        before = baseline.get(_key(result))
+        if before is None:
+            continue
+        ratio = result['throughput_rps'] / before['throughput_rps'] if before['throughput_rps'] else float('nan')
+        print(f"{result['endpoint']:<12} {result['page']:<6} {result['resolution']:<10} {result['concurrency']:>4} "
+              f"{ratio:>7.2f} {before['p95_ms']:>7} -> {result['p95_ms']:<7}")
+
+
+async def benchmark(args, factory):
+    in_process = not args.url
+    timeout = httpx.Timeout(args.timeout)
+    if in_process:
+        import main
+        transport = httpx.ASGITransport(app=main.app)
+        client = httpx.AsyncClient(transport=transport, base_url='http://benchmark', timeout=timeout)
+        lifespan = main.lifespan(main.app)
+    else:
+        client = httpx.AsyncClient(base_url=args.url, timeout=timeout)
+        lifespan = None
+
+    results = []
+    print(f"{'endpoint':<12} {'page':<6} {'resolution':<10} {'conc':>4} {'rps':>8} {'p50_ms':>9} {'p95_ms':>9} "
+          f"{'p99_ms':>9} {'peak_rss_mb':>11}  statuses")
+    async with client:
+        if lifespan is not None:
+            await lifespan.__aenter__()
+        try:
+            for endpoint in args.endpoints.split(','):
+                path = ENDPOINTS.get(endpoint, endpoint)
+                for kind in args.pages.split(','):
+                    for resolution in args.resolutions.split(','):
+                        if args.warmup:
+                            await run(client, path, factory.make(kind, resolution, args.warmup), 1)
+                        for concurrency in [int(v) for v in args.concurrency.split(',')]:
+                            pages = factory.make(kind, resolution, args.requests)
+                            result = await run(client, path, pages, concurrency)
+                            result.update(endpoint=endpoint, page=kind, resolution=resolution,
+                                          concurrency=concurrency, peak_rss_bytes=await peak_rss(client, in_process))
+                            results.append(result)
+                            rss = result['peak_rss_bytes']
+                            print(f"{endpoint:<12} {kind:<6} {resolution:<10} {concurrency:>4} "
+                                  f"{result['throughput_rps']:>8} {result['p50_ms']:>9} {result['p95_ms']:>9} "
+                                  f"{result['p99_ms']:>9} {round(rss / 1024 ** 2) if rss else '-':>11}  "
+                                  f"{result['statuses']}")
+        finally:
+            if lifespan is not None:
+                await lifespan.__aexit__(None, None, None)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='base URL of a running server, main.app is run in-process when omitted')
+    parser.add_argument('--endpoints', default='ocr,layout,table',
+                        help=f"comma separated, among {', '.join(ENDPOINTS)} or paths")
+    parser.add_argument('--pages', default='text,table,mixed', help=f"comma separated, among {', '.join(PAGES)}")
+    parser.add_argument('--resolutions', default='a4-100dpi,a4-150dpi',
+                        help=f"comma separated, among {', '.join(RESOLUTIONS)}")
+    parser.add_argument('--concurrency', default='1,4', help='concurrent clients, comma separated')
+    parser.add_argument('--requests', type=int, default=20, help='requests per configuration')
+    parser.add_argument('--warmup', type=int, default=2, help='requests sent before each page and resolution')
+    parser.add_argument('--format', choices=['png', 'jpg'], default='png')
+    parser.add_argument('--timeout', type=float, default=300.0, help='seconds per request')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare with')
+    args = parser.parse_args()
+
+    started_at = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+    factory = PageFactory(args.format)
+    results = asyncio.run(benchmark(args, factory))
+
+    if args.output:
+        meta = {
+            'started_at': started_at,
+            'mode': 'http' if args.url else 'in-process',
+            'url': args.url,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'packages': _versions(),
+            'settings': {name: os.environ.get(name) for name in _SETTINGS} if not args.url else None,
+            'run_id': factory.run_id,
+            'requests': args.requests,
+            'format': args.format,
+        }
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Speed and agreement of the PaddleOCR / PPStructure engines on each backend.
+
+Each backend runs in a fresh process on the same synthetic pages: the OCR
+engine on text pages and the table engine on table pages. Agreement is the
+similarity of the recognized text and table HTML with the Paddle backend,
+which is the reference. The ONNX backends need the exports of export_onnx.py.
+
+    python -m benchmarks.backends --backends paddle,onnx,onnx-int8 --pages 10 --output backends.json
+    ONNX_INTRA_OP_THREADS=4 PADDLE_CPU_THREADS=4 python -m benchmarks.backends
+"""
+
+import argparse
+import difflib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.synthetic import RESOLUTIONS, percentile, table_page, text_page
+
+# Environment of each backend, applied before the engines are imported
+BACKENDS = {
+    'paddle': {'ENGINE_BACKEND': 'paddle', 'ONNX_QUANTIZED': 'false'},
+    'onnx': {'ENGINE_BACKEND': 'onnx', 'ONNX_QUANTIZED': 'false'},
+    'onnx-int8': {'ENGINE_BACKEND': 'onnx', 'ONNX_QUANTIZED': 'true'},
+}
+
+_SETTINGS = ('ONNX_INTRA_OP_THREADS', 'ONNX_INTER_OP_THREADS', 'ONNX_GRAPH_OPTIMIZATION', 'ONNX_CPU_ARENA',
+             'PADDLE_CPU_THREADS', 'OMP_NUM_THREADS')
+
+
+def _measure(backend, lang, resolution, pages):
+    os.environ.update(BACKENDS[backend])
+    from utils.MemoryHelper import peak_rss_bytes
+    from utils.ModelRegistry import MODEL_LOADERS
+
+    width, height = RESOLUTIONS[resolution]
+    result = {'backend': backend}
+    for name, make_page in (('ocr', text_page), ('table', table_page)):
+        start = time.perf_counter()
+        engine = MODEL_LOADERS[name](lang)
+        load_seconds = time.perf_counter() - start
+
+        outputs, timings = [], []
+        for seed in range(pages + 1):
+            img = make_page(width, height, seed=seed)
+            start = time.perf_counter()
+            if name == 'ocr':
+                lines = engine.ocr(img, cls=True)[0] or []
+                output = '\n'.join(text for _, (text, _) in lines)
+            else:
+                output = '\n'.join(region['res'].get('html', '') for region in engine(img)
+                                   if region['type'] == 'table')
+            # The first page warms the engine up
+            if seed:
+                timings.append(time.perf_counter() - start)
+                outputs.append(output)
+        result[name] = {
+            'load_seconds': round(load_seconds, 3),
+            'p50_ms': round(percentile(timings, 50) * 1000, 1),
+            'p95_ms': round(percentile(timings, 95) * 1000, 1),
+            'pages_per_second': round(len(timings) / sum(timings), 3) if timings else 0.0,
+            'outputs': outputs,
+        }
+        del engine
+    result['peak_rss_bytes'] = peak_rss_bytes()
+    return result
+
+
+def agreement(outputs, reference):
+    """Mean similarity ratio of each page output with the reference one"""
+    ratios = [difflib.SequenceMatcher(None, a, b).ratio() for a, b in zip(outputs, reference)]
+    return round(sum(ratios) / len(ratios), 4) if ratios else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', default='paddle,onnx,onnx-int8',
+                        help=f"comma separated, among {', '.join(BACKENDS)}, the first one is the reference")
+    parser.add_argument('--lang', default=os.environ.get('OCR_LANGUAGE', 'en'))
+    parser.add_argument('--resolution', default='a4-150dpi', help=f"among {', '.join(RESOLUTIONS)}")
+    parser.add_argument('--pages', type=int, default=10, help='pages per engine, after one warm-up page')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = []
+    for backend in args.backends.split(','):
+        # A fresh process per backend, the runtimes and their thread pools are configured at import
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results.append(pool.submit(_measure, backend, args.lang, args.resolution, args.pages).result())
+
+    reference = results[0]
+    print(f"{'backend':<10} {'engine':<6} {'load_s':>7} {'p50_ms':>8} {'p95_ms':>8} {'pages/s':>8} {'agreement':>9} "
+          f"{'peak_mb':>8}")
+    for result in results:
+        for name in ('ocr', 'table'):
+            engine = result[name]
+            engine['agreement'] = agreement(engine['outputs'], reference[name]['outputs'])
+            print(f"{result['backend']:<10} {name:<6} {engine['load_seconds']:>7} {engine['p50_ms']:>8} "
+                  f"{engine['p95_ms']:>8} {engine['pages_per_second']:>8} {engine['agreement']:>9} "
+                  f"{round(result['peak_rss_bytes'] / 1024 ** 2):>8}")
+
+    if args.output:
+        settings = {name: os.environ.get(name) for name in _SETTINGS}
+        with open(args.output, 'w') as f:
+            json.dump({'lang': args.lang, 'resolution': args.resolution, 'pages': args.pages,
+                       'settings': settings, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Throughput against p99 latency of the micro-batching scheduler.
+
+Concurrent clients submit single images in a closed loop while the batch size
+and wait window are swept. The default engine is a simulated one with a fixed
+per-call overhead, `--engine yolo` or `--engine ocr` uses the real models on
+synthetic pages.
+
+    python -m benchmarks.microbatch --clients 8 --batch-sizes 1,4,8 --waits 0,2,5,10
+"""
+
+import argparse
+import functools
+import json
+import threading
+import time
+
+from benchmarks.synthetic import RESOLUTIONS, percentile, text_page
+from utils.MicroBatcher import MicroBatcher
+
+
+_simulated_engine_lock = threading.Lock()
+
+
+def simulated_batch(overhead_ms, per_item_ms, items):
+    # One engine instance, with a fixed per-call cost plus a smaller cost per image
+    with _simulated_engine_lock:
+        time.sleep((overhead_ms + per_item_ms * len(items)) / 1000)
+    return [None] * len(items)
+
+
+def make_batch_fn(engine, overhead_ms, per_item_ms):
+    if engine == 'simulated':
+        return functools.partial(simulated_batch, overhead_ms, per_item_ms)
+    from utils import BatchInference
+    if engine == 'yolo':
+        return BatchInference._detect_batch
+    return functools.partial(BatchInference._ocr_batch, None)
+
+
+def make_item(engine, page):
+    if engine == 'yolo':
+        return page, (8, 9)
+    if engine == 'ocr':
+        return page, True
+    return None
+
+
+def run(batch_fn, item, clients, batch_size, wait_ms, duration):
+    batcher = MicroBatcher(batch_fn, batch_size, wait_ms, name=f'bench-{batch_size}-{wait_ms}')
+    latencies = []
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def client():
+        local = []
+        while time.perf_counter() < stop_at:
+            start = time.perf_counter()
+            batcher(item)
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    stats = batcher.stats()
+    return {
+        'batch_size': batch_size,
+        'wait_ms': wait_ms,
+        'clients': clients,
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'avg_batch_size': stats['avg_batch_size'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engine', choices=['simulated', 'yolo', 'ocr'], default='simulated')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--batch-sizes', default='1,2,4,8')
+    parser.add_argument('--waits', default='0,2,5,10', help='max wait in ms, comma separated')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per configuration')
+    parser.add_argument('--overhead-ms', type=float, default=20.0, help='simulated fixed cost per call')
+    parser.add_argument('--per-item-ms', type=float, default=5.0, help='simulated cost per image')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    batch_fn = make_batch_fn(args.engine, args.overhead_ms, args.per_item_ms)
+    item = make_item(args.engine, text_page(*RESOLUTIONS['a4-150dpi']) if args.engine != 'simulated' else None)
+
+    results = []
+    print(f"{'batch':>6} {'wait_ms':>8} {'rps':>10} {'p50_ms':>10} {'p99_ms':>10} {'avg_batch':>10}")
+    for batch_size in [int(v) for v in args.batch_sizes.split(',')]:
+        for wait_ms in [float(v) for v in args.waits.split(',')]:
+            if batch_size == 1 and results and results[-1]['batch_size'] == 1:
+                continue  # the wait window has no effect without batching
+            result = run(batch_fn, item, args.clients, batch_size, wait_ms, args.duration)
+            results.append(result)
+            print(f"{batch_size:>6} {wait_ms:>8} {result['throughput_rps']:>10} {result['p50_ms']:>10} "
+                  f"{result['p99_ms']:>10} {result['avg_batch_size']:>10}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'engine': args.engine, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
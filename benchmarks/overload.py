@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Latency of small and large requests when more work arrives than the server can process.
+
+Requests arrive open-loop (Poisson arrivals at `--rate` per second, whatever
+the server answers) for `--duration` seconds. A `--small-share` of them are
+small OCR calls on low resolution text pages, the others are layout analyses
+of high resolution mixed pages. `main.app` is driven in-process first with
+admission control disabled and then enabled (utils/Admission.py). The
+default engine is a simulated one whose inference sleeps in proportion to the
+pixels of the page, `--engine models` runs the real models. With `--url`
+a running server is measured once, as it is configured.
+
+Without admission control small calls queue behind large ones and latency
+grows with the backlog. With it, small calls keep their latency, large ones
+wait at most ADMISSION_QUEUE_TIMEOUT and the rest are rejected right away
+with a 503.
+
+    python -m benchmarks.overload --rate 8 --duration 30
+    python -m benchmarks.overload --url http://localhost:8000 --rate 20 --output overload.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from collections import Counter
+
+import httpx
+
+from benchmarks.api import ENDPOINTS, PageFactory
+from benchmarks.synthetic import percentile
+
+CLASSES = {
+    # endpoint, page, resolution
+    'small': ('ocr-json', 'text', 'a4-100dpi'),
+    'large': ('layout-json', 'mixed', 'a4-300dpi'),
+}
+# Distinct pages per class, each request appends random bytes after the image so the result cache misses
+_POOL_SIZE = 8
+
+
+def simulate_engines(ocr_ms, layout_ms):
+    """Replace the OCR and layout pipelines by sleeps of `ocr_ms` and `layout_ms` per megapixel"""
+    import routers.layout
+    import routers.ocr
+    from utils.ImagePreprocess import image_size
+
+    def megapixels(file_data):
+        width, height = image_size(file_data)
+        return width * height / 1e6
+
+    def ocr_pipeline(file_data, strategy, lang=None, cls=None):
+        time.sleep(ocr_ms * megapixels(file_data) / 1000)
+        return [[]]
+
+    def layout_analysis(file_data, strategy='skip', lang=None, options=None):
+        time.sleep(layout_ms * megapixels(file_data) / 1000)
+        return {'width': image_size(file_data)[0], 'regions': []}
+
+    routers.ocr.ocr_pipeline = ocr_pipeline
+    routers.layout.layout_analysis = layout_analysis
+
+
+async def drive(client, pools, rate, duration, small_share, seed):
+    """Send requests at Poisson arrival times, returns (class, status, seconds) per request"""
+    rng = random.Random(seed)
+    loop = asyncio.get_running_loop()
+
+    async def send(kind):
+        endpoint, _, _ = CLASSES[kind]
+        name, data = rng.choice(pools[kind])
+        body = data + os.urandom(16)
+        start = time.perf_counter()
+        try:
+            response = await client.post(ENDPOINTS[endpoint], files={'file': (name, body, 'image/png')})
+            outcome = str(response.status_code)
+        except httpx.HTTPError as exc:
+            outcome = type(exc).__name__
+        return kind, outcome, time.perf_counter() - start
+
+    tasks = []
+    start = loop.time()
+    at = 0.0
+    while True:
+        at += rng.expovariate(rate)
+        if at > duration:
+            break
+        await asyncio.sleep(max(start + at - loop.time(), 0))
+        tasks.append(asyncio.ensure_future(send('small' if rng.random() < small_share else 'large')))
+    return await asyncio.gather(*tasks)
+
+
+def summarize(records, duration):
+    summary = {}
+    for kind in CLASSES:
+        records_of = [record for record in records if record[0] == kind]
+        succeeded = [seconds for _, outcome, seconds in records_of if outcome == '200']
+        failed = [seconds for _, outcome, seconds in records_of if outcome != '200']
+        summary[kind] = {
+            'requests': len(records_of),
+            'statuses': dict(Counter(outcome for _, outcome, _ in records_of)),
+            'goodput_rps': round(len(succeeded) / duration, 3),
+            'ok_p50_ms': round(percentile(succeeded, 50) * 1000, 1) if succeeded else None,
+            'ok_p99_ms': round(percentile(succeeded, 99) * 1000, 1) if succeeded else None,
+            'rejected_p99_ms': round(percentile(failed, 99) * 1000, 1) if failed else None,
+        }
+    return summary
+
+
+def print_summary(label, summary):
+    for kind, result in summary.items():
+        print(f"{label:<10} {kind:<6} {result['requests']:>8} {result['goodput_rps']:>8} "
+              f"{result['ok_p50_ms'] or '-':>10} {result['ok_p99_ms'] or '-':>10} "
+              f"{result['rejected_p99_ms'] or '-':>12}  {result['statuses']}")
+
+
+async def benchmark(args, pools):
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=1000, max_keepalive_connections=100)
+    print(f"{'admission':<10} {'class':<6} {'requests':>8} {'goodput':>8} {'ok_p50_ms':>10} {'ok_p99_ms':>10} "
+          f"{'rejected_p99':>12}  statuses")
+    results = {}
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=timeout, limits=limits) as client:
+            records = await drive(client, pools, args.rate, args.duration, args.small_share, args.seed)
+        results['server'] = summarize(records, args.duration)
+        print_summary('server', results['server'])
+        return results
+
+    import main
+    import utils.Admission as Admission
+
+    if args.engine == 'simulated':
+        simulate_engines(args.ocr_ms, args.layout_ms)
+        lifespan = None
+    else:
+        lifespan = main.lifespan(main.app)
+        await lifespan.__aenter__()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url='http://benchmark',
+                                     timeout=timeout) as client:
+            for label, budget in (('off', 0), ('on', Admission.ADMISSION_BUDGET or 64)):
+                # A fresh controller per run, looked up by admit() through the module
+                Admission.admission = Admission.AdmissionController(budget=budget)
+                records = await drive(client, pools, args.rate, args.duration, args.small_share, args.seed)
+                results[label] = summarize(records, args.duration)
+                print_summary(label, results[label])
+    finally:
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='base URL of a running server, main.app is run in-process when omitted')
+    parser.add_argument('--engine', choices=['simulated', 'models'], default='simulated')
+    parser.add_argument('--rate', type=float, default=8.0, help='requests per second')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of arrivals per run')
+    parser.add_argument('--small-share', type=float, default=0.7, help='share of small OCR requests')
+    parser.add_argument('--ocr-ms', type=float, default=40.0, help='simulated OCR time per megapixel')
+    parser.add_argument('--layout-ms', type=float, default=60.0, help='simulated layout time per megapixel')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=300.0, help='seconds per request')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    factory = PageFactory('png')
+    pools = {kind: factory.make(page, resolution, _POOL_SIZE) for kind, (_, page, resolution) in CLASSES.items()}
+    results = asyncio.run(benchmark(args, pools))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'engine': 'server' if args.url else args.engine, 'rate': args.rate, 'duration': args.duration,
+                       'small_share': args.small_share, 'classes': CLASSES, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Peak memory and time of decoding a very large scan, at full resolution against the working resolution.
+
+Each mode runs in a fresh process on the same synthetic scan, 600 dpi A3 by
+default, and reports its peak RSS above the process baseline:
+
+- full: decode at full resolution then resize for detection, as before preprocessing
+- reduced: ImagePreprocess.decode_image then downscale for detection
+
+    python -m benchmarks.preprocess --resolution 7016x9921 --format jpg
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _measure(mode, path, repeat):
+    from utils.ImageHelper import bytes_to_ndarray
+    from utils.ImagePreprocess import DETECTION_MAX_SIDE, MAX_IMAGE_SIDE, decode_image, downscale
+    from utils.MemoryHelper import current_rss_bytes, peak_rss_bytes
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    baseline = current_rss_bytes()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if mode == 'full':
+            img = bytes_to_ndarray(data)
+        else:
+            img, _ = decode_image(data, MAX_IMAGE_SIDE)
+        decoded = img.shape[:2]
+        small, _ = downscale(img, DETECTION_MAX_SIDE)
+        timings.append(time.perf_counter() - start)
+        del img, small
+    return {
+        'mode': mode,
+        'decoded_height': decoded[0],
+        'decoded_width': decoded[1],
+        'seconds': round(min(timings), 3),
+        'peak_rss_above_baseline_bytes': max(peak_rss_bytes() - baseline, 0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolution', default='7016x9921', help='WIDTHxHEIGHT of the synthetic scan')
+    parser.add_argument('--format', choices=['jpg', 'png'], default='jpg')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    from benchmarks.synthetic import encode_page, mixed_page
+
+    width, height = (int(v) for v in args.resolution.split('x'))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, f'scan.{args.format}')
+        with open(path, 'wb') as f:
+            f.write(encode_page(mixed_page(width, height), args.format))
+
+        results = []
+        print(f"{'mode':<8} {'decoded':>12} {'seconds':>8} {'peak_mb':>8}")
+        for mode in ('full', 'reduced'):
+            # A fresh process per mode, peak RSS never goes down
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                result = pool.submit(_measure, mode, path, args.repeat).result()
+            results.append(result)
+            print(f"{mode:<8} {result['decoded_width']:>5}x{result['decoded_height']:<6} {result['seconds']:>8} "
+                  f"{round(result['peak_rss_above_baseline_bytes'] / 1024 ** 2):>8}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'resolution': args.resolution, 'format': args.format, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
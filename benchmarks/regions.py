@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Per-page latency of region recognition on template forms, with and without the region cache.
+
+Every page is a copy of the same form whose field values and table rows
+change: the text regions of the template (header, field labels, footer) are
+the same pixels on each page. The regions are recognized like the `regions`
+strategy does, the text regions together and the table on its own, first with
+the region cache disabled and then with it enabled. The default engine is a
+simulated one with a fixed cost per call and per region, `--engine ocr` uses
+the real OCR and table models.
+
+    python -m benchmarks.regions --pages 50 --noise 4
+    python -m benchmarks.regions --engine ocr --resolution a4-150dpi --output regions.json
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+import utils.RegionCache as RegionCache
+from benchmarks.synthetic import RESOLUTIONS, form_page, percentile
+
+
+def simulated_recognizer(overhead_ms, per_item_ms):
+    def recognize(crops):
+        time.sleep((overhead_ms + per_item_ms * len(crops)) / 1000)
+        return [[None] for _ in crops]
+    return recognize
+
+
+def make_page_fn(engine, lang, overhead_ms, per_item_ms, table_ms):
+    if engine == 'simulated':
+        recognize_text = simulated_recognizer(overhead_ms, per_item_ms)
+        recognize_table = simulated_recognizer(table_ms, 0)
+
+        def page_fn(img, text_regions, table_region):
+            RegionCache.cached_regions('text', [img[y1:y2, x1:x2] for x1, y1, x2, y2 in text_regions],
+                                       recognize_text, lang)
+            x1, y1, x2, y2 = table_region
+            RegionCache.cached_regions('table', [img[y1:y2, x1:x2]], recognize_table, lang)
+        return page_fn
+
+    from routers.ocr import ocr_regions
+    from routers.table import recognize_table_from_image
+
+    def page_fn(img, text_regions, table_region):
+        ocr_regions(img, text_regions, lang, cls=False)
+        x1, y1, x2, y2 = table_region
+        recognize_table_from_image(img[y1:y2, x1:x2], xlsx=False, lang=lang)
+    return page_fn
+
+
+def run(page_fn, pages, max_bytes):
+    # A fresh cache per run, looked up by the recognition functions through the module
+    RegionCache.region_cache = RegionCache.RegionCache(max_bytes)
+    timings = []
+    for img, text_regions, table_region in pages:
+        start = time.perf_counter()
+        page_fn(img, text_regions, table_region)
+        timings.append(time.perf_counter() - start)
+    stats = RegionCache.region_cache.stats()
+    return {
+        'cache_bytes': max_bytes,
+        'pages': len(timings),
+        'p50_ms': round(percentile(timings, 50) * 1000, 1),
+        'p95_ms': round(percentile(timings, 95) * 1000, 1),
+        'total_s': round(sum(timings), 3),
+        'hit_rate': stats['hit_rate'],
+        'kinds': stats['kinds'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engine', choices=['simulated', 'ocr'], default='simulated')
+    parser.add_argument('--lang', default=None)
+    parser.add_argument('--resolution', default='a4-150dpi', help=f"among {', '.join(RESOLUTIONS)}")
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--noise', type=int, default=0, help='uniform pixel noise added to each page, like a scan')
+    parser.add_argument('--cache-bytes', type=int, default=RegionCache.REGION_CACHE_BYTES or 64 * 1024 ** 2)
+    parser.add_argument('--overhead-ms', type=float, default=20.0, help='simulated fixed cost per call')
+    parser.add_argument('--per-item-ms', type=float, default=15.0, help='simulated cost per text region')
+    parser.add_argument('--table-ms', type=float, default=300.0, help='simulated cost per table')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    width, height = RESOLUTIONS[args.resolution]
+    rng = np.random.default_rng(0)
+    pages = []
+    for seed in range(args.pages):
+        img, text_regions, table_region = form_page(width, height, seed=seed)
+        if args.noise:
+            img = np.clip(img.astype(np.int16) + rng.integers(-args.noise, args.noise + 1, img.shape), 0,
+                          255).astype(np.uint8)
+        pages.append((img, text_regions, table_region))
+
+    page_fn = make_page_fn(args.engine, args.lang, args.overhead_ms, args.per_item_ms, args.table_ms)
+    # The first page warms the engines up
+    page_fn(*pages[0])
+
+    results = [run(page_fn, pages, 0), run(page_fn, pages, args.cache_bytes)]
+    print(f"{'cache':>6} {'p50_ms':>8} {'p95_ms':>8} {'total_s':>8} {'hit_rate':>9}")
+    for result in results:
+        print(f"{'on' if result['cache_bytes'] else 'off':>6} {result['p50_ms']:>8} {result['p95_ms']:>8} "
+              f"{result['total_s']:>8} {result['hit_rate']:>9}")
+    if results[1]['p50_ms']:
+        print(f"p50 speedup: {results[0]['p50_ms'] / results[1]['p50_ms']:.2f}x")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'engine': args.engine, 'resolution': args.resolution, 'noise': args.noise,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
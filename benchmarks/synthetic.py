@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Synthetic document pages and latency statistics shared by the benchmarks.
+
+Pages are drawn with OpenCV only, so the benchmarks run offline and give the
+same images on every machine.
+"""
+
+import cv2
+import numpy as np
+
+# A4 pages at 100, 150 and 300 dpi
+RESOLUTIONS = {
+    'a4-100dpi': (827, 1169),
+    'a4-150dpi': (1240, 1754),
+    'a4-300dpi': (2480, 3508),
+}
+
+_FONT = cv2.FONT_HERSHEY_SIMPLEX
+_WORDS = ('the', 'invoice', 'total', 'amount', 'service', 'document', 'table', 'quarterly', 'report', 'value',
+          'customer', 'delivery', 'payment', 'number', 'period', 'summary', 'account', 'balance', 'date', 'item')
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return float(np.percentile(np.asarray(values), q))
+
+
+def _scale(width):
+    # Drawing sizes are given for a 1240 px wide page
+    return width / 1240
+
+
+def _text_block(img, rng, x1, y1, x2, y2, scale):
+    line_height = int(40 * scale)
+    for y in range(y1 + line_height, y2, line_height):
+        words, line = [], ''
+        while True:
+            candidate = (line + ' ' + _WORDS[rng.integers(len(_WORDS))]).strip()
+            (w, _), _ = cv2.getTextSize(candidate, _FONT, 0.8 * scale, max(int(2 * scale), 1))
+            if x1 + w > x2:
+                break
+            line = candidate
+        cv2.putText(img, line, (x1, y), _FONT, 0.8 * scale, (0, 0, 0), max(int(2 * scale), 1))
+
+
+def _table(img, rng, x1, y1, x2, y2, scale, rows=6, cols=4, header_rng=None):
+    # The header row is drawn from `header_rng` when given, so it can stay the same across pages
+    header_rng = header_rng or rng
+    thickness = max(int(2 * scale), 1)
+    cell_w = (x2 - x1) // cols
+    cell_h = (y2 - y1) // rows
+    for r in range(rows + 1):
+        cv2.line(img, (x1, y1 + r * cell_h), (x1 + cols * cell_w, y1 + r * cell_h), (0, 0, 0), thickness)
+    for c in range(cols + 1):
+        cv2.line(img, (x1 + c * cell_w, y1), (x1 + c * cell_w, y1 + rows * cell_h), (0, 0, 0), thickness)
+    for r in range(rows):
+        for c in range(cols):
+            text = _WORDS[header_rng.integers(len(_WORDS))] if r == 0 else f'{rng.integers(10, 99999)}'
+            cv2.putText(img, text, (x1 + c * cell_w + int(12 * scale), y1 + r * cell_h + int(cell_h * 0.65)),
+                        _FONT, 0.7 * scale, (0, 0, 0), thickness)
+
+
+def _title(img, text, x, y, scale):
+    cv2.putText(img, text, (x, y), _FONT, 1.4 * scale, (0, 0, 0), max(int(3 * scale), 1))
+
+
+def text_page(width, height, seed=0):
+    """Page of running text in one column"""
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), 255, dtype=np.uint8)
+    s = _scale(width)
+    _title(img, f'Synthetic text page {seed}', int(100 * s), int(120 * s), s)
+    _text_block(img, rng, int(100 * s), int(160 * s), width - int(100 * s), height - int(120 * s), s)
+    return img
+
+
+def table_page(width, height, seed=0):
+    """Page with two ruled tables"""
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), 255, dtype=np.uint8)
+    s = _scale(width)
+    _title(img, f'Synthetic table page {seed}', int(100 * s), int(120 * s), s)
+    middle = height // 2
+    _table(img, rng, int(100 * s), int(180 * s), width - int(100 * s), middle - int(60 * s), s)
+    _table(img, rng, int(100 * s), middle + int(60 * s), width - int(100 * s), height - int(150 * s), s,
+           rows=8, cols=3)
+    return img
+
+
+def mixed_page(width, height, seed=0):
+    """Page with a title, two text columns, a figure and a table"""
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), 255, dtype=np.uint8)
+    s = _scale(width)
+    margin = int(100 * s)
+    middle = width // 2
+    _title(img, f'Synthetic mixed page {seed}', margin, int(120 * s), s)
+    _text_block(img, rng, margin, int(160 * s), middle - int(30 * s), height // 2, s)
+    _text_block(img, rng, middle + int(30 * s), int(160 * s), width - margin, int(height * 0.3), s)
+    # A filled figure with a caption below it
+    cv2.rectangle(img, (middle + int(30 * s), int(height * 0.32)), (width - margin, int(height * 0.47)),
+                  (120, 160, 200), -1)
+    cv2.putText(img, 'Figure 1. Synthetic figure', (middle + int(30 * s), int(height * 0.49)),
+                _FONT, 0.7 * s, (0, 0, 0), max(int(2 * s), 1))
+    _table(img, rng, margin, height // 2 + int(60 * s), width - margin, height - int(150 * s), s)
+    return img
+
+
+def form_page(width, height, seed=0):
+    """Page of a fixed form template: the header, field labels, table header row and footer are the same
+    pixels on every page, the field values and table rows change with `seed`
+
+    Returns:
+        tuple: the page, and the (x1, y1, x2, y2) text regions and table region of the template
+    """
+    template = np.random.default_rng(12345)
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), 255, dtype=np.uint8)
+    s = _scale(width)
+    thickness = max(int(2 * s), 1)
+    margin = int(100 * s)
+    middle = width // 2
+    text_regions = []
+
+    _title(img, 'ACME Logistics - Delivery note', margin, int(120 * s), s)
+    text_regions.append((margin, int(80 * s), width - margin, int(140 * s)))
+    _text_block(img, template, margin, int(150 * s), width - margin, int(270 * s), s)
+    text_regions.append((margin, int(150 * s), width - margin, int(280 * s)))
+    for i, label in enumerate(('Customer', 'Order number', 'Delivery date')):
+        y = int((330 + 60 * i) * s)
+        cv2.putText(img, label, (margin, y), _FONT, 0.8 * s, (0, 0, 0), thickness)
+        text_regions.append((margin, y - int(35 * s), middle - int(20 * s), y + int(15 * s)))
+        cv2.putText(img, f'{_WORDS[rng.integers(len(_WORDS))]} {rng.integers(1000, 99999)}', (middle, y), _FONT,
+                    0.8 * s, (0, 0, 0), thickness)
+        text_regions.append((middle, y - int(35 * s), width - margin, y + int(15 * s)))
+
+    table_region = (margin, int(540 * s), width - margin, height - int(300 * s))
+    _table(img, rng, *table_region, s, rows=10, cols=4, header_rng=template)
+
+    _text_block(img, template, margin, height - int(260 * s), width - margin, height - int(120 * s), s)
+    text_regions.append((margin, height - int(260 * s), width - margin, height - int(110 * s)))
+    return img, text_regions, table_region
+
+
+PAGES = {
+    'text': text_page,
+    'table': table_page,
+    'mixed': mixed_page,
+}
+
+
+def encode_page(img, fmt='png'):
+    """Encoded image bytes of a page, 'png' or 'jpg'"""
+    ok, buffer = cv2.imencode('.' + fmt, img)
+    if not ok:
+        raise ValueError(f'Unable to encode the page as {fmt}')
+    return buffer.tobytes()
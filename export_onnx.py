@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Export the PaddleOCR / PPStructure models to ONNX for ENGINE_BACKEND=onnx.
+
+The Paddle models of the given languages are downloaded if needed, then every
+inference model found in the PaddleOCR model directory is converted with
+paddle2onnx to model.onnx next to it and, with --int8, quantized to
+model.int8.onnx with onnxruntime dynamic quantization:
+
+    python export_onnx.py --lang en,fr --int8
+"""
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+
+logger = logging.getLogger('export_onnx')
+
+# Where PaddleOCR stores the models it downloads
+PADDLEOCR_HOME = os.path.expanduser(os.environ.get("PADDLEOCR_HOME", "~/.paddleocr/whl"))
+
+
+def model_dirs(root):
+    """Directories holding a Paddle inference model under `root`"""
+    for directory, _, files in os.walk(root):
+        if 'inference.pdmodel' in files and 'inference.pdiparams' in files:
+            yield directory
+
+
+def export(model_dir, opset):
+    subprocess.run([
+        sys.executable, '-m', 'paddle2onnx.command',
+        '--model_dir', model_dir,
+        '--model_filename', 'inference.pdmodel',
+        '--params_filename', 'inference.pdiparams',
+        '--save_file', os.path.join(model_dir, 'model.onnx'),
+        '--opset_version', str(opset),
+        '--enable_onnx_checker', 'True',
+    ], check=True)
+
+
+def quantize(model_dir):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(os.path.join(model_dir, 'model.onnx'), os.path.join(model_dir, 'model.int8.onnx'),
+                     weight_type=QuantType.QInt8)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lang', default=os.environ.get('OCR_LANGUAGE', 'en'),
+                        help='comma separated languages whose models are downloaded first')
+    parser.add_argument('--int8', action='store_true', help='also write the int8 quantized models')
+    parser.add_argument('--opset', type=int, default=11)
+    parser.add_argument('--force', action='store_true', help='export models that already have an export')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    from paddleocr import PPStructure, PaddleOCR
+
+    for lang in [lang.strip() for lang in args.lang.split(',') if lang.strip()]:
+        PaddleOCR(use_angle_cls=True, lang=lang, show_log=False)
+        PPStructure(lang=lang, layout=False, show_log=False)
+
+    for model_dir in model_dirs(PADDLEOCR_HOME):
+        if args.force or not os.path.exists(os.path.join(model_dir, 'model.onnx')):
+            logger.info('Exporting %s', model_dir)
+            export(model_dir, args.opset)
+        if args.int8 and (args.force or not os.path.exists(os.path.join(model_dir, 'model.int8.onnx'))):
+            logger.info('Quantizing %s', model_dir)
+            quantize(model_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Gunicorn settings of the multi-process deployment.
+
+The master imports the application and loads the PRELOAD_MODELS once, then
+forks the uvicorn workers, which share the model weights copy-on-write
+instead of each loading its own copy. No inference runs in the master: the
+Paddle runtime and the YOLO detector start their thread pools on the first
+inference, which each worker then runs as its warm-up (see
+utils/Lifecycle.py) before reporting ready. onnxruntime starts them when a
+session is created, so with ENGINE_BACKEND=onnx the PaddleOCR engines are
+not loaded in the master, each worker loads its own during its warm-up.
+
+    gunicorn -c gunicorn.conf.py main:app
+    WEB_CONCURRENCY=4 WORKER_MAX_REQUESTS=2000 gunicorn -c gunicorn.conf.py main:app
+"""
+
+import gc
+import os
+import shutil
+
+# Address the server listens on
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+# Worker processes, each with its own event loop and inference executor
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+worker_class = 'uvicorn.workers.UvicornWorker'
+# Import the application and load the models in the master before forking
+preload_app = True
+# Requests after which a worker is replaced, 0 never replaces it. The jitter spreads the restarts of the
+# workers so they are not all warming up at once
+max_requests = int(os.environ.get("WORKER_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.environ.get("WORKER_MAX_REQUESTS_JITTER", "0"))
+# Seconds without a heartbeat before a worker is killed, inference runs off the event loop so it keeps beating
+timeout = int(os.environ.get("WORKER_TIMEOUT", "120"))
+# Seconds a stopping worker has to finish its in-flight requests
+graceful_timeout = int(os.environ.get("WORKER_GRACEFUL_TIMEOUT", "60"))
+
+# Metrics files of the previous run would be aggregated with the new ones, clear them before the
+# application is imported
+_metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR", "")
+if _metrics_dir:
+    shutil.rmtree(_metrics_dir, ignore_errors=True)
+    os.makedirs(_metrics_dir, exist_ok=True)
+
+# Objects created while loading are never collected in the master, so the collector of a worker does not
+# write to (and copy) the pages holding them
+gc.disable()
+
+
+def when_ready(server):
+    from utils.ModelRegistry import PRELOAD_MODELS, fork_safe_models, registry
+
+    models = fork_safe_models(PRELOAD_MODELS)
+    if models:
+        server.log.info('Loading %s before forking the workers', ', '.join(models))
+        registry.warm_up_hot(models)
+    skipped = [name for name in PRELOAD_MODELS if name not in models]
+    if skipped:
+        server.log.info('Each worker loads %s, onnxruntime sessions cannot be shared across a fork',
+                        ', '.join(skipped))
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from utils.Lifecycle import worker_lifecycle
+
+    gc.enable()
+    worker_lifecycle.forked()
+
+
+def child_exit(server, worker):
+    if _metrics_dir:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
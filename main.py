@@ -1,18 +1,47 @@
 # -*- coding: utf-8 -*-
 
 # import uvicorn
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 # import uvicorn
 
 from models.RestfulModel import *
-from routers import ocr, layout, table
+from routers import ocr, layout, table, jobs, system
+from utils.Admission import AdmissionMiddleware
+from utils.BatchInference import log_batching
 from utils.ImageHelper import *
+from utils.InferenceExecutor import inference_executor
+from utils.Lifecycle import worker_lifecycle
+from utils.Metrics import ServerTimingMiddleware, metrics_payload
+from utils.UrlFetcher import url_fetcher
+from utils.Workspace import workspace_manager
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Optional warm-up of the hot languages, every other model is loaded on first use. It runs in the
+    # background so the process answers liveness probes meanwhile, /system/ready tells when it is done
+    warm_up = asyncio.create_task(worker_lifecycle.warm_up())
+    log_batching()
+    memory_watcher = asyncio.create_task(worker_lifecycle.watch_memory())
+    sweeper = asyncio.create_task(workspace_manager.run_sweeper())
+    yield
+    for task in (warm_up, memory_watcher, sweeper):
+        task.cancel()
+    await url_fetcher.aclose()
+    inference_executor.shutdown()
+
 
 app = FastAPI(title="PaddleOCR and PPstructure API",
-              description="Self-use interface based on Paddle OCR and FastAPI")
+              description="Self-use interface based on Paddle OCR and FastAPI",
+              lifespan=lifespan)
 
 
+# Per-client rate limiting, inside CORS so that 429 responses carry its headers
+app.add_middleware(AdmissionMiddleware)
 # Cross-domain settings
 origins = [
     "*"
@@ -24,9 +53,19 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"]
 )
+# Request latency metrics and optional Server-Timing headers
+app.add_middleware(ServerTimingMiddleware)
 
 app.include_router(table.router)
 app.include_router(layout.router)
 app.include_router(ocr.router)
+app.include_router(jobs.router)
+app.include_router(system.router)
+
+
+@app.get('/metrics', include_in_schema=False)
+def metrics():
+    body, content_type = metrics_payload()
+    return Response(content=body, media_type=content_type)
 
 # uvicorn.run(app=app, host="0.0.0.0", port=8000)
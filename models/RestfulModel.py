@@ -3,7 +3,7 @@
 from typing import List, Union
 from pydantic import BaseModel
 from fastapi import status
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 
 from .OCRModel import OCRModel, LayoutModel
 
@@ -23,6 +23,18 @@ def resp_200(*, data: Union[list, dict, str]) -> Response:
         }
     )
     
+def resp_200_orjson(*, data: Union[list, dict, str]) -> Response:
+    # Same body as resp_200, serialized with orjson for large recognition results
+    return ORJSONResponse(
+        status_code=status.HTTP_200_OK,
+        content={
+    
+            'code': 200,
+            'message': "Success",
+            'data': data,
+        }
+    )
+    
 def resp_400(*, data: str = None, message: str="BAD REQUEST") -> Response:
     return JSONResponse(
         status_code=status.HTTP_400_BAD_REQUEST,
@@ -32,4 +44,26 @@ def resp_400(*, data: str = None, message: str="BAD REQUEST") -> Response:
             'message': message,
             'data': data,
         }
-    )
\ No newline at end of file
+    )
+    
+def resp_202(*, data: Union[list, dict, str]) -> Response:
+    return JSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content={
+    
+            'code': 202,
+            'message': "Accepted",
+            'data': data,
+        }
+    )
+    
+def resp_503(*, data: Union[list, dict, str] = None, message: str = "SERVICE UNAVAILABLE") -> Response:
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={
+    
+            'code': 503,
+            'message': message,
+            'data': data,
+        }
+    )
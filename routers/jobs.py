@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+from typing import Literal, Optional
+
+from fastapi import APIRouter, HTTPException, UploadFile, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse
+from models.RestfulModel import *
+from utils.DocumentHelper import NDJSON_MEDIA_TYPE, ndjson_line, spool_document
+from utils.ExportHelper import DOCX_MEDIA_TYPE, XLSX_MEDIA_TYPE
+from utils.JobQueue import FINISHED_STATUSES, SUCCEEDED, job_queue, job_status
+from utils.ModelRegistry import resolve_language
+
+router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+# Seconds between two checks of a job streamed by /jobs/{job_id}/events
+JOB_EVENTS_INTERVAL = float(os.environ.get("JOB_EVENTS_INTERVAL", "1"))
+
+ARTIFACT_MEDIA_TYPES = {'.docx': DOCX_MEDIA_TYPE, '.xlsx': XLSX_MEDIA_TYPE}
+
+
+def job_response(job):
+    """
+    Job status with the URLs to follow it.
+    """
+    data = job_status(job)
+    data['links'] = {
+        'status': f'/jobs/{job["id"]}',
+        'events': f'/jobs/{job["id"]}/events',
+        'artifact': f'/jobs/{job["id"]}/artifact',
+    }
+    return data
+
+async def get_job(job_id):
+    job = await run_in_threadpool(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found or expired"
+        )
+    return job
+
+def read_new_lines(path, offset):
+    """
+    Complete lines appended to a file since `offset`, with the offset to continue from.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return [], 0
+    if size < offset:
+        offset = 0  # The page results were rewritten by a retry
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    return data[:end].splitlines(keepends=True), offset + end
+
+
+@router.post('/{kind}', summary="Queue a PDF, TIFF or image for OCR, layout or table recognition")
+async def submit_job(kind: Literal['ocr', 'layout', 'table'], file: UploadFile, lang: Optional[str] = None):
+    """
+    Returns at once with a job id, the document is recognized by a worker process.
+    """
+    lang = resolve_language(lang)
+    job_id, directory = await run_in_threadpool(job_queue.create_dir)
+    try:
+        document = await spool_document(file, directory, kinds=('pdf', 'tiff', 'image'))
+        job = await run_in_threadpool(job_queue.submit, job_id, kind, file.filename, document, lang)
+    except BaseException:
+        # Shielded so the directory is removed even when the request is cancelled
+        await asyncio.shield(run_in_threadpool(job_queue.discard_dir, job_id))
+        raise
+    return resp_202(data=job_response(job))
+
+
+@router.get('/{job_id}', summary="Status of a job")
+async def job_info(job_id: str):
+    return resp_200(data=job_response(await get_job(job_id)))
+
+
+@router.get('/{job_id}/events', summary="Stream the status changes and page results of a job as NDJSON")
+async def job_events(job_id: str):
+    """
+    Page results already done are sent first, the stream ends when the job is finished.
+    """
+    await get_job(job_id)
+    pages_path = job_queue.pages_path(job_id)
+
+    async def stream():
+        offset = 0
+        last_state = None
+        while True:
+            job = await run_in_threadpool(job_queue.get, job_id)
+            if job is None:
+                return
+            lines, offset = await run_in_threadpool(read_new_lines, pages_path, offset)
+            for line in lines:
+                yield line
+
+            state = (job['status'], job['pages_done'], job['attempts'], job['cancel_requested'])
+            if state != last_state:
+                last_state = state
+                yield ndjson_line(dict(job_status(job), type='status'))
+            if job['status'] in FINISHED_STATUSES:
+                return
+            await asyncio.sleep(JOB_EVENTS_INTERVAL)
+
+    return StreamingResponse(stream(), media_type=NDJSON_MEDIA_TYPE, status_code=status.HTTP_200_OK)
+
+
+@router.get('/{job_id}/artifact', summary="Download the .docx or .xlsx produced by a job")
+async def job_artifact(job_id: str):
+    job = await get_job(job_id)
+    if job['status'] != SUCCEEDED:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Job is {job['status']}, the artifact is only available once it succeeded"
+        )
+    artifact = job['artifact']
+    return FileResponse(
+        artifact,
+        media_type=ARTIFACT_MEDIA_TYPES.get(os.path.splitext(artifact)[1]),
+        filename=os.path.basename(artifact),
+        status_code=status.HTTP_200_OK
+    )
+
+
+@router.delete('/{job_id}', summary="Cancel a job")
+async def cancel_job(job_id: str):
+    """
+    Queued jobs are cancelled at once, running jobs stop after their current page.
+    """
+    await get_job(job_id)
+    job = await run_in_threadpool(job_queue.cancel, job_id)
+    return resp_200(data=job_response(job))
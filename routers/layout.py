@@ -1,42 +1,57 @@
 # -*- coding: utf-8 -*-
 
-from fastapi import APIRouter, HTTPException, UploadFile, status, BackgroundTasks
-from fastapi.responses import FileResponse
+from functools import partial
+from typing import List, Literal, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, UploadFile, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from models.OCRModel import *
 from models.RestfulModel import *
-from ultralytics import YOLO 
-from paddleocr import PPStructure, save_structure_res
-from paddleocr.ppstructure.recovery.recovery_to_doc import sorted_layout_boxes, convert_info_docx
-from utils.ImageHelper import base64_to_ndarray, bytes_to_ndarray
-import requests
+from paddleocr.ppstructure.recovery.recovery_to_doc import sorted_layout_boxes
+from routers.table import recognize_table_from_image, table_pool
+from utils.BatchInference import (DETECTION_STRATEGY, detect_boxes, detect_regions, recognize_text_batch,
+                                  strategy_cache_name)
+from utils.BatchUpload import batch_response, decode_images, read_batch, read_batch_urls
+from utils.DocumentHelper import DocumentPipeline, document_response, spool_document
+from utils.ExportHelper import DOCX_MEDIA_TYPE, LayoutDocxBuilder, layout_to_docx, stream_layout_docx
+from utils.ImageHelper import base64_to_ndarray
+from utils.ImagePreprocess import decode_image, scale_regions
+from utils.RegionCache import cached_regions, cached_structure
+from utils.ResultCache import cached_inference
+from utils.ResultHelper import encode_artifact, layout_regions
+from utils.StageControl import (StageOptions, layout_options, layout_stage_options, options_cache_name,
+                                structure_options, use_angle_cls, use_recovery, use_table_structure)
+from utils.Timing import StageTimer, timed_iter
+from utils.UploadHelper import read_image, read_upload, upload_limits, upload_openapi
+from utils.UrlFetcher import url_fetcher
+from utils.Workspace import request_workspace
+from utils.ModelRegistry import acquire_model, resolve_language
 import os
-import numpy as np
-import cv2
-from docx import Document
-import shutil
-
-OCR_LANGUAGE = os.environ.get("OCR_LANGUAGE", "en")
 
 router = APIRouter(prefix="/layout", tags=["layout"])
 
-model = YOLO('models/yolov8n-layout.onnx', task='detect')
-layout = PPStructure(recovery=True, lang=OCR_LANGUAGE)
+# Byte and pixel limits of the uploaded images, LAYOUT_MAX_UPLOAD_BYTES and LAYOUT_MAX_UPLOAD_PIXELS
+UPLOAD_LIMITS = upload_limits('layout')
 
-def clear_temp_folder(folder_path):
-    """
-    Clears all files and folders within the specified folder path.
-    """
-    try:
-        if os.path.exists(folder_path):  # Check if the folder exists
-            shutil.rmtree(folder_path)
-        os.makedirs(folder_path)  # Recreate the temp folder after clearing
-    except Exception as e:
-        print(f'Failed to clear {folder_path}. Reason: {e}')
+# Region type of each class of the YOLO layout model (DocLayNet classes) in PPStructure terms
+REGION_TYPES = {
+    0: 'figure_caption',  # Caption
+    1: 'text',            # Footnote
+    2: 'equation',        # Formula
+    3: 'text',            # List-item
+    4: 'footer',          # Page-footer
+    5: 'header',          # Page-header
+    6: 'figure',          # Picture
+    7: 'title',           # Section-header
+    8: 'table',           # Table
+    9: 'text',            # Text
+    10: 'title',          # Title
+}
 
-def text_detection(image_path):
+def text_detection(img):
     # Perform object detection
-    results = model(image_path, classes=[8, 9])  # Assuming classes 8 and 9 are for tables and text
-    boxes = results[0].boxes.xyxy.tolist()
+    boxes = detect_boxes(img, classes=[8, 9])  # Assuming classes 8 and 9 are for tables and text
 
     if not boxes:
         raise HTTPException(
@@ -46,9 +61,153 @@ def text_detection(image_path):
     
     return boxes
 
+def read_regions_text(regions, lang=None, cls=True):
+    """
+    Recognize the text of regions in one OCR call, as the lines of their `res` in page coordinates.
+    """
+    results = cached_regions('text', [region['img'] for region in regions],
+                             lambda crops: recognize_text_batch(crops, cls=cls, lang=lang), lang, scope=f'cls={int(cls)}')
+    for region, result in zip(regions, results):
+        x, y = region['bbox'][:2]
+        region['res'] = [
+            {'text': text, 'confidence': score, 'text_region': [[px + x, py + y] for px, py in box]}
+            for box, (text, score) in result[0] or []
+        ]
+
+def recognize_regions(img, detections, timer, lang=None, options=StageOptions()):
+    """
+    Build PPStructure regions from the YOLO detections, without running the PPStructure layout model.
+    Tables go to the table engine unless table structure is turned off, the text of every other region
+    is recognized in one OCR call.
+    """
+    regions = []
+    for box, label in detections:
+        x1, y1, x2, y2 = map(int, box)
+        if x2 > x1 and y2 > y1:
+            regions.append({'type': REGION_TYPES.get(label, 'text'), 'bbox': [x1, y1, x2, y2],
+                            'img': img[y1:y2, x1:x2], 'res': [], 'img_idx': 0})
+
+    structure = use_table_structure(options.table)
+    tables = [region for region in regions if region['type'] == 'table' and structure]
+    others = [region for region in regions if region['type'] != 'table' or not structure]
+    cls = use_angle_cls(img, options.cls, timer)
+
+    with timer.stage('table'):
+        futures = [table_pool.submit(recognize_table_from_image, region['img'], False, timer, lang)
+                   for region in tables]
+        for region, future in zip(tables, futures):
+            table = future.result()
+            if table is not None:
+                region['res'] = {'html': table['html'], 'cell_bbox': table['cell_bbox']}
+
+    with timer.stage('ocr'):
+        read_regions_text(others, lang, cls)
+    return regions
+
+def layout_analysis(file_data, strategy='skip', lang=None, options=StageOptions()):
+    """
+    Decode the image once and run layout analysis on it with the given detection strategy, timing each stage.
+    Returns the raw PPStructure regions with the image width needed to sort them.
+    """
+    timer = StageTimer(f'layout/{strategy}')
+    with timer.stage('decode'):
+        img, scale = decode_image(file_data)
+    if img is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Unable to decode the image"
+        )
+
+    if strategy == 'regions':
+        # The YOLO regions replace the PPStructure layout model
+        with timer.stage('detect'):
+            detections = detect_regions(img, classes=list(REGION_TYPES))
+        if not detections:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="No Table or text found in image"
+            )
+        h, w, _ = img.shape
+        return scale_regions({'width': w, 'regions': recognize_regions(img, detections, timer, lang, options)}, scale)
+
+    if strategy == 'gate':
+        # Apply text detection on the decoded image, only to reject images without text or tables
+        with timer.stage('detect'):
+            text_detection(img)
+
+    with timer.stage('layout'):
+        return scale_regions(analyze_page(img, lang, **options._asdict()), scale)
+
+def analyze_page(img, lang=None, cls=None, recovery=None, table=None):
+    """
+    Run layout analysis on a decoded image with the layout engine of `lang`.
+    Recovery mode and table structure are used unless turned off by the request or the settings,
+    without table structure the text of the tables is recognized as plain text.
+    """
+    recovery = use_recovery(recovery)
+    table = use_table_structure(table)
+    with acquire_model('layout', lang) as layout:
+        with structure_options(layout, recovery, table), cached_structure(layout, 'layout', lang):
+            result = layout(img)
+
+    if not table:
+        tables = [region for region in result if region['type'] == 'table']
+        if tables:
+            read_regions_text(tables, lang, use_angle_cls(img, cls))
+
+    h, w, _ = img.shape
+    return {'width': w, 'regions': result}
+
+def layout_chunk(datas, lang=None, options=StageOptions()):
+    """
+    Run layout analysis on a chunk of batch images, an exception in place of the images that failed.
+    """
+    results = []
+    images, scales = decode_images(datas)
+    for img, scale in zip(images, scales):
+        if isinstance(img, Exception):
+            results.append(img)
+            continue
+        try:
+            results.append(scale_regions(analyze_page(img, lang, **options._asdict()), scale))
+        except Exception as exc:
+            results.append(exc)
+    return results
+
+def render_layout_page(builder, page_no, analysis):
+    """
+    Add the recovered regions of a document page to the combined .docx.
+    """
+    builder.add_page(sorted_layout_boxes(analysis['regions'], analysis['width']))
+
+def layout_json(analysis):
+    """
+    JSON friendly regions of a layout analysis, in reading order.
+    """
+    return layout_regions(sorted_layout_boxes(analysis['regions'], analysis['width']))
+
+layout_document_pipeline = DocumentPipeline(analyze_page, layout_json, LayoutDocxBuilder,
+                                            render_layout_page, 'docx', DOCX_MEDIA_TYPE)
+
+def render_layout_docx(analysis, strategy='skip'):
+    """
+    Recover a .docx document in memory from a layout analysis.
+    """
+    with StageTimer(f'layout/{strategy}').stage('render'):
+        res = sorted_layout_boxes(analysis['regions'], analysis['width'])
+        return layout_to_docx(res)
+
+def stream_analysis_docx(analysis, strategy='skip'):
+    """
+    Recover a .docx document from a layout analysis, written into the response body region by region.
+    """
+    def chunks():
+        yield from stream_layout_docx(sorted_layout_boxes(analysis['regions'], analysis['width']))
+    return timed_iter(StageTimer(f'layout/{strategy}'), 'render', chunks())
+
 # @router.get('/predict-by-path', response_model=RestfulModel, summary="Layout recognition with local images by path")
 # def predict_by_path(image_path: str):
-#     result = layout(image_path)
+#     result = get_model('layout')(image_path)
 #     restfulModel = RestfulModel(
 #         resultcode=200, message="Success", data=result, cls=LayoutModel)
 #     return restfulModel
@@ -57,87 +216,132 @@ def text_detection(image_path):
 # @router.post('/predict-by-base64', response_model=RestfulModel, summary="Layout recognition with base64 data")
 # def predict_by_base64(base64model: Base64PostModel):
 #     img = base64_to_ndarray(base64model.base64_str)
-#     result = layout(img)
+#     result = get_model('layout')(img)
 #     restfulModel = RestfulModel(
 #         resultcode=200, message="Success", data=result, cls=LayoutModel)
 #     return restfulModel
 
 
-@router.post('/predict-by-file', summary="Layout recognition with uploaded files")
-async def predict_by_file(file: UploadFile, background_tasks: BackgroundTasks):
-    if file.filename.endswith((".jpg", ".png")):  # Only handle common format images
-        save_folder = './temp'  # Change the save folder to './temp'
-        filename_base = os.path.basename(file.filename).split('.')[0]
-        temp_img_path = os.path.join(save_folder, filename_base + '.png')
-
-        # Write the uploaded file to a temporary location
-        with open(temp_img_path, 'wb') as buffer:
-            buffer.write(file.file.read())
-
-        img = cv2.imread(temp_img_path)  # Read the image from the temporary location
-        result = layout(img)
-
-        save_structure_res(result, save_folder, os.path.basename(temp_img_path).split('.')[0])  # Pass the path of the temporary image file to save_structure_res
-        h, w, _ = img.shape
-        res = sorted_layout_boxes(result, w)
-        convert_info_docx(img, res, save_folder, os.path.basename(temp_img_path).split('.')[0])  # This function saves the .docx file
+@router.post('/predict-by-file', summary="Layout recognition with uploaded files", openapi_extra=upload_openapi())
+async def predict_by_file(request: Request, strategy: Optional[Literal['gate', 'skip', 'regions']] = None,
+                          lang: Optional[str] = None, options: StageOptions = Depends(layout_options)):
+    """
+    The YOLO detector is not used unless a detection `strategy` is given.
+    `cls`, `recovery` and `table` turn the angle classifier, recovery mode and table structure on or off,
+    `cls` only applies to the `regions` strategy or with `table` off.
+    """
+    lang = resolve_language(lang)
+    strategy = strategy or 'skip'
+    options = layout_stage_options(options, strategy)
+    # Stream the upload, anything but a .jpg or .png within the limits is rejected before it is read
+    upload = await read_upload(request, UPLOAD_LIMITS)
+    filename_base = os.path.basename(upload.filename).split('.')[0]
 
-        docx_file_path = os.path.join(save_folder, filename_base + '_ocr.docx')
-    else:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Please upload images in .jpg or .png format"
-        )
-    response = FileResponse(
-            docx_file_path, media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    file_data = upload.content
+    analysis = await cached_inference(options_cache_name(strategy_cache_name('layout', strategy), options), file_data,
+                                      layout_analysis, file_data, strategy, lang, options, lang=lang)
+    # Stream the .docx into the response body as the regions are added to it
+    response = StreamingResponse(
+            stream_analysis_docx(analysis, strategy), media_type=DOCX_MEDIA_TYPE,
             headers={'Content-Disposition': f'attachment; filename={filename_base}.docx'},
             status_code=status.HTTP_200_OK
         )
-    background_tasks.add_task(clear_temp_folder, './temp')
     return response
 
 
 @router.post('/predict-by-url', summary="Layout recognition with URL")
-async def predict_by_url(url: str, background_tasks: BackgroundTasks):
-    if url.endswith((".jpg", ".png")):  # Only handle common format images
-        save_folder = './temp'  # Change the save folder to './temp'
-        filename_base = os.path.basename(url).split('.')[0]
-        temp_img_path = os.path.join(save_folder, filename_base + '.png')
-
-        # Download the image from the URL and save it to a temporary location
-        urlresponse = requests.get(url)
-        with open(temp_img_path, 'wb') as buffer:
-            buffer.write(urlresponse.content)
-
-        # Apply text detection
-        text_detection(temp_img_path)
-        
-        img = cv2.imread(temp_img_path)  # Read the image from the temporary location
-        result = layout(img)
-
-        save_structure_res(result, save_folder, os.path.basename(temp_img_path).split('.')[0])  # Pass the path of the temporary image file to save_structure_res
-        h, w, _ = img.shape
-        res = sorted_layout_boxes(result, w)
-        convert_info_docx(img, res, save_folder, os.path.basename(temp_img_path).split('.')[0])  # This function saves the .docx file
+async def predict_by_url(url: str, strategy: Optional[Literal['gate', 'skip', 'regions']] = None,
+                         lang: Optional[str] = None, options: StageOptions = Depends(layout_options)):
+    """
+    The YOLO detector is used according to DETECTION_STRATEGY unless a `strategy` is given.
+    `cls`, `recovery` and `table` turn the angle classifier, recovery mode and table structure on or off,
+    `cls` only applies to the `regions` strategy or with `table` off.
+    """
+    lang = resolve_language(lang)
+    strategy = strategy or DETECTION_STRATEGY
+    options = layout_stage_options(options, strategy)
+    # Download through the shared client, only .jpg and .png content is accepted
+    fetched = await url_fetcher.fetch(url)
+    filename_base = fetched.filename.split('.')[0]
 
-        docx_file_path = os.path.join(save_folder, filename_base + '_ocr.docx')
+    # Apply text detection and layout analysis off the event loop
+    analysis = await cached_inference(options_cache_name(strategy_cache_name('layout', strategy), options),
+                                      fetched.content, layout_analysis, fetched.content, strategy, lang, options,
+                                      lang=lang)
 
-        if not os.path.exists(docx_file_path):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Failed to create .docx file"
-            )
+    # Stream the .docx into the response body as the regions are added to it
+    response = StreamingResponse(
+        stream_analysis_docx(analysis, strategy),
+        media_type=DOCX_MEDIA_TYPE,
+        headers={'Content-Disposition': f'attachment; filename={filename_base}.docx'},
+        status_code=status.HTTP_200_OK
+    )
+    return response
 
-        response = FileResponse(
-            docx_file_path, 
-            media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            headers={'Content-Disposition': f'attachment; filename={filename_base}.docx'},
-            status_code=status.HTTP_200_OK
-        )
-        background_tasks.add_task(clear_temp_folder, './temp')
-        return response
-    else:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid URL. Only .jpg and .png URLs are supported.",
-        )
\ No newline at end of file
+
+@router.post('/predict-json', summary="Layout recognition of an uploaded image or an image URL, as JSON",
+             openapi_extra=upload_openapi(required=False))
+async def predict_json(request: Request, url: Optional[str] = None, artifact: bool = False,
+                       strategy: Optional[Literal['gate', 'skip', 'regions']] = None, lang: Optional[str] = None,
+                       options: StageOptions = Depends(layout_options)):
+    """
+    Regions in reading order with their boxes, text, confidences and table HTML,
+    the recovered .docx is only rendered when `artifact` is set.
+    """
+    lang = resolve_language(lang)
+    image = await read_image(request, url, UPLOAD_LIMITS)
+    strategy = strategy or (DETECTION_STRATEGY if image.from_url else 'skip')
+    options = layout_stage_options(options, strategy)
+    analysis = await cached_inference(options_cache_name(strategy_cache_name('layout', strategy), options),
+                                      image.content, layout_analysis, image.content, strategy, lang, options,
+                                      lang=lang)
+
+    data = {'filename': image.filename, 'width': analysis['width'], 'regions': layout_json(analysis)}
+    if artifact:
+        docx_bytes = await run_in_threadpool(render_layout_docx, analysis, strategy)
+        filename_base = os.path.basename(image.filename).split('.')[0]
+        data['artifact'] = encode_artifact(f'{filename_base}.docx', DOCX_MEDIA_TYPE, docx_bytes)
+    return resp_200_orjson(data=data)
+
+
+@router.post('/predict-batch', summary="Layout recognition of many uploaded images or ZIP archives of images")
+async def predict_batch(files: List[UploadFile], lang: Optional[str] = None,
+                        options: StageOptions = Depends(layout_options)):
+    """
+    Stream one NDJSON line with the regions of each image as soon as it is analyzed.
+    """
+    lang = resolve_language(lang)
+    options = layout_stage_options(options)
+    items = await read_batch(files)
+    return batch_response(options_cache_name('layout', options), items,
+                          partial(layout_chunk, lang=lang, options=options), layout_json, lang=lang)
+
+
+@router.post('/predict-batch-by-url', summary="Layout recognition of many image URLs")
+async def predict_batch_by_url(url: List[str] = Query(...), lang: Optional[str] = None,
+                               options: StageOptions = Depends(layout_options)):
+    """
+    Download the images of the `url` parameters concurrently and stream one NDJSON line with the regions
+    of each image as soon as it is analyzed, a URL that cannot be downloaded only gives an error line.
+    """
+    lang = resolve_language(lang)
+    options = layout_stage_options(options)
+    items = await read_batch_urls(url)
+    return batch_response(options_cache_name('layout', options), items,
+                          partial(layout_chunk, lang=lang, options=options), layout_json, lang=lang)
+
+
+@router.post('/predict-document', summary="Layout recognition of every page of an uploaded PDF or TIFF document")
+async def predict_document(file: UploadFile, output: Literal['ndjson', 'docx'] = 'ndjson', artifact: bool = False,
+                           lang: Optional[str] = None, options: StageOptions = Depends(layout_options),
+                           workspace: str = Depends(request_workspace)):
+    """
+    Stream the regions of each page as NDJSON, or return one recovered .docx for the whole document.
+    The NDJSON stream only ends with the .docx when `artifact` is set.
+    """
+    lang = resolve_language(lang)
+    options = layout_stage_options(options)
+    document = await spool_document(file, workspace)
+    filename_base = os.path.basename(file.filename).split('.')[0]
+    return await document_response(document, layout_document_pipeline, output, filename_base, lang, artifact,
+                                   **options._asdict())
@@ -1,40 +1,39 @@
 # -*- coding: utf-8 -*-
 
-from fastapi import APIRouter, HTTPException, UploadFile, status, BackgroundTasks
+from functools import partial
+from typing import List, Literal, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, UploadFile, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
 from models.OCRModel import *
 from models.RestfulModel import *
-from paddleocr import PaddleOCR
-from ultralytics import YOLO 
-from utils.ImageHelper import base64_to_ndarray, bytes_to_ndarray
-import requests
+from utils.BatchInference import (DETECTION_STRATEGY, detect_boxes, recognize_text, recognize_text_batch,
+                                  recognize_text_tiled, strategy_cache_name)
+from utils.BatchUpload import batch_response, decode_images, map_decoded, read_batch, read_batch_urls
+from utils.DocumentHelper import DocumentPipeline, document_response, spool_document
+from utils.ExportHelper import DOCX_MEDIA_TYPE, TextDocxBuilder, stream_text_docx, text_to_docx
+from utils.ImageHelper import base64_to_ndarray
+from utils.ImagePreprocess import decode_image, needs_tiling, scale_ocr_result
+from utils.ModelRegistry import resolve_language
+from utils.RegionCache import cached_regions
+from utils.ResultCache import cached_inference
+from utils.ResultHelper import encode_artifact, ocr_lines, ocr_text
+from utils.StageControl import StageOptions, options_cache_name, use_angle_cls
+from utils.Timing import StageTimer, timed_iter
+from utils.UploadHelper import read_image, read_upload, upload_limits, upload_openapi
+from utils.UrlFetcher import url_fetcher
+from utils.Workspace import request_workspace
 import os
-import io
-from docx import Document
-import shutil
-
-OCR_LANGUAGE = os.environ.get("OCR_LANGUAGE", "en")
 
 router = APIRouter(prefix="/ocr", tags=["OCR"])
 
-model = YOLO('models/yolov8n-layout.onnx', task='detect')
-ocr = PaddleOCR(use_angle_cls=True, lang=OCR_LANGUAGE)
-
-def clear_temp_folder(folder_path):
-    """
-    Clears all files and folders within the specified folder path.
-    """
-    try:
-        if os.path.exists(folder_path):  # Check if the folder exists
-            shutil.rmtree(folder_path)
-        os.makedirs(folder_path)  # Recreate the temp folder after clearing
-    except Exception as e:
-        print(f'Failed to clear {folder_path}. Reason: {e}')
+# Byte and pixel limits of the uploaded images, OCR_MAX_UPLOAD_BYTES and OCR_MAX_UPLOAD_PIXELS
+UPLOAD_LIMITS = upload_limits('ocr')
 
-def text_detection(image_path):
+def text_detection(img):
     # Perform object detection
-    results = model(image_path, classes=[8, 9])  # Assuming classes 8 and 9 are for tables and text
-    boxes = results[0].boxes.xyxy.tolist()
+    boxes = detect_boxes(img, classes=[8, 9])  # Assuming classes 8 and 9 are for tables and text
 
     if not boxes:
         raise HTTPException(
@@ -44,9 +43,116 @@ def text_detection(image_path):
     
     return boxes
 
+def recognize_page(img, lang=None, cls=True):
+    if needs_tiling(img):
+        return recognize_text_tiled(img, cls=cls, lang=lang)
+    return recognize_text(img, cls=cls, lang=lang)
+
+def ocr_image(img, lang=None, cls=None):
+    """
+    Run PaddleOCR on image data, batched with concurrent requests in the same language.
+    Text lines go through the angle classifier according to `cls`, or to the page orientation when it is None.
+    """
+    return recognize_page(img, lang, use_angle_cls(img, cls))
+
+def ocr_images(images, lang=None, cls=None):
+    """
+    Run OCR on several decoded images, the text lines of all of them together except the very large ones, which are tiled.
+    """
+    flags = [use_angle_cls(img, cls) for img in images]
+    results = [None] * len(images)
+    whole = [i for i, img in enumerate(images) if not needs_tiling(img)]
+    for i, result in zip(whole, recognize_text_batch([images[i] for i in whole], cls=[flags[i] for i in whole],
+                                                     lang=lang)):
+        results[i] = result
+    for i, img in enumerate(images):
+        if results[i] is None:
+            results[i] = recognize_text_tiled(img, cls=flags[i], lang=lang)
+    return results
+
+def ocr_regions(img, boxes, lang=None, cls=True):
+    """
+    Recognize the text of the detected regions only, the crops of every region in one recognition call.
+    Returns the lines in page coordinates, in the format of PaddleOCR.ocr.
+    """
+    crops = []
+    offsets = []
+    for box in sorted(boxes, key=lambda box: (box[1], box[0])):
+        x1, y1, x2, y2 = map(int, box)
+        if x2 > x1 and y2 > y1:
+            crops.append(img[y1:y2, x1:x2])
+            offsets.append((x1, y1))
+
+    lines = []
+    results = cached_regions('text', crops, lambda missing: recognize_text_batch(missing, cls=cls, lang=lang), lang,
+                             scope=f'cls={int(cls)}')
+    for (x, y), result in zip(offsets, results):
+        for box, rec in result[0] or []:
+            lines.append([[[px + x, py + y] for px, py in box], rec])
+    return [lines or None]
+
+def ocr_pipeline(file_data, strategy, lang=None, cls=None):
+    """
+    Decode the image once and run OCR with the given detection strategy, timing each stage.
+    """
+    timer = StageTimer(f'ocr/{strategy}')
+    with timer.stage('decode'):
+        img, scale = decode_image(file_data)
+    if img is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Unable to decode the image"
+        )
+
+    if strategy == 'regions':
+        # Only the text and tables found by YOLO are recognized
+        with timer.stage('detect'):
+            boxes = text_detection(img)
+        cls = use_angle_cls(img, cls, timer)
+        with timer.stage('recognize'):
+            return scale_ocr_result(ocr_regions(img, boxes, lang, cls), scale)
+
+    if strategy == 'gate':
+        # Apply text detection, only to reject images without text or tables
+        with timer.stage('detect'):
+            text_detection(img)
+    cls = use_angle_cls(img, cls, timer)
+    with timer.stage('recognize'):
+        return scale_ocr_result(recognize_page(img, lang, cls), scale)
+
+def render_ocr_docx(result, strategy):
+    """
+    Single paragraph .docx of the recognized text, built in memory.
+    """
+    with StageTimer(f'ocr/{strategy}').stage('render'):
+        return text_to_docx(ocr_text(result))
+
+def stream_ocr_docx(result, strategy):
+    """
+    Single paragraph .docx of the recognized text, written into the response body as it is generated.
+    """
+    return timed_iter(StageTimer(f'ocr/{strategy}'), 'render', stream_text_docx(ocr_text(result)))
+
+def ocr_chunk(datas, lang=None, cls=None):
+    """
+    Run OCR on a chunk of batch images, recognizing all their text lines together.
+    """
+    images, scales = decode_images(datas)
+    results = map_decoded(images, partial(ocr_images, lang=lang, cls=cls))
+    return [result if isinstance(result, Exception) else scale_ocr_result(result, scale)
+            for result, scale in zip(results, scales)]
+
+def render_ocr_page(builder, page_no, result):
+    """
+    Add the recognized text of a document page to the combined .docx.
+    """
+    builder.add_page(ocr_text(result))
+
+ocr_document_pipeline = DocumentPipeline(ocr_image, ocr_lines, TextDocxBuilder, render_ocr_page, 'docx', DOCX_MEDIA_TYPE)
+
 # @router.get('/predict-by-path', response_model=RestfulModel, summary="Identify local images by path")
 # def predict_by_path(image_path: str):
-#     result = ocr.ocr(image_path, cls=True)
+#     result = get_model('ocr').ocr(image_path, cls=True)
 #     restfulModel = RestfulModel(
 #         resultcode=200, message="Success", data=result, cls=OCRModel)
 #     return restfulModel
@@ -55,103 +161,125 @@ def text_detection(image_path):
 # @router.post('/predict-by-base64', response_model=RestfulModel, summary="Recognize base64 data")
 # def predict_by_base64(base64model: Base64PostModel):
 #     img = base64_to_ndarray(base64model.base64_str)
-#     result = ocr.ocr(img=img, cls=True)
+#     result = get_model('ocr').ocr(img=img, cls=True)
 #     restfulModel = RestfulModel(
 #         resultcode=200, message="Success", data=result, cls=OCRModel)
 #     return restfulModel
 
 
-@router.post('/predict-by-file', summary="Identify uploaded files")
-async def predict_by_file(file: UploadFile, background_tasks: BackgroundTasks):
-    if file.filename.endswith((".jpg", ".png")):  # Only handle common format images
-        file_data = await file.read()  # Read file asynchronously
-        result = ocr.ocr(file_data, cls=True)  # Perform OCR on the image data
-
-        # Convert OCR results to .docx
-        extracted_text = ""
-        for line in result:
-            for word in line:
-                extracted_text += word[1][0] + " "  # Extracted text is at index 0 in each word tuple
-
-        doc = Document()
-        doc.add_paragraph(extracted_text)
-        
-        # Save .docx file to BytesIO buffer
-        docx_bytes = io.BytesIO()
-        doc.save(docx_bytes)
-        docx_bytes.seek(0)
-
-        # Prepare filename for attachment
-        filename_base = os.path.basename(file.filename).split('.')[0]
-
-        # Return .docx file as a streaming response
-        response = StreamingResponse(
-            docx_bytes,
-            media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            headers={'Content-Disposition': f'attachment; filename={filename_base}.docx'},
-            status_code=status.HTTP_200_OK
-        )
-        background_tasks.add_task(clear_temp_folder, './temp')
-        return response
-    else:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Please upload images in .jpg or .png format"
-        )
-
-
-@router.get('/predict-by-url', summary="Identify image URL")
-async def predict_by_url(url: str, background_tasks: BackgroundTasks):
-    if not url.lower().endswith((".jpg", ".png")):  # Only handle common format images
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Please provide URLs to images in .jpg or .png format"
-        )
-
-    urlresponse = requests.get(url)
-    if urlresponse.status_code != 200:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Unable to access the provided URL"
-        )
-
-    file_data = urlresponse.content
+@router.post('/predict-by-file', summary="Identify uploaded files", openapi_extra=upload_openapi())
+async def predict_by_file(request: Request, strategy: Optional[Literal['gate', 'skip', 'regions']] = None,
+                          lang: Optional[str] = None, cls: Optional[bool] = None):
+    """
+    The YOLO detector is not used unless a detection `strategy` is given.
+    The angle classifier runs according to `cls`, by default on pages not found upright (ANGLE_CLS).
+    """
+    lang = resolve_language(lang)
+    # Stream the upload, anything but a .jpg or .png within the limits is rejected before it is read
+    upload = await read_upload(request, UPLOAD_LIMITS)
+    file_data = upload.content
+    strategy = strategy or 'skip'
+    # Perform OCR on the image data off the event loop
+    result = await cached_inference(options_cache_name(strategy_cache_name('ocr', strategy), StageOptions(cls)),
+                                    file_data, ocr_pipeline, file_data, strategy, lang, cls, lang=lang)
 
-    # Save the image to a temporary location
-    save_folder = './temp'
-    filename_base = os.path.basename(url).split('.')[0]
-    temp_img_path = os.path.join(save_folder, filename_base + '.png')
-    with open(temp_img_path, 'wb') as buffer:
-        buffer.write(file_data)
+    # Prepare filename for attachment
+    filename_base = os.path.basename(upload.filename).split('.')[0]
 
-    # Apply text detection
-    text_detection(temp_img_path)
-    
-    result = ocr.ocr(file_data, cls=True)  # Perform OCR on the image data
+    # Stream the .docx into the response body as it is generated
+    response = StreamingResponse(
+        stream_ocr_docx(result, strategy),
+        media_type=DOCX_MEDIA_TYPE,
+        headers={'Content-Disposition': f'attachment; filename={filename_base}.docx'},
+        status_code=status.HTTP_200_OK
+    )
+    return response
 
-    # Convert OCR results to .docx
-    extracted_text = ""
-    for line in result:
-        for word in line:
-            extracted_text += word[1][0] + " "  # Extracted text is at index 0 in each word tuple
 
-    doc = Document()
-    doc.add_paragraph(extracted_text)
+@router.get('/predict-by-url', summary="Identify image URL")
+async def predict_by_url(url: str, strategy: Optional[Literal['gate', 'skip', 'regions']] = None,
+                         lang: Optional[str] = None, cls: Optional[bool] = None):
+    """
+    The YOLO detector is used according to DETECTION_STRATEGY unless a `strategy` is given.
+    The angle classifier runs according to `cls`, by default on pages not found upright (ANGLE_CLS).
+    """
+    lang = resolve_language(lang)
+    # Download through the shared client, only .jpg and .png content is accepted
+    fetched = await url_fetcher.fetch(url)
+    file_data = fetched.content
+    strategy = strategy or DETECTION_STRATEGY
 
-    # Save .docx file to BytesIO buffer
-    docx_bytes = io.BytesIO()
-    doc.save(docx_bytes)
-    docx_bytes.seek(0)
+    # Perform detection and OCR off the event loop
+    result = await cached_inference(options_cache_name(strategy_cache_name('ocr', strategy), StageOptions(cls)),
+                                    file_data, ocr_pipeline, file_data, strategy, lang, cls, lang=lang)
 
     # Prepare filename for attachment
-    filename_base = os.path.basename(url).split('.')[0]
+    filename_base = fetched.filename.split('.')[0]
 
-    # Return .docx file as a streaming response
+    # Stream the .docx into the response body as it is generated
     response = StreamingResponse(
-        docx_bytes,
-        media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        stream_ocr_docx(result, strategy),
+        media_type=DOCX_MEDIA_TYPE,
         headers={'Content-Disposition': f'attachment; filename={filename_base}.docx'},
         status_code=status.HTTP_200_OK
     )
-    background_tasks.add_task(clear_temp_folder, './temp')
     return response
+
+
+@router.post('/predict-json', summary="Identify an uploaded image or an image URL, as JSON",
+             openapi_extra=upload_openapi(required=False))
+async def predict_json(request: Request, url: Optional[str] = None, artifact: bool = False,
+                       strategy: Optional[Literal['gate', 'skip', 'regions']] = None, lang: Optional[str] = None,
+                       cls: Optional[bool] = None):
+    """
+    Text lines with their boxes and confidences, the .docx is only rendered when `artifact` is set.
+    """
+    lang = resolve_language(lang)
+    image = await read_image(request, url, UPLOAD_LIMITS)
+    strategy = strategy or (DETECTION_STRATEGY if image.from_url else 'skip')
+    result = await cached_inference(options_cache_name(strategy_cache_name('ocr', strategy), StageOptions(cls)),
+                                    image.content, ocr_pipeline, image.content, strategy, lang, cls, lang=lang)
+
+    data = {'filename': image.filename, 'lines': ocr_lines(result)}
+    if artifact:
+        docx_bytes = await run_in_threadpool(render_ocr_docx, result, strategy)
+        filename_base = os.path.basename(image.filename).split('.')[0]
+        data['artifact'] = encode_artifact(f'{filename_base}.docx', DOCX_MEDIA_TYPE, docx_bytes)
+    return resp_200_orjson(data=data)
+
+
+@router.post('/predict-batch', summary="Identify many uploaded images or ZIP archives of images")
+async def predict_batch(files: List[UploadFile], lang: Optional[str] = None, cls: Optional[bool] = None):
+    """
+    Stream one NDJSON line with the text lines of each image as soon as it is recognized.
+    """
+    lang = resolve_language(lang)
+    items = await read_batch(files)
+    return batch_response(options_cache_name('ocr', StageOptions(cls)), items, partial(ocr_chunk, lang=lang, cls=cls),
+                          ocr_lines, lang=lang)
+
+
+@router.post('/predict-batch-by-url', summary="Identify many image URLs")
+async def predict_batch_by_url(url: List[str] = Query(...), lang: Optional[str] = None, cls: Optional[bool] = None):
+    """
+    Download the images of the `url` parameters concurrently and stream one NDJSON line with the text
+    lines of each image as soon as it is recognized, a URL that cannot be downloaded only gives an error line.
+    """
+    lang = resolve_language(lang)
+    items = await read_batch_urls(url)
+    return batch_response(options_cache_name('ocr', StageOptions(cls)), items, partial(ocr_chunk, lang=lang, cls=cls),
+                          ocr_lines, lang=lang)
+
+
+@router.post('/predict-document', summary="Identify every page of an uploaded PDF or TIFF document")
+async def predict_document(file: UploadFile, output: Literal['ndjson', 'docx'] = 'ndjson', artifact: bool = False,
+                           lang: Optional[str] = None, cls: Optional[bool] = None,
+                           workspace: str = Depends(request_workspace)):
+    """
+    Stream the text lines of each page as NDJSON, or return one .docx with a page per document page.
+    The NDJSON stream only ends with the .docx when `artifact` is set.
+    """
+    lang = resolve_language(lang)
+    document = await spool_document(file, workspace)
+    filename_base = os.path.basename(file.filename).split('.')[0]
+    return await document_response(document, ocr_document_pipeline, output, filename_base, lang, artifact, cls=cls)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from fastapi import APIRouter
+from models.RestfulModel import *
+from utils.Admission import admission, rate_limiter
+from utils.BatchInference import batcher_stats
+from utils.InferenceExecutor import inference_executor
+from utils.JobQueue import job_queue
+from utils.Lifecycle import worker_lifecycle
+from utils.MemoryHelper import current_rss_bytes, peak_rss_bytes
+from utils.ModelRegistry import registry
+from utils.RegionCache import region_cache
+from utils.ResultCache import result_cache
+from utils.StageControl import stage_decisions
+from utils.Timing import stage_stats
+from utils.Workspace import workspace_manager
+
+router = APIRouter(prefix="/system", tags=["system"])
+
+
+@router.get('/models', summary="Loaded models with their load time and resident memory, and the engine pools per language")
+def list_models():
+    return resp_200(data={
+        'models': registry.stats(),
+        'pools': registry.pool_stats(),
+        'process_rss_bytes': current_rss_bytes(),
+        'process_peak_rss_bytes': peak_rss_bytes(),
+    })
+
+
+@router.get('/inference', summary="Inference executor queue depth, wait time and batch sizes")
+def inference_stats():
+    return resp_200(data={
+        'executor': inference_executor.stats(),
+        'batchers': batcher_stats(),
+    })
+
+
+@router.get('/admission', summary="Compute budget in use, admitted and rejected requests per lane, and rate limiting")
+def admission_stats():
+    return resp_200(data={**admission.stats(), 'rate_limit': rate_limiter.stats()})
+
+
+@router.get('/workspaces', summary="Per-request scratch workspaces")
+def workspace_stats():
+    return resp_200(data=workspace_manager.stats())
+
+
+@router.get('/cache', summary="Result cache and region cache hit/miss counters and size")
+def cache_stats():
+    return resp_200(data={**result_cache.stats(), 'regions': region_cache.stats()})
+
+
+@router.get('/jobs', summary="Number of jobs per status")
+def job_stats():
+    return resp_200(data=job_queue.stats())
+
+
+@router.get('/stages', summary="Latency of each pipeline stage, and how often the optional stages are skipped")
+def stage_latency():
+    return resp_200(data={'stages': stage_stats.stats(), 'optional': stage_decisions.stats()})
+
+
+@router.get('/live', summary="Liveness probe, answers as soon as the process serves requests")
+def liveness():
+    return resp_200(data={'pid': os.getpid()})
+
+
+@router.get('/ready', summary="Readiness probe, 503 until the models are loaded and warmed up, and while draining")
+def readiness():
+    state = worker_lifecycle.stats()
+    if not state['ready']:
+        if state['draining']:
+            message = "Draining"
+        else:
+            message = "Warm-up failed" if state['error'] else "Warming up"
+        return resp_503(data=state, message=message)
+    return resp_200(data=state)
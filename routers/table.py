@@ -1,21 +1,33 @@
 # -*- coding: utf-8 -*-
 
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, status, BackgroundTasks
-from fastapi.responses import FileResponse
+from typing import List, Literal, Optional
+
+from fastapi import FastAPI, APIRouter, Depends, HTTPException, Query, Request, UploadFile, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from ultralytics import YOLO 
 from models.OCRModel import *
 from models.RestfulModel import *
-from paddleocr import PPStructure, save_structure_res
-from utils.ImageHelper import base64_to_ndarray, bytes_to_ndarray
-import requests
+from utils.BatchInference import detect_boxes, detect_boxes_batch
+from utils.BatchUpload import batch_response, decode_images, map_decoded, read_batch, read_batch_urls
+from utils.DocumentHelper import DocumentPipeline, document_response, spool_document
+from utils.ExportHelper import XLSX_MEDIA_TYPE, ZIP_MEDIA_TYPE, TablesWorkbookBuilder, ZipStream, table_html_to_xlsx
+from utils.ImageHelper import base64_to_ndarray
+from utils.ImagePreprocess import decode_image, scale_tables
+from utils.RegionCache import cached_structure
+from utils.ResultCache import admitted_inference, cached_inference, cached_result, result_cache
+from utils.ResultHelper import encode_artifact, table_results
+from utils.Timing import StageTimer, timed_iter
+from utils.UploadHelper import read_image, read_upload, upload_limits, upload_openapi
+from utils.UrlFetcher import url_fetcher
+from utils.Workspace import request_workspace
+from utils.ModelRegistry import TABLE_PARALLELISM, acquire_model, resolve_language
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import time
+from functools import partial
 import os
-import numpy as np
-import cv2
-import glob
-import zipfile
 from urllib.parse import quote
-import shutil
 
 app = FastAPI()
 app.add_middleware(
@@ -26,56 +38,218 @@ app.add_middleware(
     allow_headers=["*"],  # Or specify just the headers you need
 )
 
-OCR_LANGUAGE = os.environ.get("OCR_LANGUAGE", "en")
-
 router = APIRouter(prefix="/table", tags=["table"])
 
-model = YOLO('models/yolov8n-layout.onnx', task='detect')
-table_engine = PPStructure(lang=OCR_LANGUAGE, layout=False)
+# Byte and pixel limits of the uploaded images, TABLE_MAX_UPLOAD_BYTES and TABLE_MAX_UPLOAD_PIXELS
+UPLOAD_LIMITS = upload_limits('table')
+
+# Tables of one page are recognized concurrently, each worker checks out its own table engine
+table_pool = ThreadPoolExecutor(max_workers=TABLE_PARALLELISM, thread_name_prefix='table')
 
-def clear_temp_folder(folder_path):
+def table_detection(img, required=True, xlsx=True, boxes=None, timer=None, lang=None, on_table=None):
     """
-    Clears all files and folders within the specified folder path.
+    Detect the tables of a decoded image and recognize them concurrently.
+    Returns one recognized table per detected box, None where no table structure was found.
+    Raises a 404 when no table is found unless `required` is False.
+    `on_table(index, table)` is called as each table is recognized, in completion order.
     """
-    try:
-        if os.path.exists(folder_path):  # Check if the folder exists
-            shutil.rmtree(folder_path)
-        os.makedirs(folder_path)  # Recreate the temp folder after clearing
-    except Exception as e:
-        print(f'Failed to clear {folder_path}. Reason: {e}')
-
-def table_detection(image_path, save_folder, base_filename):
-    # Load the original image
-    img = cv2.imread(image_path)
-    
-    # Perform object detection
-    results = model(image_path, classes=[8])
-    boxes = results[0].boxes.xyxy.tolist()
+    timer = timer or StageTimer('table')
+    # Perform object detection on the decoded image, unless it was done for a whole batch
+    if boxes is None:
+        with timer.stage('detect'):
+            boxes = detect_boxes(img, classes=[8])
 
+    if not boxes and not required:
+        return []
     if not boxes:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="No Table found in image"
         )
 
-    # Process each detected object sequentially
-    for i, box in enumerate(boxes, start=1):
+    crops = []
+    for box in boxes:
         x1, y1, x2, y2 = map(int, box)
-        cropped_img = img[y1:y2, x1:x2]
-        
-        # Recognize table from the cropped image sequentially
-        recognize_table_from_image(cropped_img, save_folder, f'{base_filename}')
+        crops.append(img[y1:y2, x1:x2])
+
+    # Recognize the cropped tables in parallel, keeping the detection order in the result
+    tables = [None] * len(crops)
+    with timer.stage('tables'):
+        futures = {table_pool.submit(recognize_table_from_image, crop, xlsx, timer, lang): i
+                   for i, crop in enumerate(crops)}
+        for future in as_completed(futures):
+            i = futures[future]
+            table = future.result()
+            if table is not None:
+                table['bbox'] = [float(v) for v in boxes[i]]
+            tables[i] = table
+            if on_table is not None:
+                on_table(i, table)
+    return tables
+
+def recognize_table_from_image(img_array, xlsx=True, timer=None, lang=None):
+    """
+    Recognize table from an image array with the table engine of `lang` and convert it to .xlsx as soon as it is done.
+    Returns the table HTML, cells and .xlsx bytes (None when `xlsx` is False), None when no table structure was found.
+    """
+    timer = timer or StageTimer('table')
+    with timer.stage('structure'):
+        with acquire_model('table', lang) as table_engine, cached_structure(table_engine, 'table', lang):
+            result = table_engine(img_array)
+    for region in result:
+        if region['type'] == 'table' and 'html' in region['res']:
+            html = region['res']['html']
+            xlsx_bytes = None
+            if xlsx:
+                with timer.stage('xlsx'):
+                    xlsx_bytes = table_html_to_xlsx(html)
+            return {
+                'html': html,
+                'cell_bbox': region['res'].get('cell_bbox'),
+                'xlsx': xlsx_bytes,
+            }
+    return None
+
+def table_recognition(file_data, lang=None, xlsx=True, on_table=None):
+    """
+    Decode the image once and recognize every table in it, an image without tables gives an empty list.
+    """
+    timer = StageTimer('table')
+    with timer.stage('decode'):
+        img, scale = decode_image(file_data)
+    if img is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Unable to decode the image"
+        )
+
+    return scale_tables(table_detection(img, required=False, xlsx=xlsx, timer=timer, lang=lang, on_table=on_table),
+                        scale)
+
+def require_tables(tables):
+    if not tables:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No Table found in image"
+        )
+    return tables
+
+def table_chunk(datas, lang=None):
+    """
+    Recognize the tables of a chunk of batch images, detecting the tables of all of them in one YOLO call.
+    """
+    images, scales = decode_images(datas)
+    detections = map_decoded(images, lambda decoded: detect_boxes_batch(decoded, classes=[8]))
+    results = []
+    for img, scale, boxes in zip(images, scales, detections):
+        if isinstance(boxes, Exception):
+            results.append(boxes)
+            continue
+        try:
+            results.append(scale_tables(table_detection(img, required=False, xlsx=False, boxes=boxes, lang=lang),
+                                        scale))
+        except Exception as exc:
+            results.append(exc)
+    return results
+
+def table_xlsx_name(filename_base, i):
+    return f'{filename_base}_table_{i + 1}.xlsx'
+
+def stream_tables_zip(tables, filename_base):
+    """
+    Zip the .xlsx files of recognized tables, yielding the archive as each file is added to it.
+    """
+    archive = ZipStream()
+    for i, table in enumerate(tables):
+        if table is not None:
+            yield archive.add(table_xlsx_name(filename_base, i), table['xlsx'] or table_html_to_xlsx(table['html']))
+    yield archive.close()
+
+async def tables_zip_response(file_data, lang, filename_base):
+    """
+    Zip of the .xlsx of every table in an image, streamed as each table is recognized.
+    Cached tables are zipped right away, otherwise the archive starts with the first table recognized
+    and the tables are cached once all of them are. Raises a 404 when no table is found.
+    """
+    timer = StageTimer('table')
+    headers = {'Content-Disposition': f'attachment; filename={filename_base}.zip'}
+    key, tables = await cached_result('table', file_data, lang)
+    if tables is not None:
+        return StreamingResponse(timed_iter(timer, 'zip', stream_tables_zip(require_tables(tables), filename_base)),
+                                 media_type=ZIP_MEDIA_TYPE, headers=headers, status_code=status.HTTP_200_OK)
+
+    loop = asyncio.get_running_loop()
+    recognized = asyncio.Queue()
+
+    def on_table(i, table):
+        loop.call_soon_threadsafe(recognized.put_nowait, (i, table))
+
+    async def recognize():
+        try:
+            return await admitted_inference(file_data, table_recognition, file_data, lang, on_table=on_table)
+        finally:
+            # Marks the end of the tables, also when the request was rejected or the recognition failed. The
+            # result of the inference thread reaches the event loop after the tables it handed to on_table
+            recognized.put_nowait(None)
+
+    task = asyncio.ensure_future(recognize())
+    first = await recognized.get()
+    if first is None:
+        # Raises the rejection or the error, or a 404 without tables
+        require_tables(await task)
 
-def recognize_table_from_image(img_array, save_folder, image_name):
+    async def stream():
+        archive = ZipStream()
+        elapsed = 0.0
+        item = first
+        while item is not None:
+            i, table = item
+            if table is not None:
+                start = time.perf_counter()
+                content = table['xlsx'] or table_html_to_xlsx(table['html'])
+                chunk = await run_in_threadpool(archive.add, table_xlsx_name(filename_base, i), content)
+                elapsed += time.perf_counter() - start
+                yield chunk
+            item = await recognized.get()
+        tables = await task
+        yield archive.close()
+        timer.record('zip', elapsed)
+        if key:
+            await run_in_threadpool(result_cache.put, key, tables)
+
+    return StreamingResponse(stream(), media_type=ZIP_MEDIA_TYPE, headers=headers, status_code=status.HTTP_200_OK)
+
+def render_tables_workbook(tables):
+    """
+    One .xlsx workbook in memory with a sheet per recognized table.
+    """
+    with StageTimer('table').stage('workbook'):
+        builder = TablesWorkbookBuilder()
+        for i, table in enumerate(tables, start=1):
+            if table is not None:
+                builder.add_table(table['html'], f'Table {i}')
+        return builder.save()
+
+def recognize_page_tables(img, lang=None):
     """
-    Recognize table from an image array and save the result.
+    Recognize the tables of a document page, pages without tables give an empty list.
     """
-    result = table_engine(img_array)
-    save_structure_res(result, save_folder, image_name)
+    return table_detection(img, required=False, xlsx=False, lang=lang)
+
+def render_table_page(builder, page_no, tables):
+    """
+    Add the tables of a document page to the combined workbook, one sheet per table.
+    """
+    for i, table in enumerate(tables, start=1):
+        if table is not None:
+            builder.add_table(table['html'], f'Page {page_no} Table {i}')
+
+table_document_pipeline = DocumentPipeline(recognize_page_tables, table_results, TablesWorkbookBuilder,
+                                           render_table_page, 'xlsx', XLSX_MEDIA_TYPE)
 
 # @router.get('/predict-by-path', response_model=RestfulModel, summary="table recognition with local images by path")
 # def predict_by_path(image_path: str):
-#     result = table_engine(image_path)
+#     result = get_model('table')(image_path)
 #     restfulModel = RestfulModel(
 #         resultcode=200, message="Success", data=result, cls=LayoutModel)
 #     return restfulModel
@@ -84,89 +258,82 @@ def recognize_table_from_image(img_array, save_folder, image_name):
 # @router.post('/predict-by-base64', response_model=RestfulModel, summary="table recognition with base64 data")
 # def predict_by_base64(base64model: Base64PostModel):
 #     img = base64_to_ndarray(base64model.base64_str)
-#     result = table_engine(img)
+#     result = get_model('table')(img)
 #     restfulModel = RestfulModel(
 #         resultcode=200, message="Success", data=result, cls=LayoutModel)
 #     return restfulModel
 
 
-@router.post('/predict-by-file-zip', summary="Zip file of table recognition with uploaded files")
-async def predict_by_file_zip(file: UploadFile, background_tasks: BackgroundTasks):
-    if not file.filename.endswith((".jpg", ".png")):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Please upload images in .jpg or .png format"
-        )
-    
-    save_folder = './temp'
-    filename_base = os.path.basename(file.filename).split('.')[0]
-    temp_img_path = os.path.join(save_folder, filename_base + '.png')
+@router.post('/predict-by-file-zip', summary="Zip file of table recognition with uploaded files",
+             openapi_extra=upload_openapi())
+async def predict_by_file_zip(request: Request, lang: Optional[str] = None):
+    lang = resolve_language(lang)
+    # Stream the upload, anything but a .jpg or .png within the limits is rejected before it is read
+    upload = await read_upload(request, UPLOAD_LIMITS)
+    filename_base = os.path.basename(upload.filename).split('.')[0]
 
-    with open(temp_img_path, 'wb') as buffer:
-        buffer.write(file.file.read())
+    # The .xlsx of each table goes into the response body as soon as the table is recognized
+    return await tables_zip_response(upload.content, lang, filename_base)
 
-    # Assuming table_detection function processes the image and saves xlsx files
-    table_detection(temp_img_path, save_folder, filename_base)
-
-    specific_folder = os.path.join(save_folder, filename_base)
-    xlsx_files = glob.glob(os.path.join(specific_folder, '*.xlsx'))
-
-    zip_file_path = os.path.join(save_folder, filename_base + '.zip')
-    with zipfile.ZipFile(zip_file_path, 'w') as zipf:
-        for file in xlsx_files:
-            zipf.write(file, os.path.basename(file))
+@router.post('/predict-by-url-zip', summary="Zip file of table recognition with URL")
+async def predict_by_url_zip(url: str, lang: Optional[str] = None):
+    lang = resolve_language(lang)
+    # Download through the shared client, only .jpg and .png content is accepted
+    fetched = await url_fetcher.fetch(url)
+    filename_base = fetched.filename.split('.')[0]
 
-    response = FileResponse(
-            zip_file_path, 
-            media_type="application/zip",
-            headers={'Content-Disposition': f'attachment; filename={filename_base}.zip'},
-            status_code=status.HTTP_200_OK
-        )
-    background_tasks.add_task(clear_temp_folder, './temp')
-    return response
+    # The .xlsx of each table goes into the response body as soon as the table is recognized
+    return await tables_zip_response(fetched.content, lang, filename_base)
 
-@router.post('/predict-by-url-zip', summary="Zip file of table recognition with URL")
-async def predict_by_url_zip(url: str, background_tasks: BackgroundTasks):
-    if not url.endswith((".jpg", ".png")):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Please provide a URL pointing to an image in .jpg or .png format"
-        )
-    
-    save_folder = './temp'
-    filename_base = os.path.basename(url).split('.')[0]
-    temp_img_path = os.path.join(save_folder, filename_base + '.png')
-
-    # Download the image from the URL and save it to a temporary location
-    urlresponse = requests.get(url)
-    if urlresponse.status_code == 200:
-        with open(temp_img_path, 'wb') as buffer:
-            buffer.write(urlresponse.content)
-    else:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Failed to download the image from the provided URL"
-        )
+@router.post('/predict-json', summary="Table recognition of an uploaded image or an image URL, as JSON",
+             openapi_extra=upload_openapi(required=False))
+async def predict_json(request: Request, url: Optional[str] = None, artifact: bool = False,
+                       lang: Optional[str] = None):
+    """
+    Box, HTML and cells of every detected table, the .xlsx is only rendered when `artifact` is set.
+    """
+    lang = resolve_language(lang)
+    image = await read_image(request, url, UPLOAD_LIMITS)
+    tables = await cached_inference('table', image.content, table_recognition, image.content, lang, xlsx=False,
+                                    lang=lang)
 
-    # Assuming table_detection function processes the image and saves xlsx files
-    table_detection(temp_img_path, save_folder, filename_base)
+    data = {'filename': image.filename, 'tables': table_results(tables)}
+    if artifact:
+        xlsx_bytes = await run_in_threadpool(render_tables_workbook, tables)
+        filename_base = os.path.basename(image.filename).split('.')[0]
+        data['artifact'] = encode_artifact(f'{filename_base}.xlsx', XLSX_MEDIA_TYPE, xlsx_bytes)
+    return resp_200_orjson(data=data)
 
-    specific_folder = os.path.join(save_folder, filename_base)
-    xlsx_files = glob.glob(os.path.join(specific_folder, '*.xlsx'))
+@router.post('/predict-batch', summary="Table recognition of many uploaded images or ZIP archives of images")
+async def predict_batch(files: List[UploadFile], lang: Optional[str] = None):
+    """
+    Stream one NDJSON line with the tables of each image as soon as they are recognized.
+    """
+    lang = resolve_language(lang)
+    items = await read_batch(files)
+    return batch_response('table', items, partial(table_chunk, lang=lang), table_results, lang=lang)
 
-    zip_file_path = os.path.join(save_folder, filename_base + '.zip')
-    with zipfile.ZipFile(zip_file_path, 'w') as zipf:
-        for file in xlsx_files:
-            zipf.write(file, os.path.basename(file))
+@router.post('/predict-batch-by-url', summary="Table recognition of many image URLs")
+async def predict_batch_by_url(url: List[str] = Query(...), lang: Optional[str] = None):
+    """
+    Download the images of the `url` parameters concurrently and stream one NDJSON line with the tables
+    of each image as soon as they are recognized, a URL that cannot be downloaded only gives an error line.
+    """
+    lang = resolve_language(lang)
+    items = await read_batch_urls(url)
+    return batch_response('table', items, partial(table_chunk, lang=lang), table_results, lang=lang)
 
-    response = FileResponse(
-            zip_file_path, 
-            media_type="application/zip",
-            headers={'Content-Disposition': f'attachment; filename={filename_base}.zip'},
-            status_code=status.HTTP_200_OK
-        )
-    background_tasks.add_task(clear_temp_folder, './temp')
-    return response
+@router.post('/predict-document', summary="Table recognition of every page of an uploaded PDF or TIFF document")
+async def predict_document(file: UploadFile, output: Literal['ndjson', 'xlsx'] = 'ndjson', artifact: bool = False,
+                           lang: Optional[str] = None, workspace: str = Depends(request_workspace)):
+    """
+    Stream the tables of each page as NDJSON, or return one .xlsx with a sheet per table.
+    The NDJSON stream only ends with the .xlsx when `artifact` is set.
+    """
+    lang = resolve_language(lang)
+    document = await spool_document(file, workspace)
+    filename_base = os.path.basename(file.filename).split('.')[0]
+    return await document_response(document, table_document_pipeline, output, filename_base, lang, artifact)
 
 # @router.get("/xlsx-preview", summary="Returns an XLSX file")
 # async def xlsx_preview(filename: str):
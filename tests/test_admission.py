@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException
+
+import utils.Admission as Admission
+from utils.Admission import AdmissionController, AdmissionMiddleware, RateLimiter
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_bulk_lane_capped_at_its_share():
+    async def scenario():
+        controller = AdmissionController(budget=10, bulk_share=0.5, small_cost=2, timeout=0.05)
+        first = await controller.acquire(5)
+        assert first.lane == 'bulk'
+        # The bulk share is used up, the rest of the budget is kept for small requests
+        with pytest.raises(HTTPException) as raised:
+            await controller.acquire(3)
+        assert raised.value.status_code == 503
+        small = await controller.acquire(2)
+        assert small.lane == 'interactive'
+        controller.release(first)
+        controller.release(small)
+        return controller.stats()['lanes']['bulk']
+
+    lane = _run(scenario())
+    assert lane['rejected']['timeout'] == 1
+    assert lane['in_flight_cost'] == 0
+
+
+def test_larger_than_budget_admitted_alone():
+    async def scenario():
+        controller = AdmissionController(budget=10, bulk_share=0.5, small_cost=2)
+        grant = await controller.acquire(50)
+        return grant.cost
+
+    assert _run(scenario()) == 5
+
+
+def test_interactive_lane_overtakes_bulk():
+    async def scenario():
+        controller = AdmissionController(budget=10, bulk_share=1, small_cost=2)
+        holding = await controller.acquire(9)
+        order = []
+
+        async def request(name, cost):
+            grant = await controller.acquire(cost)
+            order.append(name)
+            return grant
+
+        bulk = asyncio.ensure_future(request('bulk', 9))
+        await asyncio.sleep(0)
+        small = asyncio.ensure_future(request('small', 2))
+        await asyncio.sleep(0)
+        assert order == []
+        controller.release(holding)
+        small_grant = await small
+        assert order == ['small']
+        # The bulk request does not fit next to the small one, it waits for it
+        await asyncio.sleep(0)
+        assert not bulk.done()
+        controller.release(small_grant)
+        controller.release(await bulk)
+        return order
+
+    assert _run(scenario()) == ['small', 'bulk']
+
+
+def test_full_queue_rejected_right_away():
+    async def scenario():
+        controller = AdmissionController(budget=10, bulk_share=1, small_cost=2, queue_size=1, timeout=5)
+        await controller.acquire(10)
+        waiting = asyncio.ensure_future(controller.acquire(1))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as raised:
+            await controller.acquire(1)
+        # A request going away leaves the queue
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        return raised.value, controller.stats()['lanes']['interactive']
+
+    exc, lane = _run(scenario())
+    assert exc.status_code == 503
+    assert exc.headers['Retry-After'] == str(Admission.ADMISSION_RETRY_AFTER)
+    assert lane['rejected']['queue_full'] == 1
+    assert lane['waiting'] == 0
+
+
+def test_timeout_rejected_and_withdrawn():
+    async def scenario():
+        controller = AdmissionController(budget=10, bulk_share=1, small_cost=2, timeout=0.05)
+        holding = await controller.acquire(10)
+        with pytest.raises(HTTPException) as raised:
+            await controller.acquire(1)
+        stats = controller.stats()['lanes']['interactive']
+        # The budget freed later goes to nobody, the timed out request withdrew
+        controller.release(holding)
+        await controller.acquire(10)
+        return raised.value, stats
+
+    exc, lane = _run(scenario())
+    assert exc.status_code == 503
+    assert 'Retry-After' in exc.headers
+    assert lane['rejected']['timeout'] == 1
+    assert lane['waiting'] == 0
+
+
+def test_wait_ignores_queue_size_and_timeout():
+    async def scenario():
+        controller = AdmissionController(budget=10, bulk_share=1, small_cost=2, queue_size=0, timeout=0.01)
+        holding = await controller.acquire(10)
+        waiting = asyncio.ensure_future(controller.acquire(1, wait=True))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        controller.release(holding)
+        return await waiting
+
+    assert _run(scenario()).lane == 'interactive'
+
+
+def test_rate_limiter_refill_and_retry_after(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(Admission.time, 'monotonic', lambda: now[0])
+    limiter = RateLimiter(rate=2, burst=3)
+    assert [limiter.take('a') for _ in range(3)] == [0, 0, 0]
+    # The bucket is empty, a token comes back after 1 / rate seconds
+    assert limiter.take('a') == pytest.approx(0.5)
+    assert limiter.take('b') == 0
+    now[0] += 0.25
+    assert limiter.take('a') == pytest.approx(0.25)
+    now[0] += 0.25
+    assert limiter.take('a') == 0
+    # Never refilled beyond the burst
+    now[0] += 60
+    assert [limiter.take('a') for _ in range(4)][-1] == pytest.approx(0.5)
+    assert limiter.stats()['limited'] == 3
+
+
+def test_rate_limiter_forgets_least_recent_clients():
+    limiter = RateLimiter(rate=1, burst=1, max_clients=2)
+    for client in ('a', 'b', 'c'):
+        limiter.take(client)
+    assert limiter.stats()['clients'] == 2
+    # 'a' was forgotten, it starts again with a full bucket
+    assert limiter.take('a') == 0
+
+
+def test_middleware_limits_inference_routes_only(monkeypatch):
+    monkeypatch.setattr(Admission, 'rate_limiter', RateLimiter(rate=0.5, burst=1))
+    app = FastAPI()
+    workloads = []
+
+    @app.get('/ocr/predict')
+    def predict():
+        workloads.append(Admission.request_workload.get())
+        return {}
+
+    @app.get('/system/ready')
+    def ready():
+        return {}
+
+    app.add_middleware(AdmissionMiddleware)
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+            return [await client.get(path, headers=headers) for path, headers in (
+                ('/ocr/predict', {}), ('/ocr/predict', {}), ('/ocr/predict', {'X-API-Key': 'k'}),
+                ('/system/ready', {}), ('/system/ready', {}))]
+
+    responses = _run(scenario())
+    assert [response.status_code for response in responses] == [200, 429, 200, 200, 200]
+    assert responses[1].headers['Retry-After'] == '2'
+    assert workloads == ['ocr', 'ocr']
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+import utils.BatchInference as BatchInference
+from utils.BatchInference import _ocr_batch
+
+
+@pytest.fixture(scope='module')
+def ocr():
+    from utils.ModelRegistry import get_model
+
+    try:
+        return get_model('ocr')
+    except Exception as exc:
+        pytest.skip(f'PaddleOCR models are not available: {exc}')
+
+
+def _page(upside_down=False):
+    page = np.full((240, 640, 3), 255, dtype=np.uint8)
+    for row, line in enumerate(('Invoice 2024-0117', 'Total amount 1,250.00', 'Paid by transfer')):
+        cv2.putText(page, line, (20, 60 + row * 70), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 0), 2)
+    return cv2.rotate(page, cv2.ROTATE_180) if upside_down else page
+
+
+def _encoded(page):
+    return cv2.imencode('.png', page)[1].tobytes()
+
+
+@pytest.mark.parametrize('cls', [True, False])
+@pytest.mark.parametrize('upside_down', [False, True])
+def test_batch_of_one_matches_ocr(ocr, cls, upside_down):
+    page = _page(upside_down)
+    expected = ocr.ocr(page, cls=cls)
+    for image in (page, _encoded(page)):
+        result = _ocr_batch(None, [(image, cls)])[0]
+        assert len(result) == len(expected) == 1
+        assert (result[0] is None) == (expected[0] is None)
+        for (box, (text, score)), (expected_box, (expected_text, expected_score)) in zip(result[0] or [],
+                                                                                          expected[0] or []):
+            assert text == expected_text
+            assert score == pytest.approx(expected_score, abs=1e-5)
+            np.testing.assert_allclose(box, expected_box)
+
+
+def test_batch_keeps_each_image_apart(ocr):
+    pages = [_page(), np.full((120, 320, 3), 255, dtype=np.uint8)]
+    results = _ocr_batch(None, [(page, True) for page in pages])
+    assert [text for _, (text, _) in results[0][0]] == [text for _, (text, _) in ocr.ocr(pages[0])[0]]
+    assert results[1] == [None]
+
+
+def _stub_engine():
+    """A PaddleOCR whose models are replaced by deterministic stubs, PaddleOCR.ocr itself is the real one"""
+    from paddleocr import PaddleOCR
+
+    def detector(image):
+        # Out of reading order, sorted_boxes has to put them back
+        boxes = [[[20, 130], [300, 130], [300, 170], [20, 170]], [[20, 30], [300, 30], [300, 70], [20, 70]],
+                 [[320, 30], [600, 30], [600, 70], [320, 70]]]
+        return np.array(boxes, dtype=np.float32), 0.0
+
+    def classifier(crops):
+        return [crop[::-1, ::-1] for crop in crops], [['180', 0.9]] * len(crops), 0.0
+
+    def recognizer(crops):
+        # The score depends on the pixels, light crops fall below drop_score
+        return [(f'line{i}', 1.0 - float(crop.mean()) / 255) for i, crop in enumerate(crops)], 0.0
+
+    engine = PaddleOCR.__new__(PaddleOCR)
+    engine.args = SimpleNamespace(det_box_type='quad', save_crop_res=False)
+    engine.text_detector, engine.text_classifier, engine.text_recognizer = detector, classifier, recognizer
+    engine.use_angle_cls = True
+    engine.drop_score = 0.5
+    engine.page_num = 0
+    return engine
+
+
+@pytest.mark.parametrize('cls', [True, False])
+def test_batch_follows_ocr_steps(monkeypatch, cls):
+    engine = _stub_engine()
+
+    @contextmanager
+    def acquire_model(name, lang=None):
+        yield engine
+
+    monkeypatch.setattr(BatchInference, 'acquire_model', acquire_model)
+    page = np.full((200, 640, 4), 255, dtype=np.uint8)
+    page[30:70, 20:300] = (0, 0, 0, 255)
+    # Transparent, laid on white by PaddleOCR.ocr: a decoder dropping the alpha channel would read it black
+    page[30:70, 320:600] = (0, 0, 0, 0)
+    page[130:170, 20:300, :3] = 60
+    expected = engine.ocr(_encoded(page), cls=cls)
+    result = _ocr_batch(None, [(_encoded(page), cls)])[0]
+    assert result == expected
+    assert [text for _, (text, _) in result[0]] == ['line0', 'line2']
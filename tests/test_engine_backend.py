@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+from types import SimpleNamespace
+
+import pytest
+
+import utils.EngineBackend as EngineBackend
+from utils.EngineBackend import build_engine
+
+onnx = pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+pytest.importorskip('paddleocr')
+
+
+@pytest.fixture
+def utility(monkeypatch):
+    """PaddleOCR's predictor factory, replaced by a stub standing for the Paddle predictors"""
+    import paddleocr  # noqa: F401
+    from tools.infer import utility
+
+    def paddle_predictor(args, mode, paddle_logger):
+        return SimpleNamespace(mode=mode), None, None, None
+
+    monkeypatch.setattr(utility, 'create_predictor', paddle_predictor)
+    return utility
+
+
+@pytest.fixture
+def exported(tmp_path):
+    """Model directory holding a model.onnx export"""
+    x = onnx.helper.make_tensor_value_info('x', onnx.TensorProto.FLOAT, [1])
+    y = onnx.helper.make_tensor_value_info('y', onnx.TensorProto.FLOAT, [1])
+    graph = onnx.helper.make_graph([onnx.helper.make_node('Identity', ['x'], ['y'])], 'identity', [x], [y])
+    model = onnx.helper.make_model(graph, opset_imports=[onnx.helper.make_opsetid('', 13)])
+    model.ir_version = 8
+    onnx.save(model, str(tmp_path / 'model.onnx'))
+    return str(tmp_path)
+
+
+class _Engine:
+    """Builds its predictors through PaddleOCR's factory, as PaddleOCR and PPStructure do"""
+
+    def __init__(self, det_model_dir, rec_model_dir, fail=False):
+        from tools.infer import utility
+
+        args = SimpleNamespace(det_model_dir=det_model_dir, rec_model_dir=rec_model_dir)
+        self.text_detector = SimpleNamespace(use_onnx=False)
+        self.text_detector.predictor = utility.create_predictor(args, 'det', None)[0]
+        if fail:
+            raise RuntimeError('model download failed')
+        self.text_recognizer = SimpleNamespace(use_onnx=False)
+        self.text_recognizer.predictor = utility.create_predictor(args, 'rec', None)[0]
+
+
+def test_paddle_backend(monkeypatch, utility, exported):
+    monkeypatch.setattr(EngineBackend, 'ENGINE_BACKEND', 'paddle')
+    paddle_predictor = utility.create_predictor
+    engine = build_engine(_Engine, det_model_dir=exported, rec_model_dir=exported)
+    # The exports are ignored, every predictor comes from Paddle
+    assert engine.text_detector.predictor.mode == 'det'
+    assert engine.text_recognizer.predictor.mode == 'rec'
+    assert not engine.text_detector.use_onnx
+    assert utility.create_predictor is paddle_predictor
+
+
+def test_onnx_backend_confined_to_build_engine(monkeypatch, utility, exported, tmp_path_factory):
+    import onnxruntime as ort
+
+    monkeypatch.setattr(EngineBackend, 'ENGINE_BACKEND', 'onnx')
+    paddle_predictor = utility.create_predictor
+    not_exported = str(tmp_path_factory.mktemp('rec'))
+    engine = build_engine(_Engine, det_model_dir=exported, rec_model_dir=not_exported)
+    assert isinstance(engine.text_detector.predictor, ort.InferenceSession)
+    assert engine.text_detector.use_onnx
+    # Models without an export stay on Paddle
+    assert engine.text_recognizer.predictor.mode == 'rec'
+    assert not engine.text_recognizer.use_onnx
+
+    # Engines built outside of build_engine keep their Paddle predictors
+    assert utility.create_predictor is paddle_predictor
+    outside = _Engine(det_model_dir=exported, rec_model_dir=exported)
+    assert outside.text_detector.predictor.mode == 'det'
+
+
+def test_factory_restored_when_the_build_fails(monkeypatch, utility, exported):
+    monkeypatch.setattr(EngineBackend, 'ENGINE_BACKEND', 'onnx')
+    paddle_predictor = utility.create_predictor
+    with pytest.raises(RuntimeError):
+        build_engine(_Engine, det_model_dir=exported, rec_model_dir=exported, fail=True)
+    assert utility.create_predictor is paddle_predictor
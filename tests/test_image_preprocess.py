@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import io
+
+import numpy as np
+from PIL import Image
+
+from utils.ImagePreprocess import decode_image, image_size
+
+# EXIF tag of the orientation, 6 means the stored pixels are to be rotated 90 degrees clockwise
+_ORIENTATION = 0x0112
+
+
+def _jpeg(width, height, orientation=None):
+    image = Image.fromarray(np.full((height, width, 3), 255, dtype=np.uint8))
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[_ORIENTATION] = orientation
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+def test_decode_image_scale():
+    img, scale = decode_image(_jpeg(6000, 3000), max_side=4000)
+    assert img.shape[:2] == (2000, 4000)
+    assert scale == 1.5
+
+
+def test_decode_image_scale_of_exif_rotated_jpeg():
+    data = _jpeg(6000, 3000, orientation=6)
+    # The header holds the stored size, before the rotation
+    assert tuple(image_size(data)) == (6000, 3000)
+    img, scale = decode_image(data, max_side=4000)
+    assert img.shape[:2] == (4000, 2000)
+    assert scale == 1.5
+
+
+def test_decode_image_small_image_is_not_scaled():
+    img, scale = decode_image(_jpeg(800, 600, orientation=6), max_side=4000)
+    assert img.shape[:2] == (800, 600)
+    assert scale == 1.0
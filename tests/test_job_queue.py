@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import utils.JobQueue as JobQueueModule
+from utils.JobQueue import CANCELLED, FAILED, QUEUED, RUNNING, SUCCEEDED, JobQueue
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(JobQueueModule.time, 'time', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def queue(tmp_path, clock):
+    return JobQueue(str(tmp_path), max_attempts=2, lease_seconds=60, ttl=3600, retry_delay=10)
+
+
+def _submit(queue, pages=3):
+    job_id, _ = queue.create_dir()
+    return queue.submit(job_id, 'ocr', 'scan.pdf', SimpleNamespace(kind='pdf', pages=pages))['id']
+
+
+def test_claim_in_submission_order(queue, clock):
+    first = _submit(queue)
+    clock[0] += 1
+    second = _submit(queue)
+    assert queue.claim('w1')['id'] == first
+    job = queue.claim('w2')
+    assert (job['id'], job['status'], job['worker'], job['attempts']) == (second, RUNNING, 'w2', 1)
+    assert queue.claim('w3') is None
+
+
+def test_progress_renews_the_lease(queue, clock):
+    _submit(queue)
+    job = queue.claim('w1')
+    clock[0] += 50
+    assert queue.progress(job, 1)
+    clock[0] += 50
+    # Within the renewed lease, nobody takes the job over
+    assert queue.claim('w2') is None
+    assert queue.get(job['id'])['pages_done'] == 1
+
+
+def test_expired_lease_taken_over_and_stale_worker_fenced(queue, clock):
+    job_id = _submit(queue)
+    stale = queue.claim('w1')
+    clock[0] += 61
+    current = queue.claim('w2')
+    assert (current['id'], current['worker'], current['attempts'], current['pages_done']) == (job_id, 'w2', 2, 0)
+
+    # The first worker comes back: its writes are rejected and it is told to stop
+    assert not queue.progress(stale, 3)
+    queue.succeed(stale, 'stale.docx')
+    queue.fail(stale, 'stale error')
+    job = queue.get(job_id)
+    assert (job['status'], job['worker'], job['pages_done'], job['artifact'], job['error']) == \
+        (RUNNING, 'w2', 0, None, None)
+
+    assert queue.progress(current, 3)
+    queue.succeed(current, 'result.docx')
+    job = queue.get(job_id)
+    assert (job['status'], job['artifact'], job['finished_at']) == (SUCCEEDED, 'result.docx', clock[0])
+
+
+def test_failed_attempt_retried_after_a_delay(queue, clock):
+    job_id = _submit(queue)
+    queue.fail(queue.claim('w1'), 'engine crashed')
+    job = queue.get(job_id)
+    assert (job['status'], job['error'], job['available_at']) == (QUEUED, 'engine crashed', clock[0] + 10)
+    assert queue.claim('w1') is None
+    clock[0] += 10
+    assert queue.claim('w1')['attempts'] == 2
+
+
+def test_out_of_attempts_failed(queue, clock):
+    job_id = _submit(queue)
+    queue.claim('w1')
+    clock[0] += 61
+    last = queue.claim('w2')
+    assert last['attempts'] == 2
+    queue.fail(last, 'engine crashed')
+    job = queue.get(job_id)
+    assert (job['status'], job['error']) == (FAILED, 'engine crashed')
+
+
+def test_dead_worker_out_of_attempts_failed(queue, clock):
+    job_id = _submit(queue)
+    queue.claim('w1')
+    clock[0] += 61
+    queue.claim('w2')
+    clock[0] += 61
+    # Its last worker died too, the job is not handed out a third time
+    assert queue.claim('w3') is None
+    job = queue.get(job_id)
+    assert (job['status'], job['error']) == (FAILED, 'Worker stopped responding')
+
+
+def test_cancel_queued_job(queue):
+    job_id = _submit(queue)
+    assert queue.cancel(job_id)['status'] == CANCELLED
+    assert queue.claim('w1') is None
+    assert queue.cancel('missing') is None
+
+
+def test_cancel_running_job(queue, clock):
+    job_id = _submit(queue)
+    job = queue.claim('w1')
+    cancelled = queue.cancel(job_id)
+    assert (cancelled['status'], cancelled['cancel_requested']) == (RUNNING, 1)
+    # The worker learns it with its next progress report and stops
+    assert not queue.progress(job, 1)
+    queue.cancelled(job)
+    assert queue.get(job_id)['status'] == CANCELLED
+
+
+def test_cancel_running_job_of_dead_worker(queue, clock):
+    job_id = _submit(queue)
+    queue.claim('w1')
+    queue.cancel(job_id)
+    clock[0] += 61
+    assert queue.claim('w2') is None
+    assert queue.get(job_id)['status'] == CANCELLED
+
+
+def test_job_asked_to_cancel_not_retried(queue):
+    job_id = _submit(queue)
+    job = queue.claim('w1')
+    queue.cancel(job_id)
+    queue.fail(job, 'interrupted')
+    assert queue.get(job_id)['status'] == FAILED
+
+
+def test_purge_expired_finished_jobs(queue, clock):
+    finished = _submit(queue)
+    queue.succeed(queue.claim('w1'), 'result.docx')
+    running = _submit(queue)
+    queue.claim('w1')
+    clock[0] += 3599
+    assert queue.purge() == 0
+    clock[0] += 2
+    assert queue.purge() == 1
+    assert queue.get(finished) is None
+    assert not os.path.exists(queue.job_dir(finished))
+    assert queue.get(running)['status'] == RUNNING
+    assert os.path.isdir(queue.job_dir(running))
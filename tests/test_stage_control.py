@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+from utils.StageControl import StageOptions, layout_stage_options, options_cache_name
+
+
+def test_cls_dropped_for_ppstructure_strategies():
+    options = layout_stage_options(StageOptions(cls=True, table=True), 'skip')
+    assert options == StageOptions(table=True)
+    assert options_cache_name('layout', options) == 'layout-table=1'
+    assert layout_stage_options(StageOptions(cls=False), 'gate').cls is None
+
+
+def test_cls_kept_where_it_applies():
+    assert layout_stage_options(StageOptions(cls=True), 'regions').cls is True
+    assert layout_stage_options(StageOptions(cls=False, table=False), 'skip').cls is False
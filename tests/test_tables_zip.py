@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import io
+import zipfile
+
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+
+import routers.table
+import utils.Admission as Admission
+from utils.Admission import AdmissionController
+from utils.ResultCache import result_cache
+
+
+def _png():
+    buffer = io.BytesIO()
+    Image.new('RGB', (100, 100), 'white').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    monkeypatch.setattr(result_cache, 'enabled', False)
+
+
+def _zip_response(monkeypatch, table_recognition, before=None):
+    monkeypatch.setattr(routers.table, 'table_recognition', table_recognition)
+
+    async def respond():
+        if before is not None:
+            await before()
+        response = await routers.table.tables_zip_response(_png(), None, 'page')
+        return b''.join([chunk async for chunk in response.body_iterator])
+
+    return asyncio.run(respond())
+
+
+def test_rejected_before_start(monkeypatch):
+    controller = AdmissionController(budget=1, queue_size=0)
+    monkeypatch.setattr(Admission, 'admission', controller)
+
+    def table_recognition(file_data, lang=None, on_table=None):
+        raise AssertionError('a rejected request is not recognized')
+
+    async def use_whole_budget():
+        await controller.acquire(1)
+
+    with pytest.raises(HTTPException) as raised:
+        _zip_response(monkeypatch, table_recognition, use_whole_budget)
+    assert raised.value.status_code == 503
+    assert 'Retry-After' in raised.value.headers
+
+
+def test_no_table(monkeypatch):
+    with pytest.raises(HTTPException) as raised:
+        _zip_response(monkeypatch, lambda file_data, lang=None, on_table=None: [])
+    assert raised.value.status_code == 404
+
+
+def test_failed_recognition(monkeypatch):
+    def table_recognition(file_data, lang=None, on_table=None):
+        raise HTTPException(status_code=400, detail="Unable to decode the image")
+
+    with pytest.raises(HTTPException) as raised:
+        _zip_response(monkeypatch, table_recognition)
+    assert raised.value.status_code == 400
+
+
+def test_tables_streamed_as_recognized(monkeypatch):
+    def table_recognition(file_data, lang=None, on_table=None):
+        tables = [{'xlsx': b'first', 'html': ''}, None, {'xlsx': b'third', 'html': ''}]
+        for i, table in enumerate(tables):
+            on_table(i, table)
+        return tables
+
+    with zipfile.ZipFile(io.BytesIO(_zip_response(monkeypatch, table_recognition))) as archive:
+        assert archive.namelist() == ['page_table_1.xlsx', 'page_table_3.xlsx']
+        assert archive.read('page_table_3.xlsx') == b'third'
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from utils.UrlFetcher import UrlFetcher
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\0' * 64
+
+
+def _fetch(handler, url='http://stub/page.png', **kwargs):
+    fetcher = UrlFetcher(transport=httpx.MockTransport(handler), **kwargs)
+
+    async def fetch():
+        try:
+            return await fetcher.fetch(url)
+        finally:
+            await fetcher.aclose()
+
+    return asyncio.run(fetch())
+
+
+def _status(handler, **kwargs):
+    with pytest.raises(HTTPException) as raised:
+        _fetch(handler, **kwargs)
+    return raised.value.status_code
+
+
+def test_fetch_image():
+    fetched = _fetch(lambda request: httpx.Response(200, content=PNG))
+    assert fetched.content == PNG
+    assert fetched.kind == 'image'
+    assert fetched.filename == 'page.png'
+
+
+def test_declared_length_above_limit():
+    assert _status(lambda request: httpx.Response(200, content=PNG), max_bytes=16) == 413
+
+
+def test_streamed_body_above_limit():
+    async def body():
+        for chunk in (PNG[:8], b'\0' * 32, b'\0' * 32):
+            yield chunk
+
+    def handler(request):
+        # No Content-Length, the limit is enforced while the body streams in
+        return httpx.Response(200, content=body())
+
+    assert _status(handler, max_bytes=40) == 413
+
+
+def test_timeout():
+    def handler(request):
+        raise httpx.ReadTimeout('stub timed out', request=request)
+
+    assert _status(handler) == 504
+
+
+def test_not_an_image():
+    assert _status(lambda request: httpx.Response(200, content=b'<html>not an image</html>')) == 400
+
+
+def test_error_status():
+    assert _status(lambda request: httpx.Response(404)) == 400
+
+
+def test_unsupported_scheme():
+    assert _status(lambda request: httpx.Response(200, content=PNG), url='ftp://stub/page.png') == 400
+
+
+def test_fetch_many_bounds_concurrency_and_keeps_errors_in_place():
+    active = 0
+    peak = 0
+
+    async def handler(request):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        if request.url.path == '/missing.png':
+            return httpx.Response(404)
+        return httpx.Response(200, content=PNG)
+
+    urls = [f'http://stub/{i}.png' for i in range(8)]
+    urls[3] = 'http://stub/missing.png'
+    urls[5] = 'ftp://stub/5.png'
+    fetcher = UrlFetcher(transport=httpx.MockTransport(handler), concurrency=3)
+
+    async def fetch_many():
+        try:
+            return await fetcher.fetch_many(urls)
+        finally:
+            await fetcher.aclose()
+
+    results = asyncio.run(fetch_many())
+    assert peak == 3
+    statuses = [getattr(result, 'status_code', None) for result in results]
+    assert statuses == [None, None, None, 400, None, 400, None, None]
+    assert [result.url for result in results if not isinstance(result, HTTPException)] == \
+        [url for i, url in enumerate(urls) if i not in (3, 5)]
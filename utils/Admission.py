@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import contextvars
+import math
+import os
+import time
+from collections import OrderedDict, deque, namedtuple
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse
+
+from utils.ImagePreprocess import MAX_IMAGE_SIDE, image_size
+from utils.InferenceExecutor import inference_priority
+from utils.Metrics import (ADMISSION_ADMITTED, ADMISSION_IN_FLIGHT, ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS,
+                           RATE_LIMITED)
+
+# Cost of the requests processed at the same time by a process, 0 disables admission control. A request
+# costs the megapixels of its working image times the weight of its endpoint
+ADMISSION_BUDGET = float(os.environ.get("ADMISSION_BUDGET", "64"))
+# Share of the budget the bulk lane may use, the rest is kept for small requests
+ADMISSION_BULK_SHARE = float(os.environ.get("ADMISSION_BULK_SHARE", "0.75"))
+# Cost up to which a request goes to the interactive lane, larger ones go to the bulk lane
+ADMISSION_SMALL_COST = float(os.environ.get("ADMISSION_SMALL_COST", "4"))
+# Requests waiting for budget per lane beyond which new ones are rejected with a 503
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "32"))
+# Seconds a request waits for budget before it is rejected with a 503
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "10"))
+# Seconds suggested to rejected clients through the Retry-After header
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", "2"))
+# Weight of each endpoint, a layout analysis runs several models on the page
+ADMISSION_WEIGHTS = {name.strip(): float(weight) for name, weight in (
+    item.split('=') for item in os.environ.get("ADMISSION_WEIGHTS", "ocr=1,table=2,layout=3").split(',') if item)}
+# Sustained requests per second allowed per client, an API key or else an IP, 0 disables rate limiting
+RATE_LIMIT_RPS = float(os.environ.get("RATE_LIMIT_RPS", "0"))
+# Requests a client may send at once before being held to RATE_LIMIT_RPS
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", "20"))
+# Identify clients by the first address of X-Forwarded-For, only behind a proxy that sets it
+RATE_LIMIT_TRUST_PROXY = os.environ.get("RATE_LIMIT_TRUST_PROXY", "false").lower() in ("1", "true", "yes")
+
+# Header identifying a client across addresses
+API_KEY_HEADER = b'x-api-key'
+# Routes subject to rate limiting, the probes and stats of /system are not
+RATE_LIMITED_PREFIXES = ('/ocr/', '/layout/', '/table/', '/jobs')
+# Lanes in the order their waiting requests are granted budget
+LANES = ('interactive', 'bulk')
+# Most clients whose bucket is kept, the least recently seen are forgotten first
+_MAX_CLIENTS = 10000
+
+# Endpoint of the request being served, whose weight is applied to its cost, set by AdmissionMiddleware
+request_workload = contextvars.ContextVar('request_workload', default=None)
+
+AdmissionGrant = namedtuple('AdmissionGrant', ['lane', 'cost'])
+
+
+def pixels_cost(width, height, workload=None):
+    """Cost of processing a width x height image for `workload`, the endpoint of the request by default
+
+    Images are downscaled to MAX_IMAGE_SIDE before inference, so larger ones cost no more than that.
+    """
+    if MAX_IMAGE_SIDE > 0 and max(width, height) > MAX_IMAGE_SIDE:
+        scale = MAX_IMAGE_SIDE / max(width, height)
+        width, height = width * scale, height * scale
+    weight = ADMISSION_WEIGHTS.get(workload or request_workload.get(), 1.0)
+    return width * height / 1e6 * weight
+
+
+def image_cost(data, workload=None):
+    """Cost of an encoded image, read from its header. Images of unknown size cost as much as the largest"""
+    size = image_size(data)
+    if size is None:
+        side = MAX_IMAGE_SIDE if MAX_IMAGE_SIDE > 0 else 4000
+        size = (side, side)
+    return pixels_cost(size[0], size[1], workload)
+
+
+def _capacity_exception(detail):
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail=detail,
+        headers={'Retry-After': str(ADMISSION_RETRY_AFTER)}
+    )
+
+
+class AdmissionController:
+    """Admits requests against a compute budget, in two priority lanes.
+
+    A request holds its cost (see pixels_cost) of the budget while it is
+    processed. One that does not fit waits in the FIFO queue of its lane:
+    `interactive` for requests costing up to `small_cost`, `bulk` for the
+    others, which together hold at most `bulk_share` of the budget. Freed
+    budget goes to the interactive lane first, so a small OCR call never
+    waits behind large layout jobs. A request is rejected with a 503 and a
+    Retry-After when its lane already has `queue_size` waiting requests, or
+    after waiting `timeout` seconds, instead of piling up behind the work
+    the process cannot catch up with.
+
+    The admitted lane also sets the `inference_priority` of the request's
+    inference jobs. Everything runs on the event loop, no lock is needed.
+    """
+
+    def __init__(self, budget=ADMISSION_BUDGET, bulk_share=ADMISSION_BULK_SHARE, small_cost=ADMISSION_SMALL_COST,
+                 queue_size=ADMISSION_QUEUE_SIZE, timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.enabled = budget > 0
+        self.budget = budget
+        self.bulk_budget = budget * min(max(bulk_share, 0.0), 1.0)
+        self.small_cost = small_cost
+        self.queue_size = max(queue_size, 0)
+        self.timeout = timeout
+        self._in_flight = dict.fromkeys(LANES, 0.0)
+        # (cost, future) of the requests waiting for budget
+        self._waiters = {lane: deque() for lane in LANES}
+        self._admitted = dict.fromkeys(LANES, 0)
+        self._rejected = {lane: {'queue_full': 0, 'timeout': 0} for lane in LANES}
+        self._wait_total = dict.fromkeys(LANES, 0.0)
+        self._wait_max = dict.fromkeys(LANES, 0.0)
+
+    def lane(self, cost):
+        return 'interactive' if cost <= self.small_cost else 'bulk'
+
+    def _fits(self, lane, cost):
+        if sum(self._in_flight.values()) + cost > self.budget:
+            return False
+        return lane != 'bulk' or self._in_flight['bulk'] + cost <= self.bulk_budget
+
+    def _queued_ahead(self, lane):
+        """Whether requests of `lane` or of a lane before it are waiting"""
+        return any(self._waiters[other] for other in LANES[:LANES.index(lane) + 1])
+
+    def _grant(self, lane, cost):
+        self._in_flight[lane] += cost
+        ADMISSION_IN_FLIGHT.labels(lane).inc(cost)
+
+    def _reject(self, lane, reason, detail):
+        self._rejected[lane][reason] += 1
+        ADMISSION_REJECTED.labels(lane, reason).inc()
+        return _capacity_exception(detail)
+
+    async def acquire(self, cost, wait=False):
+        """Take `cost` of the budget, waiting for it to be freed if needed
+
+        Args:
+            cost (float): cost of the request
+            wait (bool): wait as long as needed, for the parts of work already accepted
+                such as the pages of a document
+
+        Returns:
+            AdmissionGrant: to hand back to release()
+
+        Raises:
+            HTTPException: 503 when the lane queue is full or the wait times out
+        """
+        lane = self.lane(cost)
+        # Larger requests are admitted alone, they would never fit otherwise
+        cost = min(cost, self.bulk_budget if lane == 'bulk' else self.budget)
+        start = time.perf_counter()
+        waiters = self._waiters[lane]
+        if not self._queued_ahead(lane) and self._fits(lane, cost):
+            self._grant(lane, cost)
+        else:
+            if not wait and len(waiters) >= self.queue_size:
+                raise self._reject(lane, 'queue_full', "Server is at capacity, please retry later")
+            future = asyncio.get_running_loop().create_future()
+            waiters.append((cost, future))
+            try:
+                await asyncio.wait_for(future, None if wait else self.timeout)
+            except BaseException as exc:
+                timed_out = isinstance(exc, asyncio.TimeoutError)
+                if future.done() and not future.cancelled():
+                    # Granted as the wait ended, kept unless the request itself is going away
+                    if not timed_out:
+                        self.release(AdmissionGrant(lane, cost))
+                        raise
+                else:
+                    self._withdraw(lane, future)
+                    if timed_out:
+                        raise self._reject(lane, 'timeout', "Timed out waiting for capacity, please retry later")
+                    raise
+        wait_seconds = time.perf_counter() - start
+        self._admitted[lane] += 1
+        self._wait_total[lane] += wait_seconds
+        self._wait_max[lane] = max(self._wait_max[lane], wait_seconds)
+        ADMISSION_ADMITTED.labels(lane).inc()
+        ADMISSION_WAIT_SECONDS.labels(lane).observe(wait_seconds)
+        return AdmissionGrant(lane, cost)
+
+    def release(self, grant):
+        self._in_flight[grant.lane] = max(self._in_flight[grant.lane] - grant.cost, 0.0)
+        ADMISSION_IN_FLIGHT.labels(grant.lane).dec(grant.cost)
+        self._dispatch()
+
+    def _withdraw(self, lane, future):
+        waiters = self._waiters[lane]
+        for i, (_, waiter) in enumerate(waiters):
+            if waiter is future:
+                del waiters[i]
+                break
+        # It may have been holding back the requests behind it
+        self._dispatch()
+
+    def _dispatch(self):
+        for lane in LANES:
+            waiters = self._waiters[lane]
+            while waiters:
+                cost, future = waiters[0]
+                if future.done():
+                    waiters.popleft()
+                    continue
+                if not self._fits(lane, cost):
+                    break
+                waiters.popleft()
+                self._grant(lane, cost)
+                future.set_result(None)
+            if waiters:
+                # Budget left over by a waiting interactive request is not taken by the bulk lane
+                return
+
+    @asynccontextmanager
+    async def admit(self, cost, wait=False):
+        """Hold `cost` of the budget while the block runs, its inference jobs run with the priority of its lane"""
+        if not self.enabled:
+            yield None
+            return
+        grant = await self.acquire(cost, wait)
+        token = inference_priority.set(LANES.index(grant.lane))
+        try:
+            yield grant
+        finally:
+            inference_priority.reset(token)
+            self.release(grant)
+
+    def stats(self):
+        lanes = {}
+        for lane in LANES:
+            admitted = self._admitted[lane]
+            lanes[lane] = {
+                'in_flight_cost': round(self._in_flight[lane], 2),
+                'waiting': len(self._waiters[lane]),
+                'admitted': admitted,
+                'rejected': dict(self._rejected[lane]),
+                'wait_seconds_avg': round(self._wait_total[lane] / admitted, 4) if admitted else 0.0,
+                'wait_seconds_max': round(self._wait_max[lane], 4),
+            }
+        return {
+            'enabled': self.enabled,
+            'budget': self.budget,
+            'bulk_budget': self.bulk_budget,
+            'small_cost': self.small_cost,
+            'queue_size': self.queue_size,
+            'timeout_seconds': self.timeout,
+            'weights': dict(ADMISSION_WEIGHTS),
+            'lanes': lanes,
+        }
+
+
+class RateLimiter:
+    """Token bucket per client: `burst` requests at once, refilled at `rate` per second."""
+
+    def __init__(self, rate=RATE_LIMIT_RPS, burst=RATE_LIMIT_BURST, max_clients=_MAX_CLIENTS):
+        self.enabled = rate > 0
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_clients = max_clients
+        # client -> (tokens, last update), least recently seen first
+        self._buckets = OrderedDict()
+        self._allowed = 0
+        self._limited = 0
+
+    def take(self, client):
+        """Spend a token of `client`, returns 0 when allowed, otherwise the seconds until one is available"""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            delay = 0.0
+            self._allowed += 1
+        else:
+            delay = (1 - tokens) / self.rate
+            self._limited += 1
+        self._buckets[client] = (tokens, now)
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return delay
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'rate': self.rate,
+            'burst': self.burst,
+            'clients': len(self._buckets),
+            'allowed': self._allowed,
+            'limited': self._limited,
+        }
+
+
+admission = AdmissionController()
+rate_limiter = RateLimiter()
+
+
+def admit(cost, wait=False):
+    """Hold `cost` of the process budget while the `async with` block runs, see AdmissionController.admit"""
+    return admission.admit(cost, wait)
+
+
+def client_key(scope):
+    """Rate limiting key of a request: its API key, else its IP address"""
+    headers = dict(scope.get('headers') or [])
+    api_key = headers.get(API_KEY_HEADER)
+    if api_key:
+        return 'key', 'key:' + api_key.decode('latin-1')
+    forwarded = headers.get(b'x-forwarded-for') if RATE_LIMIT_TRUST_PROXY else None
+    if forwarded:
+        return 'ip', 'ip:' + forwarded.decode('latin-1').split(',')[0].strip()
+    client = scope.get('client')
+    return 'ip', 'ip:' + (client[0] if client else 'unknown')
+
+
+class AdmissionMiddleware:
+    """Rejects requests of clients over their rate limit with a 429 and a Retry-After, and
+    tells the admission control which endpoint each request is for.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        path = scope['path']
+        if rate_limiter.enabled and path.startswith(RATE_LIMITED_PREFIXES):
+            kind, client = client_key(scope)
+            delay = rate_limiter.take(client)
+            if delay > 0:
+                RATE_LIMITED.labels(kind).inc()
+                response = JSONResponse(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    content={'detail': "Too many requests, please retry later"},
+                    headers={'Retry-After': str(max(math.ceil(delay), 1))}
+                )
+                await response(scope, receive, send)
+                return
+
+        workload = path.strip('/').split('/')[0]
+        token = request_workload.set(workload if workload in ADMISSION_WEIGHTS else None)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_workload.reset(token)
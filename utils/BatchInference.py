@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import logging
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from utils.ImageHelper import bytes_to_ndarray
+from utils.ImagePreprocess import (DETECTION_MAX_SIDE, OCR_TILE_OVERLAP, OCR_TILE_SIZE, downscale, merge_tiled_lines,
+                                   tile_windows)
+from utils.InferenceExecutor import INFERENCE_WORKERS
+from utils.MicroBatcher import MicroBatcher
+from utils.ModelRegistry import acquire_model
+
+logger = logging.getLogger(__name__)
+
+# Largest number of images sent to the YOLO detector in one call, 1 disables batching
+YOLO_BATCH_SIZE = int(os.environ.get("YOLO_BATCH_SIZE", "8"))
+# Longest time a detection request waits for others to join its batch
+YOLO_BATCH_WAIT_MS = float(os.environ.get("YOLO_BATCH_WAIT_MS", "5"))
+# How the OCR and layout pipelines of URL requests use the YOLO detector: gate only rejects images
+# without text or tables, skip does not run it, regions recognizes the detected regions only
+DETECTION_STRATEGY = os.environ.get("DETECTION_STRATEGY", "gate")
+# Largest number of images whose text lines are recognized in one call, 1 disables batching
+OCR_BATCH_SIZE = int(os.environ.get("OCR_BATCH_SIZE", "8"))
+# Longest time an OCR request waits for others to join its batch
+OCR_BATCH_WAIT_MS = float(os.environ.get("OCR_BATCH_WAIT_MS", "5"))
+
+
+DETECTION_STRATEGIES = ('gate', 'skip', 'regions')
+
+
+def strategy_cache_name(endpoint, strategy):
+    """Result cache namespace of a pipeline run with a detection strategy"""
+    return {'skip': endpoint, 'gate': endpoint + '-detect'}.get(strategy, f'{endpoint}-{strategy}')
+
+
+def _detect_batch(items):
+    """Run YOLO once over several (image, classes) items
+
+    Returns:
+        list: the (xyxy box, class id) pairs of each item, restricted to the classes it asked for
+    """
+    classes = sorted({c for _, wanted in items for c in wanted})
+    with acquire_model('yolo') as model:
+        results = model([image for image, _ in items], classes=classes)
+
+    detections = []
+    for (_, wanted), result in zip(items, results):
+        xyxy = result.boxes.xyxy.tolist()
+        labels = result.boxes.cls.tolist()
+        detections.append([(box, int(label)) for box, label in zip(xyxy, labels) if int(label) in wanted])
+    return detections
+
+
+def _detection_image(image):
+    # YOLO letterboxes its input to 640 px, a full resolution scan only costs memory and resize time
+    if isinstance(image, np.ndarray):
+        return downscale(image, DETECTION_MAX_SIDE)
+    return image, 1.0
+
+
+def _scale_detections(detections, scale):
+    if scale == 1.0:
+        return detections
+    return [([v * scale for v in box], label) for box, label in detections]
+
+
+def _ocr_input(image):
+    """The image PaddleOCR.ocr runs on: decoded as is, gray expanded to BGR and transparency laid on white"""
+    from paddleocr.ppocr.utils.utility import alpha_to_color
+
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = bytes_to_ndarray(image, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        return None
+    if image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    return alpha_to_color(image)
+
+
+def _ocr_batch(lang, items):
+    """Run PaddleOCR over several (image, cls) items
+
+    Text detection runs per image, angle classification and recognition run
+    once over the text lines of every image in the batch. Each image goes
+    through the steps of PaddleOCR.ocr (preprocessing, crops of the engine's
+    box type, drop_score filter), a batch of one gives the same result.
+
+    Returns:
+        list: one result per item, in the format of PaddleOCR.ocr
+    """
+    from paddleocr.tools.infer.predict_system import sorted_boxes
+    from paddleocr.tools.infer.utility import get_minarea_rect_crop, get_rotate_crop_image
+
+    with acquire_model('ocr', lang) as ocr:
+        crop_image = get_rotate_crop_image if ocr.args.det_box_type == 'quad' else get_minarea_rect_crop
+        item_boxes = []
+        crops = []
+        crop_cls = []
+        for image, cls in items:
+            image = _ocr_input(image)
+            dt_boxes = None
+            if image is not None:
+                dt_boxes, _ = ocr.text_detector(image)
+            if dt_boxes is None or len(dt_boxes) == 0:
+                item_boxes.append([])
+                continue
+            dt_boxes = sorted_boxes(dt_boxes)
+            item_boxes.append(dt_boxes)
+            for box in dt_boxes:
+                crops.append(crop_image(image, copy.deepcopy(box)))
+                crop_cls.append(cls)
+
+        if crops:
+            if ocr.use_angle_cls and any(crop_cls):
+                indices = [i for i, cls in enumerate(crop_cls) if cls]
+                rotated, _, _ = ocr.text_classifier([crops[i] for i in indices])
+                for i, crop in zip(indices, rotated):
+                    crops[i] = crop
+            rec_res, _ = ocr.text_recognizer(crops)
+        else:
+            rec_res = []
+
+        drop_score = ocr.drop_score
+
+    results = []
+    offset = 0
+    for dt_boxes in item_boxes:
+        lines = []
+        for box, (text, score) in zip(dt_boxes, rec_res[offset:offset + len(dt_boxes)]):
+            if score >= drop_score:
+                lines.append([np.asarray(box).tolist(), (text, score)])
+        offset += len(dt_boxes)
+        results.append([lines or None])
+    return results
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def _get_batcher(name, lang=None):
+    key = (name, lang)
+    batcher = _batchers.get(key)
+    if batcher is None:
+        with _batchers_lock:
+            batcher = _batchers.get(key)
+            if batcher is None:
+                # The pipelines run on the inference threads, no more callers can join a batch than there
+                # are threads, and with a single one every call runs right away
+                if name == 'yolo':
+                    batcher = MicroBatcher(_detect_batch, YOLO_BATCH_SIZE, YOLO_BATCH_WAIT_MS, name='yolo-batcher',
+                                           max_callers=INFERENCE_WORKERS)
+                else:
+                    batcher = MicroBatcher(lambda items: _ocr_batch(lang, items), OCR_BATCH_SIZE, OCR_BATCH_WAIT_MS,
+                                           name=f'ocr-batcher-{lang or "default"}', max_callers=INFERENCE_WORKERS)
+                _batchers[key] = batcher
+    return batcher
+
+
+def detect_boxes(image, classes):
+    """Detect layout elements with the shared YOLO model, batched with concurrent callers
+
+    Args:
+        image (_type_): image path or BGR ndarray
+        classes (list): YOLO class ids to keep
+
+    Returns:
+        list: xyxy boxes
+    """
+    return [box for box, _ in detect_regions(image, classes)]
+
+
+def detect_regions(image, classes):
+    """Detect layout elements with their class, batched with concurrent callers
+
+    Returns:
+        list: (xyxy box, class id) pairs
+    """
+    small, scale = _detection_image(image)
+    return _scale_detections(_get_batcher('yolo')((small, tuple(classes))), scale)
+
+
+def recognize_text(image, cls=True, lang=None):
+    """Run OCR with the shared PaddleOCR engine, batched with concurrent callers
+
+    Args:
+        image (_type_): encoded image bytes or BGR ndarray
+        cls (bool): run the text angle classifier
+        lang (str, optional): OCR language
+
+    Returns:
+        list: result in the format of PaddleOCR.ocr
+    """
+    return _get_batcher('ocr', lang)((image, cls))
+
+
+def detect_boxes_batch(images, classes):
+    """Detect layout elements in several images with one YOLO call, bypassing the micro-batcher
+
+    Returns:
+        list: xyxy boxes of each image
+    """
+    if not images:
+        return []
+    smalls, scales = zip(*(_detection_image(image) for image in images))
+    detections = _detect_batch([(image, tuple(classes)) for image in smalls])
+    return [[box for box, _ in _scale_detections(found, scale)] for found, scale in zip(detections, scales)]
+
+
+def recognize_text_batch(images, cls=True, lang=None):
+    """Run OCR on several images, recognizing the text lines of all of them together
+
+    Args:
+        images (list): encoded image bytes or BGR ndarrays
+        cls (bool or list): run the text angle classifier, for all images or per image
+        lang (str, optional): OCR language
+
+    Returns:
+        list: one result per image in the format of PaddleOCR.ocr
+    """
+    if not images:
+        return []
+    flags = cls if isinstance(cls, (list, tuple)) else [cls] * len(images)
+    return _ocr_batch(lang, list(zip(images, flags)))
+
+
+def recognize_text_tiled(image, cls=True, lang=None, size=OCR_TILE_SIZE, overlap=OCR_TILE_OVERLAP):
+    """Run OCR on a very large image tile by tile, the tiles of the image recognized together
+
+    Returns:
+        list: result in the format of PaddleOCR.ocr, in image coordinates
+    """
+    h, w = image.shape[:2]
+    windows = tile_windows(w, h, size, overlap)
+    results = recognize_text_batch([image[y1:y2, x1:x2] for x1, y1, x2, y2 in windows], cls=cls, lang=lang)
+    lines = merge_tiled_lines([(window, result[0]) for window, result in zip(windows, results)], w, h)
+    return [lines or None]
+
+
+def log_batching():
+    """Log the micro-batch sizes in effect, YOLO_BATCH_SIZE and OCR_BATCH_SIZE are capped at INFERENCE_WORKERS"""
+    settings = (('YOLO', YOLO_BATCH_SIZE, YOLO_BATCH_WAIT_MS), ('OCR', OCR_BATCH_SIZE, OCR_BATCH_WAIT_MS))
+    for name, size, wait_ms in settings:
+        effective = min(max(size, 1), max(INFERENCE_WORKERS, 1))
+        if effective == 1:
+            logger.info('%s micro-batching disabled, %s_BATCH_SIZE=%d and %s_BATCH_WAIT_MS are ignored with '
+                        'INFERENCE_WORKERS=%d', name, name, size, name, INFERENCE_WORKERS)
+        elif effective < size:
+            logger.info('%s micro-batches hold at most %d images, INFERENCE_WORKERS caps %s_BATCH_SIZE=%d',
+                        name, effective, name, size)
+        else:
+            logger.info('%s micro-batches hold at most %d images, waiting %gms', name, effective, wait_ms)
+
+
+def batcher_stats():
+    return [batcher.stats() for batcher in _batchers.values()]
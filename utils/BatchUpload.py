@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import io
+import logging
+import os
+import posixpath
+import zipfile
+from typing import List
+
+from fastapi import HTTPException, UploadFile, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+
+from utils.Admission import admit, image_cost
+from utils.DocumentHelper import HTTP_413_CONTENT_TOO_LARGE, NDJSON_MEDIA_TYPE, ndjson_line
+from utils.ImagePreprocess import decode_image
+from utils.InferenceExecutor import run_inference_with_retry
+from utils.ResultCache import result_cache
+from utils.Timing import StageTimer
+from utils.UrlFetcher import url_fetcher, url_filename
+
+logger = logging.getLogger(__name__)
+
+# Largest number of images accepted in one batch request, ZIP entries included
+MAX_BATCH_ITEMS = int(os.environ.get("MAX_BATCH_ITEMS", "500"))
+# Largest image accepted in a batch, in bytes
+MAX_BATCH_ITEM_BYTES = int(os.environ.get("MAX_BATCH_ITEM_BYTES", str(20 * 1024 ** 2)))
+# Largest total of the images of a batch in bytes, ZIP entries counted at their extracted size. The images
+# are held until the whole batch is answered
+MAX_BATCH_BYTES = int(os.environ.get("MAX_BATCH_BYTES", str(256 * 1024 ** 2)))
+# Images sent to the engines together in one inference job
+BATCH_CHUNK_SIZE = int(os.environ.get("BATCH_CHUNK_SIZE", "8"))
+# Chunks of one batch request queued for inference at the same time
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "2"))
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def _item_error(detail):
+    return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
+
+
+def _batch_too_large():
+    return HTTPException(
+        status_code=HTTP_413_CONTENT_TOO_LARGE,
+        detail=f"Batches are limited to {MAX_BATCH_BYTES} bytes of images"
+    )
+
+
+def _zip_items(name, data, budget):
+    """Images of a ZIP archive, extracted only while their declared sizes fit in `budget` bytes
+
+    Returns:
+        tuple: (items, bytes extracted)
+
+    Raises:
+        HTTPException: 413 when the images of the archive go over the budget
+    """
+    items = []
+    used = 0
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile:
+        return [(name, _item_error("Unable to read the ZIP archive"))], 0
+    with archive:
+        for info in archive.infolist():
+            entry = info.filename
+            if info.is_dir() or entry.startswith('__MACOSX/') or posixpath.basename(entry).startswith('.'):
+                continue
+            if not entry.lower().endswith(IMAGE_EXTENSIONS):
+                items.append((entry, _item_error("Only .jpg and .png images are processed")))
+            elif info.file_size > MAX_BATCH_ITEM_BYTES:
+                items.append((entry, _item_error(f"Images are limited to {MAX_BATCH_ITEM_BYTES} bytes")))
+            elif used + info.file_size > budget:
+                # Checked before extracting, the archive may be a few KB expanding into gigabytes
+                raise _batch_too_large()
+            else:
+                try:
+                    # Never more than the declared size, zipfile stops there
+                    items.append((entry, archive.read(info)))
+                    used += info.file_size
+                except (zipfile.BadZipFile, NotImplementedError, RuntimeError):
+                    items.append((entry, _item_error("Unable to extract the image from the ZIP archive")))
+    return items, used
+
+
+async def read_batch(files: List[UploadFile]):
+    """Images of a batch request, from the uploaded images and ZIP archives
+
+    Returns:
+        list: (name, bytes) per image, an HTTPException in place of the bytes for items that cannot be processed
+
+    Raises:
+        HTTPException: 400 for an empty batch, 413 above MAX_BATCH_ITEMS or MAX_BATCH_BYTES
+    """
+    items = []
+    total = 0
+    for file in files:
+        with StageTimer('upload').stage('read'):
+            data = await file.read()
+        if data[:4] == b'PK\x03\x04':
+            entries, used = await run_in_threadpool(_zip_items, file.filename, data, MAX_BATCH_BYTES - total)
+            items.extend(entries)
+            total += used
+        elif not file.filename.lower().endswith(IMAGE_EXTENSIONS):
+            items.append((file.filename, _item_error("Only .jpg and .png images and ZIP archives are processed")))
+        elif len(data) > MAX_BATCH_ITEM_BYTES:
+            items.append((file.filename, _item_error(f"Images are limited to {MAX_BATCH_ITEM_BYTES} bytes")))
+        elif total + len(data) > MAX_BATCH_BYTES:
+            raise _batch_too_large()
+        else:
+            items.append((file.filename, data))
+            total += len(data)
+        if len(items) > MAX_BATCH_ITEMS:
+            raise HTTPException(
+                status_code=HTTP_413_CONTENT_TOO_LARGE,
+                detail=f"Batches are limited to {MAX_BATCH_ITEMS} images"
+            )
+
+    if not items:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Please upload at least one image or ZIP archive"
+        )
+    return items
+
+
+async def read_batch_urls(urls: List[str]):
+    """Images of a batch request, downloaded from `urls` URL_PREFETCH_CONCURRENCY at a time
+
+    Returns:
+        list: (filename, bytes) per URL, the HTTPException of the download in place of the bytes when it failed
+
+    Raises:
+        HTTPException: 400 without URLs, 413 above MAX_BATCH_ITEMS or MAX_BATCH_BYTES
+    """
+    if not urls:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Please provide at least one image URL"
+        )
+    if len(urls) > MAX_BATCH_ITEMS:
+        raise HTTPException(
+            status_code=HTTP_413_CONTENT_TOO_LARGE,
+            detail=f"Batches are limited to {MAX_BATCH_ITEMS} images"
+        )
+
+    items = []
+    total = 0
+    for url, fetched in zip(urls, await url_fetcher.fetch_many(urls)):
+        if isinstance(fetched, Exception):
+            items.append((url_filename(url), fetched))
+        elif len(fetched.content) > MAX_BATCH_ITEM_BYTES:
+            items.append((fetched.filename, _item_error(f"Images are limited to {MAX_BATCH_ITEM_BYTES} bytes")))
+        elif total + len(fetched.content) > MAX_BATCH_BYTES:
+            raise _batch_too_large()
+        else:
+            items.append((fetched.filename, fetched.content))
+            total += len(fetched.content)
+    return items
+
+
+def decode_images(datas):
+    """Decode the images of a chunk at their working resolution, see ImagePreprocess.decode_image
+
+    Returns:
+        tuple: (ndarray or HTTPException for those that cannot be decoded, scale back to the original) per image
+    """
+    images, scales = [], []
+    for data in datas:
+        img, scale = decode_image(data)
+        images.append(img if img is not None else _item_error("Unable to decode the image"))
+        scales.append(scale)
+    return images, scales
+
+
+def map_decoded(images, fn):
+    """Call `fn` on the decoded images of a chunk at once, keeping the decoding errors in place
+
+    Args:
+        images (list): ndarray or exception per item
+        fn (callable): takes the list of decoded images, returns one result per image
+    """
+    decoded = [i for i, img in enumerate(images) if not isinstance(img, Exception)]
+    results = list(images)
+    for i, result in zip(decoded, fn([images[i] for i in decoded])):
+        results[i] = result
+    return results
+
+
+def _item_detail(exc):
+    if isinstance(exc, HTTPException):
+        return exc.detail
+    return 'Item could not be processed'
+
+
+def batch_response(endpoint, items, process_chunk, serialize, lang=None):
+    """Run a batch through the engines chunk by chunk and stream one NDJSON line per item
+
+    Cached items are answered first, the others are sent to the engines in
+    chunks of BATCH_CHUNK_SIZE so detection and recognition run on several
+    images per call. Lines come in completion order, each with the index of
+    its item, and a failing item only produces an error line.
+
+    Args:
+        endpoint (str): result cache namespace, shared with the single image endpoints
+        items (list): (name, bytes or exception) per item
+        process_chunk (callable): blocking, takes a list of image bytes and returns a raw result
+            or an exception per image
+        serialize (callable): raw result to a JSON friendly item result
+        lang (str, optional): OCR language of the cache keys
+    """
+
+    def item_line(index, raw):
+        name = items[index][0]
+        if not isinstance(raw, Exception):
+            try:
+                return False, ndjson_line({'type': 'item', 'index': index, 'filename': name, 'result': serialize(raw)})
+            except Exception as exc:
+                logger.warning('Result of batch item %s cannot be serialized', name, exc_info=True)
+                raw = exc
+        return True, ndjson_line({'type': 'error', 'index': index, 'filename': name, 'detail': _item_detail(raw)})
+
+    def lookup():
+        cached, misses = {}, []
+        for index, (_, data) in enumerate(items):
+            if isinstance(data, Exception):
+                cached[index] = data
+                continue
+            key = result_cache.key(endpoint, data, lang) if result_cache.enabled else None
+            raw = result_cache.get(key) if key is not None else None
+            if raw is not None:
+                cached[index] = raw
+            else:
+                misses.append((index, key))
+        return cached, misses
+
+    timer = StageTimer(f'{endpoint}/batch')
+
+    def run_chunk(chunk):
+        try:
+            with timer.stage('chunk'):
+                results = process_chunk([items[index][1] for index, _ in chunk])
+        except Exception as exc:
+            logger.warning('Batch chunk of %d items failed', len(chunk), exc_info=True)
+            results = [exc] * len(chunk)
+        for (_, key), raw in zip(chunk, results):
+            if key is not None and not isinstance(raw, Exception):
+                result_cache.put(key, raw)
+        return [(index, raw) for (index, _), raw in zip(chunk, results)]
+
+    async def stream():
+        cached, misses = await run_in_threadpool(lookup)
+        failed = 0
+        for index, raw in cached.items():
+            error, line = item_line(index, raw)
+            failed += error
+            yield line
+
+        # A large batch only holds a few inference slots at a time, other requests keep being served
+        semaphore = asyncio.Semaphore(max(BATCH_CONCURRENCY, 1))
+
+        async def run(chunk):
+            # The batch is already accepted, its chunks wait for compute budget rather than fail
+            async with semaphore, admit(sum(image_cost(items[index][1]) for index, _ in chunk), wait=True):
+                return await run_inference_with_retry(run_chunk, chunk)
+
+        chunk_size = max(BATCH_CHUNK_SIZE, 1)
+        tasks = [asyncio.ensure_future(run(misses[i:i + chunk_size])) for i in range(0, len(misses), chunk_size)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                for index, raw in await next_done:
+                    error, line = item_line(index, raw)
+                    failed += error
+                    yield line
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        yield ndjson_line({'type': 'summary', 'items': len(items), 'succeeded': len(items) - failed, 'failed': failed})
+
+    return StreamingResponse(stream(), media_type=NDJSON_MEDIA_TYPE, status_code=status.HTTP_200_OK)
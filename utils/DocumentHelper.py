@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from collections import namedtuple
+from functools import partial
+
+import cv2
+import numpy as np
+from fastapi import HTTPException, UploadFile, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+
+from utils.Admission import admit, pixels_cost
+from utils.ImagePreprocess import MAX_IMAGE_SIDE, decode_image, downscale
+from utils.InferenceExecutor import run_inference_with_retry
+from utils.ResultHelper import encode_artifact
+from utils.Timing import StageTimer
+
+logger = logging.getLogger(__name__)
+
+# Resolution PDF pages are rasterized at
+PDF_DPI = int(os.environ.get("PDF_DPI", "200"))
+# Largest number of pages accepted in one document
+MAX_DOCUMENT_PAGES = int(os.environ.get("MAX_DOCUMENT_PAGES", "500"))
+# Pages rasterized ahead of the page being recognized
+PAGE_PREFETCH = int(os.environ.get("PAGE_PREFETCH", "2"))
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# Status of the inputs above a limit. Starlette renamed HTTP_413_REQUEST_ENTITY_TOO_LARGE and warns on
+# the old name, which is the only one of the pinned release
+HTTP_413_CONTENT_TOO_LARGE = getattr(status, 'HTTP_413_CONTENT_TOO_LARGE', 413)
+
+PagedDocument = namedtuple('PagedDocument', ['path', 'kind', 'pages'])
+
+
+def document_type(head: bytes):
+    """Document type from the first bytes of a file
+
+    Returns:
+        str: 'pdf', 'tiff', 'image' for a single JPEG or PNG, or None
+    """
+    if head.startswith(b'%PDF'):
+        return 'pdf'
+    if head[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff'
+    if head.startswith((b'\xff\xd8\xff', b'\x89PNG')):
+        return 'image'
+    return None
+
+
+def page_count(path, kind):
+    if kind == 'image':
+        return 1
+    if kind == 'pdf':
+        import fitz
+
+        with fitz.open(path) as pdf:
+            return pdf.page_count
+    from PIL import Image
+
+    with Image.open(path) as tiff:
+        return getattr(tiff, 'n_frames', 1)
+
+
+def iter_pages(path, kind, dpi=PDF_DPI):
+    """Rasterize the pages of a document one at a time
+
+    Args:
+        path (str): PDF, TIFF or image file
+        kind (str): 'pdf', 'tiff' or 'image'
+        dpi (int): resolution of rasterized PDF pages
+
+    Yields:
+        ndarray: BGR image of each page, no larger than MAX_IMAGE_SIDE
+    """
+    if kind == 'image':
+        with open(path, 'rb') as f:
+            image, _ = decode_image(f.read())
+        if image is None:
+            raise ValueError('Unable to decode the image')
+        yield image
+    elif kind == 'pdf':
+        import fitz
+
+        with fitz.open(path) as pdf:
+            for page in pdf:
+                # Oversized pages are rasterized below `dpi` to stay within MAX_IMAGE_SIDE
+                zoom = dpi / 72
+                if MAX_IMAGE_SIDE > 0:
+                    zoom = min(zoom, MAX_IMAGE_SIDE / max(page.rect.width, page.rect.height, 1))
+                pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+                rgb = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+                yield cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR if pix.n == 3 else cv2.COLOR_GRAY2BGR)
+                del pix
+    else:
+        from PIL import Image, ImageSequence
+
+        with Image.open(path) as tiff:
+            for frame in ImageSequence.Iterator(tiff):
+                image, _ = downscale(cv2.cvtColor(np.asarray(frame.convert('RGB')), cv2.COLOR_RGB2BGR), MAX_IMAGE_SIDE)
+                yield image
+
+
+_END = object()
+
+
+class PagePrefetcher:
+    """Rasterizes pages on a background thread, at most `prefetch` pages ahead.
+
+    Decoding the next pages overlaps with inference on the current one while
+    the bounded queue keeps memory flat whatever the number of pages.
+    """
+
+    def __init__(self, document, prefetch=PAGE_PREFETCH, dpi=PDF_DPI):
+        self.document = document
+        self.dpi = dpi
+        self._queue = queue.Queue(maxsize=max(prefetch, 1))
+        self._stop = threading.Event()
+        self._timer = StageTimer('document')
+        self._thread = threading.Thread(target=self._produce, name='page-prefetch', daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        try:
+            start = time.perf_counter()
+            for image in iter_pages(self.document.path, self.document.kind, self.dpi):
+                self._timer.record('rasterize', time.perf_counter() - start)
+                if not self._put(image):
+                    return
+                start = time.perf_counter()
+        except Exception as exc:
+            self._put(exc)
+        else:
+            self._put(_END)
+
+    def get(self):
+        """Next page image, None once the document is exhausted
+
+        Raises:
+            Exception: the error raised while rasterizing
+        """
+        item = self._queue.get()
+        if item is _END:
+            return None
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self._stop.set()
+        # Drop buffered pages so a producer blocked on a full queue notices the stop
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+
+async def spool_document(file: UploadFile, directory, kinds=('pdf', 'tiff')) -> PagedDocument:
+    """Copy an uploaded document into a directory without reading it into memory
+
+    Args:
+        file (UploadFile): the upload
+        directory (str): where the document is written
+        kinds (tuple): accepted document types
+
+    Raises:
+        HTTPException: 400 for other file types or unreadable documents, 413 above MAX_DOCUMENT_PAGES
+    """
+    kind = document_type(await file.read(8))
+    if kind not in kinds:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Please upload a PDF or TIFF document" if 'image' not in kinds
+            else "Please upload a PDF, TIFF, .jpg or .png file"
+        )
+    await file.seek(0)
+
+    path = os.path.join(directory, 'document.' + kind)
+    with StageTimer('upload').stage('spool'), open(path, 'wb') as out:
+        await run_in_threadpool(shutil.copyfileobj, file.file, out)
+
+    try:
+        pages = await run_in_threadpool(page_count, path, kind)
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Unable to read the document"
+        )
+    if pages > MAX_DOCUMENT_PAGES:
+        raise HTTPException(
+            status_code=HTTP_413_CONTENT_TOO_LARGE,
+            detail=f"Documents are limited to {MAX_DOCUMENT_PAGES} pages"
+        )
+    return PagedDocument(path, kind, pages)
+
+
+async def process_pages(document, process):
+    """Run `process` on every page of a document as soon as it is rasterized
+
+    Yields:
+        tuple: page number from 1, then the raw result or the exception raised for that page
+    """
+    prefetcher = PagePrefetcher(document)
+    timer = StageTimer('document')
+    try:
+        page_no = 0
+        while True:
+            image = await run_in_threadpool(prefetcher.get)
+            if image is None:
+                return
+            page_no += 1
+            try:
+                # Pages of an accepted document wait for compute budget rather than fail
+                async with admit(pixels_cost(image.shape[1], image.shape[0]), wait=True):
+                    with timer.stage('page'):
+                        result = await run_inference_with_retry(process, image)
+            except Exception as exc:
+                logger.warning('Page %d of %s failed', page_no, document.path, exc_info=True)
+                result = exc
+            del image
+            yield page_no, result
+    finally:
+        prefetcher.close()
+
+
+class DocumentPipeline:
+    """How the pages of a document are recognized, serialized and assembled.
+
+    Args:
+        process (callable): blocking inference on one page image and an OCR language, returns the raw result
+        serialize (callable): raw result to a JSON friendly page result
+        builder (callable): creates the combined artifact, an object with a save() method
+        render (callable): render(builder, page_no, raw) adds one page to the artifact
+        extension (str): file extension of the artifact
+        media_type (str): media type of the artifact
+    """
+
+    def __init__(self, process, serialize, builder, render, extension, media_type):
+        self.process = process
+        self.serialize = serialize
+        self.builder = builder
+        self.render = render
+        self.extension = extension
+        self.media_type = media_type
+
+
+def ndjson_line(obj) -> bytes:
+    return (json.dumps(obj, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+def page_record(page_no, pages, result=None, error=None):
+    """NDJSON record of one page, shared by the streaming endpoints and the job API"""
+    if error is not None:
+        return {'type': 'error', 'page': page_no, 'pages': pages, 'detail': error}
+    return {'type': 'page', 'page': page_no, 'pages': pages, 'result': result}
+
+
+def page_error(exc):
+    if isinstance(exc, HTTPException):
+        return exc.detail
+    return 'Page could not be processed'
+
+
+async def document_response(document, pipeline, output, filename_base, lang=None, artifact=False, **options):
+    """Recognize a document page by page in the OCR language `lang`
+
+    With `output='ndjson'` one line is streamed per page as soon as it is
+    recognized, followed by a summary line. The combined artifact is only
+    built with `artifact`, it then ends the stream in base64 instead, as it
+    grows with the page count. Any other output waits for every page and
+    returns the artifact. `options` are passed on to pipeline.process, e.g.
+    the stages to run.
+    """
+    filename = f'{filename_base}.{pipeline.extension}'
+    process = partial(pipeline.process, lang=lang, **options)
+
+    if output != 'ndjson':
+        builder = await run_in_threadpool(pipeline.builder)
+        failed = []
+        async for page_no, raw in process_pages(document, process):
+            if isinstance(raw, Exception):
+                failed.append(str(page_no))
+                continue
+            await run_in_threadpool(pipeline.render, builder, page_no, raw)
+        artifact = await run_in_threadpool(builder.save)
+        headers = {'Content-Disposition': f'attachment; filename={filename}'}
+        if failed:
+            headers['X-Failed-Pages'] = ','.join(failed)
+        return StreamingResponse(artifact, media_type=pipeline.media_type, headers=headers,
+                                 status_code=status.HTTP_200_OK)
+
+    async def stream():
+        builder = await run_in_threadpool(pipeline.builder) if artifact else None
+        failed = 0
+        async for page_no, raw in process_pages(document, process):
+            if isinstance(raw, Exception):
+                failed += 1
+                yield ndjson_line(page_record(page_no, document.pages, error=page_error(raw)))
+                continue
+            line = await run_in_threadpool(pipeline.serialize, raw)
+            if builder is not None:
+                await run_in_threadpool(pipeline.render, builder, page_no, raw)
+            yield ndjson_line(page_record(page_no, document.pages, result=line))
+
+        if builder is None:
+            yield ndjson_line({'type': 'summary', 'pages': document.pages, 'failed': failed})
+            return
+        content = await run_in_threadpool(builder.save)
+        yield ndjson_line(dict(encode_artifact(filename, pipeline.media_type, content),
+                               type='document', pages=document.pages))
+
+    return StreamingResponse(stream(), media_type=NDJSON_MEDIA_TYPE, status_code=status.HTTP_200_OK)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Runtime of the PaddleOCR / PPStructure models, "paddle" or "onnx". With "onnx" the text detection,
+# recognition, angle classification and table structure models run on onnxruntime when an export
+# exists next to the Paddle model (see export_onnx.py), the PPStructure layout model stays on Paddle
+ENGINE_BACKEND = os.environ.get("ENGINE_BACKEND", "paddle").lower()
+# Use the int8 quantized exports (model.int8.onnx) where they exist
+ONNX_QUANTIZED = os.environ.get("ONNX_QUANTIZED", "false").lower() in ("1", "true", "yes")
+# Threads of each onnxruntime session within an operator and across operators, 0 lets onnxruntime decide
+ONNX_INTRA_OP_THREADS = int(os.environ.get("ONNX_INTRA_OP_THREADS", "0"))
+ONNX_INTER_OP_THREADS = int(os.environ.get("ONNX_INTER_OP_THREADS", "0"))
+# Graph optimizations applied when a session is created: disabled, basic, extended or all
+ONNX_GRAPH_OPTIMIZATION = os.environ.get("ONNX_GRAPH_OPTIMIZATION", "all").lower()
+# Memory arena of the onnxruntime CPU allocator, faster but keeps the memory of the largest input
+ONNX_CPU_ARENA = os.environ.get("ONNX_CPU_ARENA", "true").lower() in ("1", "true", "yes")
+# Threads of the Paddle inference runtime per engine, 0 keeps the PaddleOCR default of 10
+PADDLE_CPU_THREADS = int(os.environ.get("PADDLE_CPU_THREADS", "0"))
+
+# Predictor modes of PaddleOCR with an onnxruntime code path, and the argument holding their model directory
+ONNX_MODEL_DIRS = {
+    'det': 'det_model_dir',
+    'rec': 'rec_model_dir',
+    'cls': 'cls_model_dir',
+    'table': 'table_model_dir',
+}
+
+# Attributes leading from an engine to its predictors
+_PREDICTOR_ATTRS = ('text_system', 'table_system', 'text_detector', 'text_recognizer', 'text_classifier',
+                    'table_structurer')
+
+_GRAPH_OPTIMIZATIONS = {
+    'disabled': 'ORT_DISABLE_ALL',
+    'basic': 'ORT_ENABLE_BASIC',
+    'extended': 'ORT_ENABLE_EXTENDED',
+    'all': 'ORT_ENABLE_ALL',
+}
+
+# Engines are built one at a time while PaddleOCR's predictor factory is swapped
+_predictors_lock = threading.Lock()
+
+
+def backend_name():
+    """Backend identifier recorded in cache keys and benchmark results"""
+    if ENGINE_BACKEND != 'onnx':
+        return 'paddle'
+    return 'onnx-int8' if ONNX_QUANTIZED else 'onnx'
+
+
+def onnx_model_path(model_dir, quantized=ONNX_QUANTIZED):
+    """ONNX export of a Paddle inference model, stored next to it as model.onnx or model.int8.onnx
+
+    Returns:
+        str: path of the export to use, None when the model was not exported
+    """
+    if not model_dir:
+        return None
+    names = ('model.int8.onnx', 'model.onnx') if quantized else ('model.onnx',)
+    for name in names:
+        path = os.path.join(model_dir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def session_options():
+    """onnxruntime session options shared by every ONNX model of the service"""
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    if ONNX_INTRA_OP_THREADS > 0:
+        options.intra_op_num_threads = ONNX_INTRA_OP_THREADS
+    if ONNX_INTER_OP_THREADS > 0:
+        options.inter_op_num_threads = ONNX_INTER_OP_THREADS
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    options.graph_optimization_level = getattr(
+        ort.GraphOptimizationLevel, _GRAPH_OPTIMIZATIONS.get(ONNX_GRAPH_OPTIMIZATION, 'ORT_ENABLE_ALL'))
+    options.enable_cpu_mem_arena = ONNX_CPU_ARENA
+    return options
+
+
+def create_session(path):
+    import onnxruntime as ort
+
+    return ort.InferenceSession(path, sess_options=session_options(), providers=['CPUExecutionProvider'])
+
+
+@contextmanager
+def _onnx_predictors():
+    """Make PaddleOCR create onnxruntime sessions for the exported models while the block builds an engine
+
+    PaddleOCR's predictor factory is swapped only for the duration of the block and restored on
+    exit, engines built outside of build_engine keep their Paddle predictors.
+    """
+    import paddleocr  # noqa: F401, puts the PaddleOCR `tools` package on sys.path
+    from tools.infer import utility
+
+    def create_predictor(args, mode, paddle_logger):
+        if mode in ONNX_MODEL_DIRS:
+            model_dir = getattr(args, ONNX_MODEL_DIRS[mode])
+            path = onnx_model_path(model_dir)
+            if path is not None:
+                logger.info('Running the %s model on onnxruntime from %s', mode, path)
+                session = create_session(path)
+                return session, session.get_inputs()[0], None, None
+            logger.warning('No ONNX export in %s, the %s model runs on Paddle', model_dir, mode)
+        return paddle_create_predictor(args, mode, paddle_logger)
+
+    with _predictors_lock:
+        paddle_create_predictor = utility.create_predictor
+        utility.create_predictor = create_predictor
+        try:
+            yield
+        finally:
+            utility.create_predictor = paddle_create_predictor
+
+
+def _use_onnx(engine):
+    # Predictors read `use_onnx` from the engine arguments, which stay False so the Paddle
+    # models are still downloaded: switch the ones given a session to their ONNX code path
+    import onnxruntime as ort
+
+    pending = [engine]
+    while pending:
+        obj = pending.pop()
+        if isinstance(getattr(obj, 'predictor', None), ort.InferenceSession):
+            obj.use_onnx = True
+        pending.extend(getattr(obj, name) for name in _PREDICTOR_ATTRS if getattr(obj, name, None) is not None)
+    return engine
+
+
+def build_engine(engine_class, **kwargs):
+    """Create a PaddleOCR or PPStructure engine on the configured backend
+
+    Args:
+        engine_class (type): PaddleOCR or PPStructure
+        **kwargs: engine arguments
+
+    Returns:
+        _type_: the engine instance
+    """
+    if PADDLE_CPU_THREADS > 0:
+        kwargs.setdefault('cpu_threads', PADDLE_CPU_THREADS)
+    if ENGINE_BACKEND != 'onnx':
+        return engine_class(**kwargs)
+    with _onnx_predictors():
+        engine = engine_class(**kwargs)
+    return _use_onnx(engine)
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+
+import io
+import zipfile
+
+import cv2
+from docx import Document, shared
+from docx.enum.section import WD_SECTION
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.opc.constants import CONTENT_TYPE
+from docx.opc.packuri import PACKAGE_URI
+from docx.oxml.ns import qn
+from lxml import etree
+
+DOCX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+ZIP_MEDIA_TYPE = "application/zip"
+
+_CONTENT_TYPES_NS = 'http://schemas.openxmlformats.org/package/2006/content-types'
+
+
+class _ChunkSink(io.RawIOBase):
+    """Unseekable file keeping what is written to it until it is taken"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ZipStream:
+    """Writes a .zip archive entry by entry and hands out its bytes as they are written.
+
+    The archive goes to an unseekable sink, so zipfile puts the sizes and CRC
+    of each entry in a data descriptor after it and nothing written has to be
+    revisited: every chunk returned can be sent right away and only the entry
+    being compressed is held in memory.
+    """
+
+    def __init__(self, compression=zipfile.ZIP_DEFLATED):
+        self._sink = _ChunkSink()
+        self._zip = zipfile.ZipFile(self._sink, 'w', compression)
+
+    def add(self, name, content) -> bytes:
+        """Add a whole entry, returns the archive bytes written since the last call"""
+        self._zip.writestr(name, content)
+        return self._sink.take()
+
+    def open(self, name):
+        """Entry written piece by piece through the returned file, see take()"""
+        return self._zip.open(name, 'w')
+
+    def take(self) -> bytes:
+        """Archive bytes written since the last call"""
+        return self._sink.take()
+
+    def close(self) -> bytes:
+        """Write the central directory, returns the last bytes of the archive"""
+        self._zip.close()
+        return self._sink.take()
+
+
+def _content_types_xml(parts):
+    """[Content_Types].xml of a package: the relationship parts by extension, every other part by name"""
+    types = etree.Element(f'{{{_CONTENT_TYPES_NS}}}Types', nsmap={None: _CONTENT_TYPES_NS})
+    etree.SubElement(types, f'{{{_CONTENT_TYPES_NS}}}Default', Extension='rels',
+                     ContentType=CONTENT_TYPE.OPC_RELATIONSHIPS)
+    etree.SubElement(types, f'{{{_CONTENT_TYPES_NS}}}Default', Extension='xml', ContentType=CONTENT_TYPE.XML)
+    for part in parts:
+        etree.SubElement(types, f'{{{_CONTENT_TYPES_NS}}}Override', PartName=str(part.partname),
+                         ContentType=part.content_type)
+    return etree.tostring(types, encoding='UTF-8', xml_declaration=True, standalone=True)
+
+
+class DocxStream:
+    """Streams a python-docx document as a .docx file while it is being built.
+
+    Everything appended to the document body since the last flush() is
+    serialized into word/document.xml and removed from the tree, so pages are
+    sent as they are recovered and never accumulate in memory. close() ends
+    the body and writes the other parts of the package (styles, images,
+    relationships) once nothing can be added to them anymore.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self._zip = ZipStream()
+        self._body = doc.element.body
+        self._part = None
+        self._tail = b''
+
+    def _start(self):
+        # Opening tags of the document with the namespaces of python-docx, serialized around an empty body
+        children = list(self._body)
+        for child in children:
+            self._body.remove(child)
+        xml = etree.tostring(self.doc.element, encoding='UTF-8', xml_declaration=True, standalone=True)
+        for child in children:
+            self._body.append(child)
+        head, tail = xml.split(b'<w:body/>')
+        self._tail = b'</w:body>' + tail
+        self._part = self._zip.open('word/document.xml')
+        self._part.write(head + b'<w:body>')
+
+    def _write_body(self, final=False):
+        if self._part is None:
+            self._start()
+        # The body sectPr, the page setup of the last section, stays last until the body is closed
+        sect_pr = self._body.sectPr
+        for child in list(self._body):
+            if child is not sect_pr or final:
+                self._part.write(etree.tostring(child, encoding='UTF-8'))
+                self._body.remove(child)
+
+    def flush(self) -> bytes:
+        """Serialize what was added to the body, returns the .docx bytes written since the last call"""
+        self._write_body()
+        return self._zip.take()
+
+    def close(self) -> bytes:
+        """End the document, returns the last bytes of the .docx file"""
+        self._write_body(final=True)
+        self._part.write(self._tail)
+        self._part.close()
+
+        package = self.doc.part.package
+        parts = list(package.iter_parts())
+        chunks = [
+            self._zip.take(),
+            self._zip.add('[Content_Types].xml', _content_types_xml(parts)),
+            self._zip.add(PACKAGE_URI.rels_uri.membername, package.rels.xml),
+        ]
+        for part in parts:
+            if part is not self.doc.part:
+                chunks.append(self._zip.add(part.partname.membername, part.blob))
+            if len(part.rels):
+                chunks.append(self._zip.add(part.partname.rels_uri.membername, part.rels.xml))
+        chunks.append(self._zip.close())
+        return b''.join(chunks)
+
+
+def stream_text_docx(text: str):
+    """Single paragraph .docx document, yielded in chunks as it is written
+
+    Args:
+        text (str): paragraph text
+    """
+    doc = Document()
+    stream = DocxStream(doc)
+    doc.add_paragraph(text)
+    yield stream.close()
+
+
+def text_to_docx(text: str) -> io.BytesIO:
+    """Single paragraph .docx document built in memory
+
+    Args:
+        text (str): paragraph text
+
+    Returns:
+        io.BytesIO: the .docx file, positioned at the start
+    """
+    return io.BytesIO(b''.join(stream_text_docx(text)))
+
+
+class TextDocxBuilder:
+    """Builds a .docx document holding one paragraph of recognized text per page."""
+
+    def __init__(self):
+        self.doc = Document()
+        self.pages = 0
+
+    def add_page(self, text):
+        if self.pages:
+            self.doc.add_page_break()
+        self.pages += 1
+        self.doc.add_paragraph(text)
+
+    def save(self) -> io.BytesIO:
+        return _save_document(self.doc)
+
+
+class LayoutDocxBuilder:
+    """Recovers a .docx document from sorted PPStructure regions, page by page.
+
+    Same output as paddleocr's convert_info_docx, except figures are encoded
+    from the region crops instead of being read back from save_structure_res
+    files, and several pages can be appended to one document.
+    """
+
+    def __init__(self):
+        from paddleocr.ppstructure.recovery.table_process import HtmlToDocx
+
+        self._html_to_docx = HtmlToDocx
+        self.doc = Document()
+        self.doc.styles['Normal'].font.name = 'Times New Roman'
+        self.doc.styles['Normal']._element.rPr.rFonts.set(qn('w:eastAsia'), u'宋体')
+        self.doc.styles['Normal'].font.size = shared.Pt(6.5)
+        self.pages = 0
+        self._flag = 1
+
+    def add_page(self, res):
+        """Append the regions of one page
+
+        Args:
+            res (list): regions returned by sorted_layout_boxes
+        """
+        for _ in self.iter_page(res):
+            pass
+
+    def iter_page(self, res):
+        """Append the regions of one page one at a time, yielding after each of them
+
+        Args:
+            res (list): regions returned by sorted_layout_boxes
+        """
+        doc = self.doc
+        if self.pages:
+            doc.add_page_break()
+        self.pages += 1
+
+        for region in res:
+            if len(region['res']) == 0:
+                continue
+            if self._flag == 2 and region['layout'] == 'single':
+                section = doc.add_section(WD_SECTION.CONTINUOUS)
+                section._sectPr.xpath('./w:cols')[0].set(qn('w:num'), '1')
+                self._flag = 1
+            elif self._flag == 1 and region['layout'] == 'double':
+                section = doc.add_section(WD_SECTION.CONTINUOUS)
+                section._sectPr.xpath('./w:cols')[0].set(qn('w:num'), '2')
+                self._flag = 2
+
+            region_type = region['type'].lower()
+            if region_type == 'figure':
+                ok, encoded = cv2.imencode('.jpg', region['img'])
+                if not ok:
+                    continue
+                paragraph_pic = doc.add_paragraph()
+                paragraph_pic.alignment = WD_ALIGN_PARAGRAPH.CENTER
+                run = paragraph_pic.add_run("")
+                width = shared.Inches(5) if self._flag == 1 else shared.Inches(2)
+                run.add_picture(io.BytesIO(encoded.tobytes()), width=width)
+            elif region_type == 'title':
+                doc.add_heading(region['res'][0]['text'])
+            elif region_type == 'table' and isinstance(region['res'], dict):
+                parser = self._html_to_docx()
+                parser.table_style = 'TableGrid'
+                parser.handle_table(region['res']['html'], doc)
+            else:
+                paragraph = doc.add_paragraph()
+                paragraph_format = paragraph.paragraph_format
+                for i, line in enumerate(region['res']):
+                    if i == 0:
+                        paragraph_format.first_line_indent = shared.Inches(0.25)
+                    text_run = paragraph.add_run(line['text'] + ' ')
+                    text_run.font.size = shared.Pt(10)
+            yield region
+
+    def save(self) -> io.BytesIO:
+        return _save_document(self.doc)
+
+
+def stream_layout_docx(res):
+    """Recover a .docx document from sorted PPStructure regions, yielded in chunks as regions are added
+
+    Args:
+        res (list): regions returned by sorted_layout_boxes
+    """
+    builder = LayoutDocxBuilder()
+    stream = DocxStream(builder.doc)
+    for _ in builder.iter_page(res):
+        chunk = stream.flush()
+        if chunk:
+            yield chunk
+    yield stream.close()
+
+
+def layout_to_docx(res) -> io.BytesIO:
+    """Recover a .docx document from sorted PPStructure regions, in memory
+
+    Args:
+        res (list): regions returned by sorted_layout_boxes
+
+    Returns:
+        io.BytesIO: the .docx file, positioned at the start
+    """
+    return io.BytesIO(b''.join(stream_layout_docx(res)))
+
+
+def table_html_to_xlsx(html: str) -> bytes:
+    """Convert a recognized table's HTML into .xlsx bytes
+
+    Args:
+        html (str): table HTML from the PPStructure table engine
+
+    Returns:
+        bytes: the .xlsx file
+    """
+    from paddleocr import to_excel
+
+    buffer = io.BytesIO()
+    to_excel(html, buffer)
+    return buffer.getvalue()
+
+
+class TablesWorkbookBuilder:
+    """Collects recognized tables into one .xlsx workbook, one sheet per table."""
+
+    def __init__(self):
+        from openpyxl import Workbook
+
+        self.workbook = Workbook()
+        self.workbook.remove(self.workbook.active)
+        self.tables = 0
+
+    def add_table(self, html, title):
+        """Append a table as a new sheet
+
+        Args:
+            html (str): table HTML from the PPStructure table engine
+            title (str): sheet title, at most 31 characters
+        """
+        from paddleocr.ppstructure.table.tablepyxl.tablepyxl import document_to_workbook
+
+        # tablepyxl names each sheet after the name attribute of its table
+        named = html.replace('<table', f'<table name="{title[:31]}"', 1)
+        document_to_workbook(named, wb=self.workbook)
+        self.tables += 1
+
+    def save(self) -> io.BytesIO:
+        if not self.tables:
+            self.workbook.create_sheet('Empty')
+        buffer = io.BytesIO()
+        self.workbook.save(buffer)
+        buffer.seek(0)
+        return buffer
+
+
+def _save_document(doc) -> io.BytesIO:
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    buffer.seek(0)
+    return buffer
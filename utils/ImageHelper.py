@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import base64
+import time
 
 import cv2
 import numpy as np
 
+from utils.Metrics import observe_image
+
 
 def base64_to_ndarray(b64_data: str):
     """base64转numpy数组
@@ -15,21 +18,26 @@ def base64_to_ndarray(b64_data: str):
     Returns:
         _type_: _description_
     """
+    start = time.perf_counter()
     image_bytes = base64.b64decode(b64_data)
     image_np = np.frombuffer(image_bytes, dtype=np.uint8)
     image_np2 = cv2.imdecode(image_np, cv2.IMREAD_COLOR)
+    observe_image(image_np2, len(image_bytes), time.perf_counter() - start)
     return image_np2
 
 
-def bytes_to_ndarray(img_bytes: str):
+def bytes_to_ndarray(img_bytes: str, flags=cv2.IMREAD_COLOR):
     """字节转numpy数组
 
     Args:
         img_bytes (str): 图片字节
+        flags (int): cv2.imdecode flags, e.g. cv2.IMREAD_REDUCED_COLOR_2 to decode a JPEG at half size
 
     Returns:
         _type_: _description_
     """
+    start = time.perf_counter()
     image_array = np.frombuffer(img_bytes, dtype=np.uint8)
-    image_np2 = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
+    image_np2 = cv2.imdecode(image_array, flags)
+    observe_image(image_np2, len(img_bytes), time.perf_counter() - start)
     return image_np2
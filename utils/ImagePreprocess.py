@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import struct
+import warnings
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from utils.ImageHelper import bytes_to_ndarray
+
+# Longest side images are decoded at: larger JPEGs are decoded at 1/2, 1/4 or 1/8 scale by the
+# JPEG decoder itself, other images are resized after decoding. 0 keeps the full resolution
+MAX_IMAGE_SIDE = int(os.environ.get("MAX_IMAGE_SIDE", "4000"))
+# Longest side of the images sent to the YOLO detector, which letterboxes them to 640 px anyway
+DETECTION_MAX_SIDE = int(os.environ.get("DETECTION_MAX_SIDE", "1280"))
+# Longest side above which text is detected and recognized tile by tile, the PaddleOCR text
+# detector shrinks whole pages to 960 px and loses small text. Just above A4 at 300 dpi, 0 disables tiling
+OCR_TILE_THRESHOLD = int(os.environ.get("OCR_TILE_THRESHOLD", "3600"))
+# Side of the OCR tiles and overlap between neighbouring tiles, larger than a text line is high
+OCR_TILE_SIZE = int(os.environ.get("OCR_TILE_SIZE", "2000"))
+OCR_TILE_OVERLAP = int(os.environ.get("OCR_TILE_OVERLAP", "200"))
+
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+# Longest side pages are shrunk to before their orientation is estimated
+_ORIENTATION_SIDE = 1000
+# Ink above minus ink below the x-height band of the text lines, over both, beyond which Latin text is
+# taken as upright or upside down: ascenders are more frequent than descenders
+_ASCENDER_MARGIN = 0.1
+
+PageOrientation = namedtuple('PageOrientation', ['upright', 'rotated', 'skew'])
+
+
+def _jpeg_size(data):
+    # Width and height from the first start of frame marker, skipping the segments before it
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return width, height
+        if marker in (0x01, *range(0xD0, 0xD8)):
+            i += 2
+            continue
+        i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+    return None
+
+
+def image_size(data):
+    """Width and height of an encoded image read from its header, None when unknown
+
+    JPEG and PNG headers are parsed directly, whatever the size they declare,
+    so it also works on the first bytes of an image and on decompression bombs.
+    """
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    if data[:3] == b'\xff\xd8\xff':
+        return _jpeg_size(data)
+
+    from PIL import Image
+
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            with Image.open(io.BytesIO(data)) as image:
+                return image.size
+    except Exception:
+        return None
+
+
+def downscale(img, max_side):
+    """Shrink an image so that its longest side is at most `max_side`
+
+    Returns:
+        tuple: (image, scale) where scale maps the returned image back to the original, 1.0 when unchanged
+    """
+    h, w = img.shape[:2]
+    if max_side <= 0 or max(h, w) <= max_side:
+        return img, 1.0
+    ratio = max_side / max(h, w)
+    small = cv2.resize(img, (max(int(round(w * ratio)), 1), max(int(round(h * ratio)), 1)),
+                       interpolation=cv2.INTER_AREA)
+    return small, w / small.shape[1]
+
+
+def decode_image(data, max_side=MAX_IMAGE_SIDE):
+    """Decode an image at a working resolution no larger than `max_side`
+
+    JPEGs are decoded directly at a reduced size when the reduction keeps them
+    at least `max_side` large, so a 600 dpi scan never exists in memory at full
+    resolution. Anything still too large is then resized.
+
+    Returns:
+        tuple: (BGR ndarray or None when the image cannot be decoded, scale from the working image
+        back to the original)
+    """
+    size = image_size(data) if max_side > 0 else None
+    if size is None or max(size) <= max_side:
+        return bytes_to_ndarray(data), 1.0
+
+    flags = cv2.IMREAD_COLOR
+    if data[:3] == b'\xff\xd8\xff':
+        for factor, reduced in _REDUCED_FLAGS:
+            if max(size) / factor >= max_side:
+                flags = reduced
+                break
+    img = bytes_to_ndarray(data, flags)
+    if img is None:
+        return None, 1.0
+    img, _ = downscale(img, max_side)
+    # The header size is before the EXIF orientation OpenCV applies while decoding, a rotated photo has its
+    # width and height swapped, its longest side is the same
+    return img, max(size) / max(img.shape[:2])
+
+
+def _row_profile(ink, angle=0.0):
+    if angle:
+        h, w = ink.shape
+        matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+        ink = cv2.warpAffine(ink, matrix, (w, h), flags=cv2.INTER_NEAREST)
+    return cv2.reduce(ink, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel().astype(np.float64)
+
+
+def _sharpness(rows):
+    # How much the ink jumps from one row to the next, highest when the text lines are horizontal
+    return float(np.square(np.diff(rows)).sum())
+
+
+def _best_angle(ink, angles):
+    scores = [(_sharpness(_row_profile(ink, float(angle))), float(angle)) for angle in angles]
+    return max(scores)
+
+
+def _ascender_balance(rows):
+    # Ink above minus ink below the densest rows of each text line, over both
+    text_rows = rows > 0.02 * rows.max()
+    above = below = 0.0
+    start = None
+    for y, is_text in enumerate(np.append(text_rows, False)):
+        if is_text and start is None:
+            start = y
+        elif not is_text and start is not None:
+            band = rows[start:y]
+            if len(band) >= 4:
+                core = np.flatnonzero(band >= 0.5 * band.max())
+                above += band[:core[0]].sum()
+                below += band[core[-1] + 1:].sum()
+            start = None
+    total = above + below
+    return (above - below) / total if total else 0.0
+
+
+def estimate_orientation(img):
+    """Cheap estimate of the orientation and skew of a page of text, from its ink projections
+
+    The skew is the small rotation making the row profile the sharpest, and
+    text lines running vertically mean the page is rotated by 90 degrees.
+    The balance between ascenders and descenders around the x-height band of
+    the lines tells upright Latin text from upside-down text. Pages without
+    enough text, or in scripts without that balance, are not known upright.
+
+    Returns:
+        PageOrientation: upright (True, False for upside down, None when unknown), rotated (text lines
+        vertical) and skew in degrees, counterclockwise
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    gray, _ = downscale(gray, _ORIENTATION_SIDE)
+    _, ink = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    coverage = ink.mean()
+    if coverage < 0.002 or coverage > 0.5:
+        return PageOrientation(None, False, 0.0)
+
+    coarse = np.arange(-6.0, 6.5, 2.0)
+    horizontal, angle = _best_angle(ink, coarse)
+    vertical, _ = _best_angle(np.ascontiguousarray(ink.T), coarse)
+    if vertical > 1.5 * horizontal:
+        return PageOrientation(None, True, 0.0)
+
+    _, angle = _best_angle(ink, angle + np.arange(-1.0, 1.25, 0.25))
+    balance = _ascender_balance(_row_profile(ink, angle))
+    upright = True if balance > _ASCENDER_MARGIN else False if balance < -_ASCENDER_MARGIN else None
+    # The page is rotated by the opposite of the rotation straightening it
+    return PageOrientation(upright, False, -angle)
+
+
+def needs_tiling(img):
+    """Whether the text of an image is recognized tile by tile"""
+    return OCR_TILE_THRESHOLD > 0 and max(img.shape[:2]) > OCR_TILE_THRESHOLD
+
+
+def scale_points(points, scale):
+    """Points or boxes mapped back to the original image, nested lists of coordinates"""
+    if scale == 1.0 or points is None:
+        return points
+    return (np.asarray(points, dtype=np.float64) * scale).tolist()
+
+
+def scale_ocr_result(result, scale):
+    """PaddleOCR.ocr result of a working image, in the coordinates of the original image"""
+    if scale == 1.0:
+        return result
+    return [[[scale_points(box, scale), rec] for box, rec in page] if page else page for page in result]
+
+
+def scale_regions(analysis, scale):
+    """PPStructure layout analysis of a working image, in the coordinates of the original image"""
+    if scale == 1.0:
+        return analysis
+    regions = []
+    for region in analysis['regions']:
+        region = dict(region, bbox=[int(round(v * scale)) for v in region['bbox']])
+        res = region['res']
+        if isinstance(res, dict):
+            region['res'] = dict(res, cell_bbox=scale_points(res.get('cell_bbox'), scale))
+        elif res:
+            region['res'] = [dict(line, text_region=scale_points(line['text_region'], scale)) for line in res]
+        regions.append(region)
+    return {'width': int(round(analysis['width'] * scale)), 'regions': regions}
+
+
+def scale_tables(tables, scale):
+    """Recognized tables of a working image, in the coordinates of the original image"""
+    if scale == 1.0:
+        return tables
+    return [
+        dict(table, bbox=scale_points(table.get('bbox'), scale), cell_bbox=scale_points(table.get('cell_bbox'), scale))
+        if table is not None else None
+        for table in tables
+    ]
+
+
+def tile_windows(width, height, size=OCR_TILE_SIZE, overlap=OCR_TILE_OVERLAP):
+    """Overlapping tiles covering an image, the last row and column aligned on its edges
+
+    Returns:
+        list: (x1, y1, x2, y2) per tile
+    """
+    step = max(size - overlap, 1)
+
+    def starts(length):
+        if length <= size:
+            return [0]
+        positions = list(range(0, length - size, step))
+        positions.append(length - size)
+        return positions
+
+    return [(x, y, min(x + size, width), min(y + size, height)) for y in starts(height) for x in starts(width)]
+
+
+def _rect(box):
+    points = np.asarray(box, dtype=np.float64)
+    return points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()
+
+
+def _overlap(a, b):
+    # Intersection over the smaller rectangle, 1.0 when one contains the other
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    smaller = min((a[2] - a[0]) * (a[3] - a[1]), (b[2] - b[0]) * (b[3] - b[1]))
+    return w * h / smaller if smaller > 0 else 0.0
+
+
+def _join_text(left, right, expected):
+    # Both fragments read the characters of the overlap, about `expected` of them: keep them once,
+    # picking the matching overlap closest to the expected one in case the text repeats itself
+    matches = [k for k in range(1, min(len(left), len(right), expected + 2) + 1) if left.endswith(right[:k])]
+    if not matches:
+        return f'{left} {right}'
+    k = min(matches, key=lambda k: abs(k - expected))
+    return left + right[k:]
+
+
+def merge_tiled_lines(tiles, width, height, margin=2):
+    """Merge the text lines recognized on overlapping tiles into the lines of the whole image
+
+    Lines that touch the inner edge of their tile were cut by it: they are only
+    kept when no tile saw the whole line, and fragments of one line cut by a tile
+    edge are joined. Duplicates of a line seen whole by two tiles are dropped.
+
+    Args:
+        tiles (list): ((x1, y1, x2, y2) window, lines in tile coordinates in the format of PaddleOCR.ocr)
+        width (int): image width
+        height (int): image height
+
+    Returns:
+        list: lines in image coordinates, top to bottom then left to right
+    """
+    whole, cut = [], []
+    for (x1, y1, x2, y2), lines in tiles:
+        for box, (text, score) in lines or []:
+            box = [[px + x1, py + y1] for px, py in box]
+            r = _rect(box)
+            touches = ((x1 > 0 and r[0] <= x1 + margin) or (y1 > 0 and r[1] <= y1 + margin)
+                       or (x2 < width and r[2] >= x2 - margin) or (y2 < height and r[3] >= y2 - margin))
+            (cut if touches else whole).append([r, box, text, score])
+
+    kept = []
+    for line in sorted(whole, key=lambda line: -line[3]):
+        if all(_overlap(line[0], other[0]) <= 0.5 for other in kept):
+            kept.append(line)
+
+    fragments = [line for line in cut if all(_overlap(line[0], other[0]) <= 0.5 for other in kept)]
+    fragments.sort(key=lambda line: line[0][0])
+    joined = []
+    for line in fragments:
+        for other in joined:
+            a, b = other[0], line[0]
+            rows = min(a[3], b[3]) - max(a[1], b[1])
+            if rows > 0.5 * min(a[3] - a[1], b[3] - b[1]) and b[0] <= a[2]:
+                if b[2] > a[2]:
+                    chars_per_px = len(line[2]) / max(b[2] - b[0], 1)
+                    other[2] = _join_text(other[2], line[2], int(round((a[2] - b[0]) * chars_per_px)))
+                elif _overlap(a, b) <= 0.5:
+                    continue
+                other[0] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                other[1] = None
+                other[3] = min(other[3], line[3])
+                break
+        else:
+            joined.append(list(line))
+
+    merged = []
+    for r, box, text, score in kept + joined:
+        if box is None:
+            box = [[r[0], r[1]], [r[2], r[1]], [r[2], r[3]], [r[0], r[3]]]
+        merged.append([box, (text, score)])
+    # Reading order as in PaddleOCR: top to bottom, left to right within 10 px high rows
+    merged.sort(key=lambda line: (_rect(line[0])[1], _rect(line[0])[0]))
+    for i in range(len(merged) - 1):
+        for j in range(i, -1, -1):
+            a, b = _rect(merged[j][0]), _rect(merged[j + 1][0])
+            if abs(b[1] - a[1]) < 10 and b[0] < a[0]:
+                merged[j], merged[j + 1] = merged[j + 1], merged[j]
+            else:
+                break
+    return merged
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import contextvars
+import functools
+import heapq
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from fastapi import HTTPException, status
+
+from utils.Metrics import INFERENCE_QUEUE_DEPTH, INFERENCE_REJECTED, INFERENCE_RUNNING, INFERENCE_WAIT_SECONDS
+
+# Number of inference jobs running at the same time
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "1"))
+# Number of jobs allowed to wait for a free worker before new ones are rejected
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", "16"))
+# Seconds suggested to rejected clients through the Retry-After header
+INFERENCE_RETRY_AFTER = int(os.environ.get("INFERENCE_RETRY_AFTER", "1"))
+
+# Priority of the inference jobs submitted from the current context, lower first. Set by the admission
+# control (utils/Admission.py) to the lane of the request, jobs of the same priority run in order
+inference_priority = contextvars.ContextVar('inference_priority', default=0)
+
+
+class InferenceExecutor:
+    """Bounded thread pool that keeps blocking inference off the event loop.
+
+    At most `workers` jobs run at once and at most `queue_size` wait for a
+    slot, anything beyond that is rejected immediately with a 503 so the
+    process keeps answering other requests. A freed worker picks the waiting
+    job of lowest `inference_priority`, so small requests do not queue
+    behind large ones.
+    """
+
+    def __init__(self, workers=INFERENCE_WORKERS, queue_size=INFERENCE_QUEUE_SIZE):
+        self.workers = max(workers, 1)
+        self.queue_size = max(queue_size, 0)
+        # Created on first use so forked workers never inherit a parent's threads
+        self._executor = None
+        self._lock = threading.Lock()
+        # (priority, sequence, job, future) of the jobs waiting for a worker
+        self._pending = []
+        self._sequence = itertools.count()
+        self._queued = 0
+        self._running = 0
+        self._submitted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._failed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                        thread_name_prefix='inference')
+        return self._executor
+
+    async def run(self, fn, *args, **kwargs):
+        """Run `fn(*args, **kwargs)` on an inference worker and await its result
+
+        Raises:
+            HTTPException: 503 when the queue is full
+        """
+        with self._lock:
+            if self._queued + self._running >= self.workers + self.queue_size:
+                self._rejected += 1
+                INFERENCE_REJECTED.inc()
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Inference queue is full, please retry later",
+                    headers={'Retry-After': str(INFERENCE_RETRY_AFTER)}
+                )
+            self._queued += 1
+            self._submitted += 1
+        INFERENCE_QUEUE_DEPTH.inc()
+
+        # The job sees the context of the request, e.g. its stage timings
+        job = functools.partial(contextvars.copy_context().run, self._run_job, time.perf_counter(), fn, args, kwargs)
+        future = Future()
+        with self._lock:
+            heapq.heappush(self._pending, (inference_priority.get(), next(self._sequence), job, future))
+        self._get_executor().submit(self._run_next)
+        return await asyncio.wrap_future(future)
+
+    def _run_next(self):
+        # Every submission runs one job, the most urgent one waiting when a worker frees up
+        with self._lock:
+            _, _, job, future = heapq.heappop(self._pending)
+        if not future.set_running_or_notify_cancel():
+            # Cancelled while waiting, e.g. the client went away
+            with self._lock:
+                self._queued -= 1
+            INFERENCE_QUEUE_DEPTH.dec()
+            return
+        try:
+            result = job()
+        except BaseException as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+    def _run_job(self, submitted_at, fn, args, kwargs):
+        wait = time.perf_counter() - submitted_at
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+        INFERENCE_QUEUE_DEPTH.dec()
+        INFERENCE_RUNNING.inc()
+        INFERENCE_WAIT_SECONDS.observe(wait)
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException:
+            with self._lock:
+                self._failed += 1
+            raise
+        else:
+            with self._lock:
+                self._completed += 1
+            return result
+        finally:
+            with self._lock:
+                self._running -= 1
+            INFERENCE_RUNNING.dec()
+
+    def stats(self):
+        with self._lock:
+            started = self._completed + self._failed + self._running
+            return {
+                'workers': self.workers,
+                'queue_size': self.queue_size,
+                'queue_depth': self._queued,
+                'running': self._running,
+                'submitted': self._submitted,
+                'rejected': self._rejected,
+                'completed': self._completed,
+                'failed': self._failed,
+                'wait_seconds_avg': round(self._wait_total / started, 4) if started else 0.0,
+                'wait_seconds_max': round(self._wait_max, 4),
+            }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+inference_executor = InferenceExecutor()
+
+
+async def run_inference(fn, *args, **kwargs):
+    """Run a blocking inference call on the shared inference executor"""
+    return await inference_executor.run(fn, *args, **kwargs)
+
+
+async def run_inference_with_retry(fn, *args, **kwargs):
+    """Run a blocking inference call, waiting for a slot instead of failing when the queue is full
+
+    Meant for work already accepted in several parts, such as the pages of a
+    document, which should not be dropped halfway through.
+    """
+    while True:
+        try:
+            return await inference_executor.run(fn, *args, **kwargs)
+        except HTTPException as exc:
+            if exc.status_code != status.HTTP_503_SERVICE_UNAVAILABLE:
+                raise
+            await asyncio.sleep(INFERENCE_RETRY_AFTER)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Directory holding the job database, the uploaded documents and the artifacts, shared by the API and the workers
+JOB_DIR = os.environ.get("JOB_DIR", "./jobs")
+# Attempts of a job before it is marked as failed
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+# Seconds before a failed attempt is retried, multiplied by the number of attempts
+JOB_RETRY_DELAY = int(os.environ.get("JOB_RETRY_DELAY", "10"))
+# Seconds a worker may go without reporting progress before its job is handed to another worker
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "600"))
+# Seconds finished jobs and their artifacts are kept
+JOB_TTL = int(os.environ.get("JOB_TTL", "86400"))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATUSES = (SUCCEEDED, FAILED, CANCELLED)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    lang TEXT,
+    status TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    document_kind TEXT NOT NULL,
+    pages INTEGER NOT NULL,
+    pages_done INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    worker TEXT,
+    artifact TEXT,
+    created_at REAL NOT NULL,
+    available_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at);
+'''
+# Columns added since the first schema, added to existing databases
+_ADDED_COLUMNS = {'lang': 'TEXT'}
+
+
+class JobQueue:
+    """Persistent job queue in SQLite, shared by the API and the worker processes.
+
+    Each job owns a directory under `directory` holding its input document,
+    the NDJSON result of every page and the final artifact. A worker claims a
+    job under a lease it renews with each page, so a job whose worker died is
+    handed to another one once the lease expires, up to `max_attempts` times.
+    """
+
+    def __init__(self, directory=JOB_DIR, max_attempts=JOB_MAX_ATTEMPTS, lease_seconds=JOB_LEASE_SECONDS,
+                 ttl=JOB_TTL, retry_delay=JOB_RETRY_DELAY):
+        self.directory = os.path.abspath(directory)
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.ttl = ttl
+        self.retry_delay = retry_delay
+        self.db_path = os.path.join(self.directory, 'jobs.db')
+        self._initialized = False
+
+    @contextmanager
+    def _connect(self):
+        if not self._initialized:
+            os.makedirs(self.directory, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            if not self._initialized:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.executescript(_SCHEMA)
+                columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+                for column, definition in _ADDED_COLUMNS.items():
+                    if column not in columns:
+                        conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} {definition}')
+                self._initialized = True
+            yield conn
+        finally:
+            conn.close()
+
+    def job_dir(self, job_id):
+        return os.path.join(self.directory, job_id)
+
+    def pages_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), 'pages.ndjson')
+
+    def create_dir(self):
+        """Reserve a job id and its directory, before the input document is written into it"""
+        job_id = uuid.uuid4().hex
+        os.makedirs(self.job_dir(job_id))
+        return job_id, self.job_dir(job_id)
+
+    def discard_dir(self, job_id):
+        shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+    def submit(self, job_id, kind, filename, document, lang=None):
+        """Queue a job whose document was spooled into its directory
+
+        Args:
+            job_id (str): id returned by create_dir
+            kind (str): pipeline running the job, 'ocr', 'layout' or 'table'
+            filename (str): name of the uploaded file
+            document (PagedDocument): the spooled document
+            lang (str, optional): OCR language, the worker's OCR_LANGUAGE when not given
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, kind, lang, status, filename, document_kind, pages, max_attempts, created_at, '
+                'available_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, kind, lang, QUEUED, filename, document.kind, document.pages, self.max_attempts, now, now))
+        return self.get(job_id)
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def claim(self, worker):
+        """Take the oldest available job, or one whose worker stopped renewing its lease
+
+        Returns:
+            dict: the claimed job, None when there is nothing to do
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Jobs abandoned by a dead worker are cancelled or failed when they cannot be retried
+                conn.execute(
+                    'UPDATE jobs SET status = ?, finished_at = ? '
+                    'WHERE status = ? AND lease_until < ? AND cancel_requested = 1',
+                    (CANCELLED, now, RUNNING, now))
+                conn.execute(
+                    'UPDATE jobs SET status = ?, finished_at = ?, error = ? '
+                    'WHERE status = ? AND lease_until < ? AND attempts >= max_attempts',
+                    (FAILED, now, 'Worker stopped responding', RUNNING, now))
+                row = conn.execute(
+                    'SELECT id FROM jobs WHERE (status = ? AND available_at <= ?) OR (status = ? AND lease_until < ?) '
+                    'ORDER BY created_at LIMIT 1',
+                    (QUEUED, now, RUNNING, now)).fetchone()
+                if row is not None:
+                    conn.execute(
+                        'UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1, started_at = ?, '
+                        'lease_until = ?, pages_done = 0, error = NULL WHERE id = ?',
+                        (RUNNING, worker, now, now + self.lease_seconds, row['id']))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        return self.get(row['id']) if row is not None else None
+
+    # The methods below are called by the worker holding a claimed job. The attempt number
+    # it claimed fences off a worker whose lease expired and whose job was handed to another one.
+
+    def progress(self, job, pages_done):
+        """Record the pages done and renew the lease
+
+        Returns:
+            bool: False when the job was cancelled or handed to another worker and this one should stop
+        """
+        now = time.time()
+        with self._connect() as conn:
+            updated = conn.execute(
+                'UPDATE jobs SET pages_done = ?, lease_until = ? WHERE id = ? AND attempts = ? AND status = ?',
+                (pages_done, now + self.lease_seconds, job['id'], job['attempts'], RUNNING)).rowcount
+            row = conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job['id'],)).fetchone()
+        return bool(updated) and row is not None and not row['cancel_requested']
+
+    def succeed(self, job, artifact):
+        self._finish(job, SUCCEEDED, artifact=artifact)
+
+    def cancelled(self, job):
+        self._finish(job, CANCELLED)
+
+    def fail(self, job, error):
+        """Queue the job again after a delay, or mark it as failed once out of attempts"""
+        current = self.get(job['id'])
+        if current is None:
+            return
+        if current['attempts'] < current['max_attempts'] and not current['cancel_requested']:
+            with self._connect() as conn:
+                conn.execute(
+                    'UPDATE jobs SET status = ?, error = ?, worker = NULL, lease_until = NULL, available_at = ? '
+                    'WHERE id = ? AND attempts = ? AND status = ?',
+                    (QUEUED, error, time.time() + self.retry_delay * current['attempts'], job['id'],
+                     job['attempts'], RUNNING))
+        else:
+            self._finish(job, FAILED, error=error)
+
+    def _finish(self, job, status, artifact=None, error=None):
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE jobs SET status = ?, artifact = ?, error = ?, finished_at = ?, lease_until = NULL '
+                'WHERE id = ? AND attempts = ? AND status = ?',
+                (status, artifact, error, time.time(), job['id'], job['attempts'], RUNNING))
+
+    def cancel(self, job_id):
+        """Cancel a queued job right away, or ask the worker of a running job to stop
+
+        Returns:
+            dict: the job, None when it does not exist
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('UPDATE jobs SET status = ?, cancel_requested = 1, finished_at = ? WHERE id = ? AND status = ?',
+                         (CANCELLED, now, job_id, QUEUED))
+            conn.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?', (job_id, RUNNING))
+        return self.get(job_id)
+
+    def purge(self):
+        """Remove finished jobs older than the TTL with their files
+
+        Returns:
+            int: number of removed jobs
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT id FROM jobs WHERE status IN (?, ?, ?) AND finished_at < ?',
+                FINISHED_STATUSES + (time.time() - self.ttl,)).fetchall()
+            for row in rows:
+                conn.execute('DELETE FROM jobs WHERE id = ?', (row['id'],))
+        for row in rows:
+            self.discard_dir(row['id'])
+        if rows:
+            logger.info('Removed %d expired jobs', len(rows))
+        return len(rows)
+
+    def stats(self):
+        with self._connect() as conn:
+            rows = conn.execute('SELECT status, COUNT(*) AS count FROM jobs GROUP BY status').fetchall()
+        counts = {status: 0 for status in (QUEUED, RUNNING) + FINISHED_STATUSES}
+        counts.update({row['status']: row['count'] for row in rows})
+        return counts
+
+
+job_queue = JobQueue()
+
+
+def job_status(job):
+    """Public view of a job row"""
+    return {
+        'job_id': job['id'],
+        'kind': job['kind'],
+        'lang': job['lang'],
+        'status': job['status'],
+        'filename': job['filename'],
+        'pages': job['pages'],
+        'pages_done': job['pages_done'],
+        'attempts': job['attempts'],
+        'cancel_requested': bool(job['cancel_requested']),
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at'],
+        'expires_at': job['finished_at'] + job_queue.ttl if job['finished_at'] else None,
+    }
+
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import os
+import signal
+import time
+
+import cv2
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+
+from utils.InferenceExecutor import inference_executor
+from utils.MemoryHelper import private_memory_bytes
+from utils.Metrics import WORKER_RECYCLED, WORKER_WARM_UP_SECONDS
+from utils.ModelRegistry import PRELOAD_MODELS, acquire_model, registry
+
+logger = logging.getLogger(__name__)
+
+# Run one inference through each of the PRELOAD_MODELS before a worker reports ready
+WARM_UP_INFERENCE = os.environ.get("WARM_UP_INFERENCE", "true").lower() in ("1", "true", "yes")
+# Private memory in bytes above which a worker is replaced by the process manager, 0 disables it.
+# Only applies to workers started by gunicorn (gunicorn.conf.py), a single process is never stopped
+WORKER_MAX_MEMORY_BYTES = int(os.environ.get("WORKER_MAX_MEMORY_BYTES", "0"))
+# Seconds between two checks of the worker memory
+WORKER_MEMORY_CHECK_INTERVAL = float(os.environ.get("WORKER_MEMORY_CHECK_INTERVAL", "10"))
+
+
+def warm_up_page():
+    """Small synthetic page with a line of text and a ruled table, enough to run every engine once"""
+    img = np.full((480, 640, 3), 255, dtype=np.uint8)
+    cv2.putText(img, 'Warm up page', (40, 70), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 0), 2)
+    for row in range(5):
+        cv2.line(img, (40, 140 + row * 60), (600, 140 + row * 60), (0, 0, 0), 2)
+    for col in range(4):
+        cv2.line(img, (40 + col * 186, 140), (40 + col * 186, 380), (0, 0, 0), 2)
+    for row in range(4):
+        for col in range(3):
+            cv2.putText(img, f'cell {row}{col}', (56 + col * 186, 180 + row * 60), cv2.FONT_HERSHEY_SIMPLEX,
+                        0.8, (0, 0, 0), 2)
+    return img
+
+
+def _warm_up_model(name, img):
+    with acquire_model(name) as model:
+        if name == 'yolo':
+            model(img, verbose=False)
+        elif name == 'ocr':
+            model.ocr(img, cls=True)
+        else:
+            model(img)
+
+
+class WorkerLifecycle:
+    """Readiness of the serving process and its replacement when it grows too large.
+
+    A process is live as soon as it answers, and ready once the PRELOAD_MODELS
+    are loaded and, with WARM_UP_INFERENCE, have each run one inference on the
+    inference executor, so the first requests do not pay for lazy
+    initialization. Under gunicorn the models are loaded by the master before
+    it forks (see gunicorn.conf.py) and only the warm-up runs in each worker.
+
+    A worker whose private memory goes over `max_memory` stops reporting ready
+    and terminates itself gracefully, gunicorn then starts a fresh one.
+    """
+
+    def __init__(self, models=PRELOAD_MODELS, warm_up=WARM_UP_INFERENCE, max_memory=WORKER_MAX_MEMORY_BYTES,
+                 check_interval=WORKER_MEMORY_CHECK_INTERVAL):
+        self.models = list(models)
+        self.warm_up_inference = warm_up
+        self.max_memory = max_memory
+        self.check_interval = check_interval
+        # Set by forked(), a standalone process has nothing to replace it
+        self.managed = False
+        self.ready = False
+        self.draining = False
+        self.error = None
+        self.started_at = time.time()
+        self.warm_up_seconds = None
+
+    def forked(self):
+        """Called in each worker forked by gunicorn"""
+        self.managed = True
+        self.started_at = time.time()
+
+    async def warm_up(self):
+        """Load the PRELOAD_MODELS, run their warm-up inference, then report ready"""
+        start = time.perf_counter()
+        try:
+            if self.models:
+                await run_in_threadpool(registry.warm_up_hot, self.models)
+            if self.warm_up_inference:
+                img = warm_up_page()
+                for name in self.models:
+                    # On the inference threads, where the engines keep their per-thread state
+                    await inference_executor.run(_warm_up_model, name, img)
+        except Exception as exc:
+            logger.exception('Warm-up failed, the process does not report ready')
+            self.error = f'{type(exc).__name__}: {exc}'
+            return
+        self.warm_up_seconds = time.perf_counter() - start
+        WORKER_WARM_UP_SECONDS.set(self.warm_up_seconds)
+        self.ready = True
+        logger.info('Worker %d ready after a %.2fs warm-up', os.getpid(), self.warm_up_seconds)
+
+    async def watch_memory(self):
+        """Replace the worker once its private memory exceeds `max_memory`"""
+        if self.max_memory <= 0:
+            return
+        if not self.managed:
+            logger.warning('WORKER_MAX_MEMORY_BYTES only applies to workers started with gunicorn.conf.py')
+            return
+        while not self.draining:
+            await asyncio.sleep(self.check_interval)
+            used = private_memory_bytes()
+            if used > self.max_memory:
+                logger.warning('Worker %d uses %d bytes of private memory, above %d, recycling it',
+                               os.getpid(), used, self.max_memory)
+                self.draining = True
+                WORKER_RECYCLED.inc()
+                # Graceful shutdown: in-flight requests complete, then gunicorn forks a replacement
+                os.kill(os.getpid(), signal.SIGTERM)
+
+    def stats(self):
+        return {
+            'pid': os.getpid(),
+            'managed': self.managed,
+            'ready': self.ready and not self.draining,
+            'draining': self.draining,
+            'error': self.error,
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'warm_up_seconds': None if self.warm_up_seconds is None else round(self.warm_up_seconds, 3),
+            'private_memory_bytes': private_memory_bytes(),
+            'max_memory_bytes': self.max_memory,
+        }
+
+
+worker_lifecycle = WorkerLifecycle()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import os
+import resource
+import sys
+
+
+def current_rss_bytes() -> int:
+    """Resident set size of the current process in bytes
+
+    Reads /proc/self/statm on Linux and falls back to the peak RSS reported by
+    getrusage elsewhere.
+
+    Returns:
+        int: resident memory in bytes
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of the current process in bytes
+
+    Returns:
+        int: peak resident memory in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def private_memory_bytes() -> int:
+    """Memory of the current process that no other process shares, in bytes
+
+    Pages inherited copy-on-write from a preloading parent only count once
+    written to. Reads /proc/self/smaps_rollup on Linux and falls back to the
+    resident set size elsewhere.
+
+    Returns:
+        int: private clean and dirty memory in bytes
+    """
+    try:
+        total = 0
+        with open('/proc/self/smaps_rollup', 'r') as f:
+            for line in f:
+                if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                    total += int(line.split()[1]) * 1024
+        return total or current_rss_bytes()
+    except (OSError, ValueError, IndexError):
+        return current_rss_bytes()
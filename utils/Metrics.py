@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import contextvars
+import os
+import time
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY,
+                               generate_latest)
+
+# Add a Server-Timing header with the duration of each pipeline stage to every response
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+# Directory shared by the processes of a multi-process server, metrics are then aggregated across them
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR", "")
+
+# Stage buckets from a millisecond decode to a multi-second table recognition
+_STAGE_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+_SIZE_BUCKETS = (256, 512, 1024, 1536, 2048, 3072, 4096, 6144, 8192, 16384)
+
+STAGE_SECONDS = Histogram('ppstructure_stage_seconds', 'Duration of the stages of each pipeline',
+                          ['pipeline', 'stage'], buckets=_STAGE_BUCKETS)
+REQUEST_SECONDS = Histogram('ppstructure_http_request_seconds', 'Time to the response headers of HTTP requests',
+                            ['method', 'route', 'status'], buckets=_STAGE_BUCKETS)
+INFERENCE_QUEUE_DEPTH = Gauge('ppstructure_inference_queue_depth', 'Inference jobs waiting for a worker',
+                              multiprocess_mode='livesum')
+INFERENCE_RUNNING = Gauge('ppstructure_inference_running', 'Inference jobs running',
+                          multiprocess_mode='livesum')
+INFERENCE_WAIT_SECONDS = Histogram('ppstructure_inference_wait_seconds', 'Time inference jobs wait for a worker',
+                                   buckets=_STAGE_BUCKETS)
+INFERENCE_REJECTED = Counter('ppstructure_inference_rejected', 'Inference jobs rejected with a 503, queue full')
+MODEL_LOAD_SECONDS = Gauge('ppstructure_model_load_seconds', 'Load time of each loaded model',
+                           ['model', 'lang', 'replica'], multiprocess_mode='max')
+IMAGE_DECODE_SECONDS = Histogram('ppstructure_image_decode_seconds', 'Duration of image decoding',
+                                 buckets=_STAGE_BUCKETS)
+IMAGE_WIDTH = Histogram('ppstructure_image_width_pixels', 'Width of the decoded images', buckets=_SIZE_BUCKETS)
+IMAGE_HEIGHT = Histogram('ppstructure_image_height_pixels', 'Height of the decoded images', buckets=_SIZE_BUCKETS)
+IMAGE_BYTES = Counter('ppstructure_image_bytes', 'Encoded bytes of the decoded images')
+OPTIONAL_STAGES = Counter('ppstructure_optional_stages', 'Optional stages run or skipped, per page',
+                          ['stage', 'decision'])
+REGION_CACHE_LOOKUPS = Counter('ppstructure_region_cache_lookups', 'Region cache lookups per kind of region and outcome',
+                               ['kind', 'outcome'])
+WORKER_WARM_UP_SECONDS = Gauge('ppstructure_worker_warm_up_seconds', 'Longest warm-up of the running workers',
+                               multiprocess_mode='livemax')
+WORKER_RECYCLED = Counter('ppstructure_worker_recycled', 'Workers recycled for going over WORKER_MAX_MEMORY_BYTES')
+ADMISSION_ADMITTED = Counter('ppstructure_admission_admitted', 'Requests admitted per priority lane', ['lane'])
+ADMISSION_REJECTED = Counter('ppstructure_admission_rejected', 'Requests rejected with a 503 per priority lane and reason',
+                             ['lane', 'reason'])
+ADMISSION_WAIT_SECONDS = Histogram('ppstructure_admission_wait_seconds', 'Time admitted requests wait for compute budget',
+                                   ['lane'], buckets=_STAGE_BUCKETS)
+ADMISSION_IN_FLIGHT = Gauge('ppstructure_admission_in_flight_cost', 'Cost of the admitted requests being processed',
+                            ['lane'], multiprocess_mode='livesum')
+RATE_LIMITED = Counter('ppstructure_rate_limited', 'Requests rejected with a 429 per kind of client, API key or IP',
+                       ['client'])
+
+# Stage durations of the request being served, set by ServerTimingMiddleware
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def observe_image(img, nbytes, seconds):
+    """Record the size and decoding time of a decoded image
+
+    Args:
+        img (ndarray): decoded image, None when decoding failed
+        nbytes (int): size of the encoded image
+        seconds (float): decoding time
+    """
+    IMAGE_DECODE_SECONDS.observe(seconds)
+    IMAGE_BYTES.inc(nbytes)
+    if img is not None:
+        IMAGE_HEIGHT.observe(img.shape[0])
+        IMAGE_WIDTH.observe(img.shape[1])
+
+
+def metrics_payload():
+    """Prometheus exposition of the metrics, of every process when PROMETHEUS_MULTIPROC_DIR is set
+
+    Returns:
+        tuple: (body bytes, content type)
+    """
+    registry = REGISTRY
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def _server_timing(timings, total):
+    entries = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings]
+    entries.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(entries).encode('latin-1')
+
+
+class ServerTimingMiddleware:
+    """Records the latency of each request per route and status, and with SERVER_TIMING
+    lists the stages run before the response started in a Server-Timing header.
+
+    Stages of streamed responses that finish after the headers are only in the metrics.
+    """
+
+    def __init__(self, app, server_timing=SERVER_TIMING):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        timings = []
+        token = request_timings.set(timings)
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                total = time.perf_counter() - start
+                route = getattr(scope.get('route'), 'path', 'unmatched')
+                REQUEST_SECONDS.labels(scope['method'], route, str(message['status'])).observe(total)
+                if self.server_timing:
+                    headers = list(message.get('headers', []))
+                    headers.append((b'server-timing', _server_timing(list(timings), total)))
+                    message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_timings.reset(token)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """Groups concurrent single-item calls into batched calls.
+
+    Items submitted from any thread are collected until `max_batch_size` items
+    are waiting or `max_wait_ms` has passed since the first one arrived, then
+    `batch_fn` is called once with the list of items and must return one
+    result per item, in order. Each caller gets back its own result.
+
+    Callers block until their result is ready, so with at most `max_callers`
+    threads submitting, a batch holding that many items cannot grow and runs
+    right away. With a single caller the items run inline, without waiting.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=5.0, name='batcher', max_callers=None):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(int(max_batch_size), 1)
+        if max_callers is not None:
+            self.max_batch_size = min(self.max_batch_size, max(int(max_callers), 1))
+        self.max_wait = max(float(max_wait_ms), 0.0) / 1000
+        self.name = name
+        self._queue = queue.Queue()
+        # Started on first use so forked workers never inherit a parent's thread
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._max_seen = 0
+
+    def submit(self, item) -> Future:
+        future = Future()
+        if self.max_batch_size == 1:
+            # Batching disabled or a single caller, run inline on the calling thread
+            self._run_batch([(item, future)])
+            return future
+
+        self._ensure_thread()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item):
+        """Submit `item` and block until its result is ready"""
+        return self.submit(item).result()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'name': self.name,
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'batches': self._batches,
+                'items': self._items,
+                'avg_batch_size': round(self._items / self._batches, 2) if self._batches else 0.0,
+                'max_batch_seen': self._max_seen,
+                'pending': self._queue.qsize(),
+            }
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._thread_lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                    self._thread.start()
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining <= 0:
+                        # Still take whatever is already waiting, without blocking
+                        batch.append(self._queue.get_nowait())
+                    else:
+                        batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        items = [item for item, _ in batch]
+        with self._stats_lock:
+            self._batches += 1
+            self._items += len(items)
+            self._max_seen = max(self._max_seen, len(items))
+        try:
+            results = self.batch_fn(items)
+            if len(results) != len(items):
+                raise RuntimeError(f'{self.name} returned {len(results)} results for {len(items)} items')
+        except BaseException as e:
+            logger.exception('%s batch of %d items failed', self.name, len(items))
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+from fastapi import HTTPException, status
+
+from utils.EngineBackend import ENGINE_BACKEND, backend_name, build_engine
+from utils.MemoryHelper import current_rss_bytes
+from utils.Metrics import MODEL_LOAD_SECONDS
+
+logger = logging.getLogger(__name__)
+
+OCR_LANGUAGE = os.environ.get("OCR_LANGUAGE", "en")
+YOLO_MODEL_PATH = os.environ.get("YOLO_MODEL_PATH", "models/yolov8n-layout.onnx")
+# Overrides the model version used in result cache keys, e.g. a release tag
+MODEL_VERSION = os.environ.get("MODEL_VERSION", "")
+# Number of tables of one page recognized at the same time, each needs its own table engine
+TABLE_PARALLELISM = int(os.environ.get("TABLE_PARALLELISM", "2"))
+# Comma separated model names loaded at startup, e.g. "yolo,ocr,layout,table"
+PRELOAD_MODELS = [name.strip() for name in os.environ.get("PRELOAD_MODELS", "").split(",") if name.strip()]
+# Comma separated languages whose PRELOAD_MODELS are loaded at startup and never evicted, besides OCR_LANGUAGE
+HOT_LANGUAGES = [lang.strip() for lang in os.environ.get("HOT_LANGUAGES", "").split(",") if lang.strip()]
+# Comma separated languages requests may ask for, any PaddleOCR language when empty
+OCR_LANGUAGES = [lang.strip() for lang in os.environ.get("OCR_LANGUAGES", "").split(",") if lang.strip()]
+# Most engine instances loaded at once, idle engines of other languages are evicted least recently used first.
+# 0 means no limit
+MAX_RESIDENT_ENGINES = int(os.environ.get("MAX_RESIDENT_ENGINES", "0"))
+
+
+def _load_yolo(lang):
+    from ultralytics import YOLO
+    return YOLO(YOLO_MODEL_PATH, task='detect')
+
+
+def _load_ocr(lang):
+    from paddleocr import PaddleOCR
+    return build_engine(PaddleOCR, use_angle_cls=True, lang=lang)
+
+
+def _load_layout(lang):
+    from paddleocr import PPStructure
+    return build_engine(PPStructure, recovery=True, lang=lang)
+
+
+def _load_table(lang):
+    from paddleocr import PPStructure
+    return build_engine(PPStructure, lang=lang, layout=False)
+
+
+MODEL_LOADERS = {
+    'yolo': _load_yolo,
+    'ocr': _load_ocr,
+    'layout': _load_layout,
+    'table': _load_table,
+}
+
+# Models whose weights do not depend on the OCR language share a single instance
+LANGUAGE_AGNOSTIC_MODELS = {'yolo'}
+# Models created by build_engine, whose predictors are onnxruntime sessions with ENGINE_BACKEND=onnx
+ENGINE_MODELS = {'ocr', 'layout', 'table'}
+
+
+def fork_safe_models(names):
+    """The models of `names` that can be loaded in a process before it forks
+
+    onnxruntime starts the thread pools of a session when it creates it, and a
+    forked process does not inherit threads, so with ENGINE_BACKEND=onnx the
+    PaddleOCR engines are left for each worker to load.
+    """
+    if ENGINE_BACKEND != 'onnx':
+        return list(names)
+    return [name for name in names if name not in ENGINE_MODELS]
+
+
+@lru_cache(maxsize=None)
+def model_language(lang):
+    """Language of the PaddleOCR recognition model used for `lang`, e.g. 'latin' for 'fr' and 'de'
+
+    Raises:
+        ValueError: for languages PaddleOCR does not support
+    """
+    from paddleocr.paddleocr import parse_lang
+
+    try:
+        return parse_lang(lang)[0]
+    except AssertionError:
+        raise ValueError(f'Unsupported OCR language: {lang}')
+
+
+def resolve_language(lang=None):
+    """OCR language of a request, OCR_LANGUAGE when not given
+
+    Languages sharing a recognition model resolve to the same one, so they share
+    engines and cached results.
+
+    Raises:
+        HTTPException: 400 for languages PaddleOCR does not support or not in OCR_LANGUAGES
+    """
+    if lang and OCR_LANGUAGES and lang not in OCR_LANGUAGES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Supported languages are {', '.join(OCR_LANGUAGES)}"
+        )
+    try:
+        return model_language(lang or OCR_LANGUAGE)
+    except ValueError as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc))
+
+
+class ModelEntry:
+    """A loaded engine together with its load statistics."""
+
+    def __init__(self, name, lang, model, load_seconds, rss_bytes, replica=0):
+        self.name = name
+        self.lang = lang
+        self.model = model
+        self.load_seconds = load_seconds
+        self.rss_bytes = rss_bytes
+        self.replica = replica
+        self.loaded_at = time.time()
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'lang': self.lang,
+            'replica': self.replica,
+            'load_seconds': round(self.load_seconds, 3),
+            'rss_bytes': self.rss_bytes,
+            'loaded_at': self.loaded_at,
+        }
+
+
+class EnginePool:
+    """Up to `max_size` interchangeable instances of one engine.
+
+    Engines are not thread-safe, each instance is checked out by one thread at
+    a time. Extra instances are only loaded when every existing one is busy.
+    An evicted pool is closed, callers get a new one from the registry.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max(max_size, 1)
+        self.entries = []
+        self.last_used = time.monotonic()
+        self.closed = False
+        self._free = []
+        self._loading = 0
+        self._cond = threading.Condition()
+
+    @property
+    def resident(self):
+        return len(self.entries) + self._loading
+
+    def checkout(self, load):
+        with self._cond:
+            while True:
+                if self.closed:
+                    raise PoolClosed()
+                self.last_used = time.monotonic()
+                if self._free:
+                    return self._free.pop()
+                if len(self.entries) + self._loading < self.max_size:
+                    replica = len(self.entries) + self._loading
+                    self._loading += 1
+                    break
+                self._cond.wait()
+        try:
+            entry = load(replica)
+        except BaseException:
+            with self._cond:
+                self._loading -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._loading -= 1
+            self.entries.append(entry)
+        return entry
+
+    def checkin(self, entry):
+        with self._cond:
+            self._free.append(entry)
+            self._cond.notify()
+
+    def close_if_idle(self):
+        """Close the pool when none of its engines is in use
+
+        Returns:
+            bool: whether the pool was closed, its engines can then be released
+        """
+        with self._cond:
+            if self.closed or self._loading or len(self._free) != len(self.entries):
+                return False
+            self.closed = True
+            self._cond.notify_all()
+            return True
+
+
+class PoolClosed(Exception):
+    """The engine pool was evicted while waiting for an instance"""
+
+
+class ModelRegistry:
+    """Process-wide, lazily populated store of inference engines.
+
+    Each engine is created on first use and shared by every router, one
+    instance per (model name, language) key, or up to `replicas[name]`
+    instances for engines that are used from several threads at once.
+
+    With `max_resident` set, loading an engine first evicts the least recently
+    used idle pools until the number of loaded instances fits. Language
+    agnostic models and the `hot_languages` are never evicted.
+    """
+
+    def __init__(self, loaders, default_lang=OCR_LANGUAGE, replicas=None, max_resident=MAX_RESIDENT_ENGINES,
+                 hot_languages=HOT_LANGUAGES):
+        self._loaders = loaders
+        self._default_lang = default_lang
+        self._replicas = replicas or {}
+        self.max_resident = max_resident
+        self._hot_languages = {default_lang, *hot_languages}
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        # Loads are serialized so the resident memory delta can be attributed to one model
+        self._load_lock = threading.Lock()
+        self._evictions = 0
+
+    def key(self, name, lang=None):
+        if name not in self._loaders:
+            raise KeyError(f'Unknown model: {name}')
+        if name in LANGUAGE_AGNOSTIC_MODELS:
+            return name, None
+        return name, model_language(lang or self._default_lang)
+
+    def _pinned(self, key):
+        name, lang = key
+        return name in LANGUAGE_AGNOSTIC_MODELS or lang in {model_language(hot) for hot in self._hot_languages}
+
+    def _pool(self, key) -> EnginePool:
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._pools_lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = EnginePool(self._replicas.get(key[0], 1))
+                    self._pools[key] = pool
+        return pool
+
+    def _checkout(self, key):
+        while True:
+            pool = self._pool(key)
+            try:
+                return pool, pool.checkout(lambda replica: self._load(*key, replica=replica))
+            except PoolClosed:
+                continue
+
+    def entry(self, name, lang=None) -> ModelEntry:
+        """First instance of the engine, loaded if needed"""
+        key = self.key(name, lang)
+        pool = self._pool(key)
+        if pool.entries:
+            return pool.entries[0]
+        pool, entry = self._checkout(key)
+        pool.checkin(entry)
+        return entry
+
+    def get(self, name, lang=None):
+        return self.entry(name, lang).model
+
+    @contextmanager
+    def acquire(self, name, lang=None):
+        pool, entry = self._checkout(self.key(name, lang))
+        try:
+            yield entry.model
+        finally:
+            pool.checkin(entry)
+
+    def _make_room(self, key):
+        """Evict idle pools, least recently used first, until the engine being loaded fits under max_resident"""
+        if self.max_resident <= 0:
+            return
+        with self._pools_lock:
+            resident = sum(pool.resident for pool in self._pools.values())
+            candidates = sorted(
+                ((pool.last_used, pool_key, pool) for pool_key, pool in self._pools.items()
+                 if pool_key != key and not self._pinned(pool_key)),
+                key=lambda candidate: candidate[0]
+            )
+            for _, pool_key, pool in candidates:
+                # The engine being loaded is already counted
+                if resident <= self.max_resident:
+                    break
+                if pool.close_if_idle():
+                    del self._pools[pool_key]
+                    resident -= len(pool.entries)
+                    self._evictions += 1
+                    logger.info('Evicted model %s (lang=%s), %d instances', pool_key[0], pool_key[1],
+                                len(pool.entries))
+        if resident > self.max_resident:
+            logger.warning('Loading model %s (lang=%s) above MAX_RESIDENT_ENGINES, no idle engine can be evicted',
+                           *key)
+
+    def is_loaded(self, name, lang=None):
+        pool = self._pools.get(self.key(name, lang))
+        return pool is not None and bool(pool.entries)
+
+    def warm_up(self, names, lang=None):
+        for name in names:
+            self.entry(name, lang)
+
+    def warm_up_hot(self, names):
+        """Load `names` for the default language and every hot language"""
+        self.warm_up(names)
+        for lang in self._hot_languages - {self._default_lang}:
+            self.warm_up([name for name in names if name not in LANGUAGE_AGNOSTIC_MODELS], lang)
+
+    def stats(self):
+        return [entry.stats() for pool in list(self._pools.values()) for entry in list(pool.entries)]
+
+    def pool_stats(self):
+        with self._pools_lock:
+            pools = list(self._pools.items())
+        return {
+            'max_resident': self.max_resident,
+            'resident': sum(pool.resident for _, pool in pools),
+            'evictions': self._evictions,
+            'pools': [
+                {'name': name, 'lang': lang, 'instances': len(pool.entries), 'pinned': self._pinned((name, lang)),
+                 'idle_seconds': round(time.monotonic() - pool.last_used, 1)}
+                for (name, lang), pool in pools
+            ],
+        }
+
+    def _load(self, name, lang, replica=0):
+        self._make_room((name, lang))
+        with self._load_lock:
+            rss_before = current_rss_bytes()
+            start = time.perf_counter()
+            model = self._loaders[name](lang)
+            load_seconds = time.perf_counter() - start
+            rss_bytes = max(current_rss_bytes() - rss_before, 0)
+        MODEL_LOAD_SECONDS.labels(name, lang or '', str(replica)).set(load_seconds)
+        logger.info('Loaded model %s (lang=%s, replica %d) in %.2fs, +%d bytes RSS',
+                    name, lang, replica, load_seconds, rss_bytes)
+        return ModelEntry(name, lang, model, load_seconds, rss_bytes, replica)
+
+
+registry = ModelRegistry(MODEL_LOADERS, replicas={'table': TABLE_PARALLELISM})
+
+_models_version = None
+
+
+def models_version():
+    """Identifier of the deployed model weights, changes whenever cached results become stale"""
+    global _models_version
+    if _models_version is None:
+        if MODEL_VERSION:
+            _models_version = MODEL_VERSION
+        else:
+            from importlib.metadata import PackageNotFoundError, version
+            try:
+                paddleocr_version = version('paddleocr')
+            except PackageNotFoundError:
+                paddleocr_version = 'unknown'
+            try:
+                yolo_stat = os.stat(YOLO_MODEL_PATH)
+                yolo_version = f'{yolo_stat.st_size}-{int(yolo_stat.st_mtime)}'
+            except OSError:
+                yolo_version = 'missing'
+            _models_version = f'paddleocr-{paddleocr_version}|{backend_name()}|yolo-{yolo_version}'
+    return _models_version
+
+
+def get_model(name, lang=None):
+    """Return the shared engine for `name`, loading it on first use
+
+    Args:
+        name (str): one of "yolo", "ocr", "layout" or "table"
+        lang (str, optional): OCR language, defaults to OCR_LANGUAGE
+
+    Returns:
+        _type_: the engine instance
+    """
+    return registry.get(name, lang)
+
+
+def acquire_model(name, lang=None):
+    """Context manager giving exclusive use of one instance of the shared engine `name`
+
+    Engines are not thread-safe, every inference call made from an executor
+    thread must go through this.
+    """
+    return registry.acquire(name, lang)
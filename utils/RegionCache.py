@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import pickle
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+from utils.Metrics import REGION_CACHE_LOOKUPS
+from utils.ModelRegistry import OCR_LANGUAGE, models_version
+from utils.ResultCache import LRUStore
+
+logger = logging.getLogger(__name__)
+
+# Memory budget of the region cache in bytes, 0 disables it
+REGION_CACHE_BYTES = int(os.environ.get("REGION_CACHE_BYTES", str(64 * 1024 ** 2)))
+# Most differing bits between the 64-bit hashes of a region and of a cached one of the same size, noise
+# flips the bits of blank areas where neighbouring pixels are equally bright
+REGION_CACHE_MAX_DISTANCE = int(os.environ.get("REGION_CACHE_MAX_DISTANCE", "16"))
+# Largest difference in gray levels at any pixel between the thumbnails of a region and of a cached one
+# for the cached result to be reused
+REGION_CACHE_TOLERANCE = int(os.environ.get("REGION_CACHE_TOLERANCE", "24"))
+
+# Longest side of the grayscale thumbnail stored with each entry to verify hash matches, a changed
+# figure on a line of text still changes some of its pixels by far more than scanner noise does
+_THUMBNAIL_SIDE = 64
+# Regions whose sizes differ by less than this many pixels share a bucket, layout boxes move by a pixel or two
+_SIZE_STEP = 4
+# Most distinct regions kept per bucket, least recently used first out
+_BUCKET_VARIANTS = 16
+# Time spent in the skipped models, reported by the engines wrapped by cached_structure on a hit
+_TEXT_SYSTEM_TIMES = ('det', 'rec', 'cls', 'all')
+_TABLE_SYSTEM_TIMES = ('table', 'match', 'det', 'rec')
+
+# Stats counter of each lookup outcome
+_OUTCOMES = {'hit': 'hits', 'miss': 'misses', 'mismatch': 'mismatches'}
+
+RegionFingerprint = namedtuple('RegionFingerprint', ['bucket', 'kind', 'hash', 'thumbnail'])
+
+
+def region_thumbnail(crop):
+    """Grayscale thumbnail of a region, _THUMBNAIL_SIDE pixels on its longest side and at least 8 on the other"""
+    # Sampling every step-th pixel first keeps 4x4 pixels averaged per thumbnail pixel at a fraction of the cost
+    step = max(max(crop.shape[:2]) // (4 * _THUMBNAIL_SIDE), 1)
+    if step > 1:
+        crop = np.ascontiguousarray(crop[::step, ::step])
+    gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY) if crop.ndim == 3 else crop
+    h, w = gray.shape[:2]
+    scale = _THUMBNAIL_SIDE / max(h, w)
+    size = (max(int(round(w * scale)), 8), max(int(round(h * scale)), 8))
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+
+def dhash(thumbnail):
+    """64-bit difference hash: whether each pixel of a 9x8 reduction is brighter than its right neighbour"""
+    small = cv2.resize(thumbnail, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return int.from_bytes(np.packbits(small[:, 1:] > small[:, :-1]).tobytes(), 'big')
+
+
+def _thumbnail_difference(a, b):
+    if a.shape != b.shape:
+        return 255
+    return int(np.abs(a.astype(np.int16) - b.astype(np.int16)).max())
+
+
+class RegionCache:
+    """Recognition results of cropped regions, matched on a perceptual hash of their pixels.
+
+    Forms sharing a template repeat the same headers, footers and table
+    headers on every page. Regions of the same kind and size share a bucket
+    of the LRUStore; a region whose difference hash (dHash) is within
+    `max_distance` bits of a cached one in its bucket, and whose thumbnail is
+    within `tolerance` gray levels of it, reuses its result instead of being
+    recognized again. The hash distance absorbs scanner noise in blank areas,
+    the thumbnail check rejects different content that hashes alike. Results
+    are in the coordinates of the crop, so they hold wherever the region sits
+    on the page.
+    """
+
+    def __init__(self, max_bytes=REGION_CACHE_BYTES, max_distance=REGION_CACHE_MAX_DISTANCE,
+                 tolerance=REGION_CACHE_TOLERANCE):
+        self.enabled = max_bytes > 0
+        self.max_distance = max_distance
+        self.tolerance = tolerance
+        self.store = LRUStore(max_bytes)
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def fingerprint(self, kind, crop, scope=''):
+        """Hash of a crop for the results of `kind` computed with `scope`, None for empty crops"""
+        if crop is None or crop.size == 0:
+            return None
+        thumbnail = region_thumbnail(crop)
+        h, w = crop.shape[:2]
+        bucket = f'{kind}|{scope}|{models_version()}|{w // _SIZE_STEP}x{h // _SIZE_STEP}'
+        return RegionFingerprint(bucket, kind, dhash(thumbnail), thumbnail)
+
+    def _count(self, kind, outcome):
+        REGION_CACHE_LOOKUPS.labels(kind, outcome).inc()
+        with self._lock:
+            counts = self._counts.setdefault(kind, dict.fromkeys(_OUTCOMES.values(), 0))
+            counts[_OUTCOMES[outcome]] += 1
+
+    def _match(self, variants, fingerprint):
+        """Index of the cached region matching `fingerprint`, and whether any was close enough in hash"""
+        close = False
+        for i, (region_hash, thumbnail, _) in enumerate(variants):
+            if bin(region_hash ^ fingerprint.hash).count('1') > self.max_distance:
+                continue
+            close = True
+            if _thumbnail_difference(thumbnail, fingerprint.thumbnail) <= self.tolerance:
+                return i, close
+        return None, close
+
+    def get(self, fingerprint):
+        """Cached result of a region, a fresh copy the caller may modify, None on a miss"""
+        if not self.enabled or fingerprint is None:
+            return None
+        with self._lock:
+            variants = self.store.get(fingerprint.bucket) or []
+            i, close = self._match(variants, fingerprint)
+            if i is not None:
+                # Most recently used first, the bucket keeps the regions every page repeats
+                variants.insert(0, variants.pop(i))
+        if i is None:
+            # A close hash whose thumbnail differs is different content that hashes alike
+            self._count(fingerprint.kind, 'mismatch' if close else 'miss')
+            return None
+        self._count(fingerprint.kind, 'hit')
+        return pickle.loads(variants[0][2])
+
+    def put(self, fingerprint, result):
+        if not self.enabled or fingerprint is None:
+            return
+        try:
+            payload = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            logger.warning('Result of a %s region cannot be cached', fingerprint.kind, exc_info=True)
+            return
+        with self._lock:
+            variants = list(self.store.get(fingerprint.bucket) or [])
+            i, _ = self._match(variants, fingerprint)
+            if i is not None:
+                variants.pop(i)
+            variants = [(fingerprint.hash, fingerprint.thumbnail, payload)] + variants[:_BUCKET_VARIANTS - 1]
+            size = len(fingerprint.bucket) + sum(len(entry[2]) + entry[1].nbytes for entry in variants)
+            self.store.put(fingerprint.bucket, variants, size)
+
+    def stats(self):
+        with self._lock:
+            kinds = {kind: dict(counts) for kind, counts in self._counts.items()}
+        hits = sum(counts['hits'] for counts in kinds.values())
+        lookups = sum(sum(counts.values()) for counts in kinds.values())
+        for counts in kinds.values():
+            total = sum(counts.values())
+            counts['hit_rate'] = round(counts['hits'] / total, 4) if total else 0.0
+        return {
+            'enabled': self.enabled,
+            'hits': hits,
+            'lookups': lookups,
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+            'kinds': kinds,
+            'buckets': len(self.store),
+            'bytes': self.store.size,
+            'max_bytes': self.store.max_bytes,
+            'evictions': self.store.evictions,
+        }
+
+
+region_cache = RegionCache()
+
+
+def cached_regions(kind, crops, recognize, lang=None, scope=''):
+    """Results of several crops, only the crops missing from the region cache are recognized
+
+    Args:
+        kind (str): what `recognize` computes, e.g. "text"
+        crops (list): BGR ndarrays
+        recognize (callable): blocking function recognizing a list of crops, called once for the misses
+        lang (str, optional): OCR language, defaults to OCR_LANGUAGE
+        scope (str): settings of `recognize` that change its results
+
+    Returns:
+        list: one result per crop
+    """
+    if not region_cache.enabled:
+        return recognize(crops)
+    scope = f'{lang or OCR_LANGUAGE}|{scope}'
+    fingerprints = [region_cache.fingerprint(kind, crop, scope) for crop in crops]
+    results = [region_cache.get(fingerprint) for fingerprint in fingerprints]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        for i, result in zip(missing, recognize([crops[i] for i in missing])):
+            results[i] = result
+            region_cache.put(fingerprints[i], result)
+    return results
+
+
+class _CachedTextSystem:
+    """Text system of a PPStructure engine reusing the results of the regions found in the region cache"""
+
+    def __init__(self, text_system, scope):
+        self.text_system = text_system
+        self.scope = scope
+
+    def __getattr__(self, name):
+        return getattr(self.text_system, name)
+
+    def __call__(self, img, cls=True):
+        fingerprint = region_cache.fingerprint('structure-text', img, f'{self.scope}|{int(cls)}')
+        cached = region_cache.get(fingerprint)
+        if cached is not None:
+            return cached[0], cached[1], dict.fromkeys(_TEXT_SYSTEM_TIMES, 0)
+        boxes, recs, times = self.text_system(img, cls)
+        region_cache.put(fingerprint, (boxes, recs))
+        return boxes, recs, times
+
+
+class _CachedTableSystem:
+    """Table system of a PPStructure engine reusing the structure of the tables found in the region cache"""
+
+    def __init__(self, table_system, scope):
+        self.table_system = table_system
+        self.scope = scope
+
+    def __getattr__(self, name):
+        return getattr(self.table_system, name)
+
+    def __call__(self, img, return_ocr_result_in_table=False):
+        fingerprint = region_cache.fingerprint('table', img, f'{self.scope}|{int(return_ocr_result_in_table)}')
+        cached = region_cache.get(fingerprint)
+        if cached is not None:
+            return cached, dict.fromkeys(_TABLE_SYSTEM_TIMES, 0)
+        result, times = self.table_system(img, return_ocr_result_in_table)
+        region_cache.put(fingerprint, result)
+        return result, times
+
+
+@contextmanager
+def cached_structure(engine, name, lang=None):
+    """Run a checked out PPStructure engine with the region cache in front of its table and text systems
+
+    Tables are always recognized on their crop. In recovery mode the text of
+    a region is recognized on a page-sized canvas rather than its crop and is
+    not cached. The engine settings are restored on exit.
+    """
+    if not region_cache.enabled:
+        yield engine
+        return
+    scope = f'{name}|{lang or OCR_LANGUAGE}'
+    saved = engine.text_system, engine.table_system
+    if engine.text_system is not None and not getattr(engine, 'recovery', False):
+        engine.text_system = _CachedTextSystem(engine.text_system, scope)
+    if engine.table_system is not None:
+        engine.table_system = _CachedTableSystem(engine.table_system, scope)
+    try:
+        yield engine
+    finally:
+        engine.text_system, engine.table_system = saved
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+from fastapi.concurrency import run_in_threadpool
+
+from utils.Admission import admit, image_cost
+from utils.InferenceExecutor import run_inference
+from utils.ModelRegistry import OCR_LANGUAGE, models_version
+
+logger = logging.getLogger(__name__)
+
+# Memory budget of the in-process tier in bytes, 0 disables the cache
+RESULT_CACHE_BYTES = int(os.environ.get("RESULT_CACHE_BYTES", str(256 * 1024 ** 2)))
+# Directory of the optional on-disk tier, empty disables it
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "")
+# Size budget of the on-disk tier in bytes
+RESULT_CACHE_DISK_BYTES = int(os.environ.get("RESULT_CACHE_DISK_BYTES", str(2 * 1024 ** 3)))
+
+
+class LRUStore:
+    """Thread-safe LRU mapping bounded by the total size of its values in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self._data[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DiskStore:
+    """Pickled entries in a directory, oldest files removed when over the size budget."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                payload = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)  # Keep recently used entries from being evicted first
+        except OSError:
+            pass
+        return payload
+
+    def put(self, key, payload):
+        if len(payload) > self.max_bytes:
+            return
+        # Write then rename so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            self.size += len(payload)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.name.endswith('.pkl')),
+                         key=lambda entry: entry.stat().st_mtime)
+        self.size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self.size -= size
+            self.evictions += 1
+
+
+class ResultCache:
+    """Content-addressed cache of raw engine output.
+
+    Entries are keyed on a hash of the image bytes, the endpoint, the OCR
+    language and the model versions, and hold the pickled engine output so a
+    hit can be rendered into any output format without running inference.
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_BYTES, directory=RESULT_CACHE_DIR, disk_bytes=RESULT_CACHE_DISK_BYTES):
+        self.enabled = max_bytes > 0
+        self.memory = LRUStore(max_bytes)
+        self.disk = DiskStore(directory, disk_bytes) if self.enabled and directory else None
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+
+    def key(self, endpoint, data, lang=None):
+        digest = hashlib.blake2b(data, digest_size=20).hexdigest()
+        scope = f'{endpoint}|{lang or OCR_LANGUAGE}|{models_version()}'
+        return digest + '-' + hashlib.blake2b(scope.encode('utf-8'), digest_size=8).hexdigest()
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        payload = self.memory.get(key)
+        if payload is not None:
+            with self._lock:
+                self._hits += 1
+            return pickle.loads(payload)
+
+        if self.disk is not None:
+            payload = self.disk.get(key)
+            if payload is not None:
+                self.memory.put(key, payload, len(payload))
+                with self._lock:
+                    self._disk_hits += 1
+                return pickle.loads(payload)
+
+        with self._lock:
+            self._misses += 1
+        return None
+
+    def put(self, key, result):
+        if not self.enabled:
+            return
+        try:
+            payload = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            logger.warning('Result for %s cannot be cached', key, exc_info=True)
+            return
+        self.memory.put(key, payload, len(payload))
+        if self.disk is not None:
+            try:
+                self.disk.put(key, payload)
+            except OSError:
+                logger.warning('Failed to write %s to the disk cache', key, exc_info=True)
+
+    def stats(self):
+        with self._lock:
+            hits, disk_hits, misses = self._hits, self._disk_hits, self._misses
+        lookups = hits + disk_hits + misses
+        return {
+            'enabled': self.enabled,
+            'hits': hits,
+            'disk_hits': disk_hits,
+            'misses': misses,
+            'hit_rate': round((hits + disk_hits) / lookups, 4) if lookups else 0.0,
+            'memory_entries': len(self.memory),
+            'memory_bytes': self.memory.size,
+            'memory_max_bytes': self.memory.max_bytes,
+            'memory_evictions': self.memory.evictions,
+            'disk_bytes': self.disk.size if self.disk is not None else 0,
+            'disk_max_bytes': self.disk.max_bytes if self.disk is not None else 0,
+            'disk_evictions': self.disk.evictions if self.disk is not None else 0,
+        }
+
+
+result_cache = ResultCache()
+
+
+async def admitted_inference(data, fn, *args, **kwargs):
+    """Run `fn` on the inference executor once the cost of `data` is admitted against the compute budget
+
+    Raises:
+        HTTPException: 503 when the request is not admitted or the inference queue is full
+    """
+    async with admit(image_cost(data)):
+        return await run_inference(fn, *args, **kwargs)
+
+
+async def cached_result(endpoint, data, lang=None):
+    """Look up the cached engine output for `data`
+
+    Returns:
+        tuple: (cache key, None when the cache is disabled; cached result or None)
+    """
+    if not result_cache.enabled:
+        return None, None
+    key = result_cache.key(endpoint, data, lang)
+    return key, await run_in_threadpool(result_cache.get, key)
+
+
+async def cached_inference(endpoint, data, fn, *args, lang=None, **kwargs):
+    """Return the cached engine output for `data`, running `fn` on the inference executor on a miss
+
+    Cache hits never wait for an inference slot, misses are admitted against the compute budget
+    (see utils/Admission.py) first.
+
+    Args:
+        endpoint (str): name of the pipeline producing the result
+        data (bytes): encoded image the result is computed from
+        fn (callable): blocking function computing the raw engine output
+        lang (str, optional): OCR language, defaults to OCR_LANGUAGE
+    """
+    key, result = await cached_result(endpoint, data, lang)
+    if result is None:
+        result = await admitted_inference(data, fn, *args, **kwargs)
+        if key is not None:
+            await run_in_threadpool(result_cache.put, key, result)
+    return result
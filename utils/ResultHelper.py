@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import base64
+
+import numpy as np
+
+
+def _plain(value):
+    # numpy scalars and arrays coming out of the engines are not JSON serializable
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    return value
+
+
+def ocr_lines(result):
+    """Flatten a PaddleOCR.ocr result into text lines
+
+    Args:
+        result (list): result in the format of PaddleOCR.ocr
+
+    Returns:
+        list: {'text', 'confidence', 'box'} per recognized line
+    """
+    lines = []
+    for page in result or []:
+        for box, (text, score) in page or []:
+            lines.append({'text': text, 'confidence': float(score), 'box': _plain(box)})
+    return lines
+
+
+def ocr_text(result):
+    """Recognized text of a PaddleOCR.ocr result, lines separated by a space"""
+    return ' '.join(line['text'] for line in ocr_lines(result))
+
+
+def layout_regions(regions):
+    """JSON friendly copy of PPStructure regions, without the region crops
+
+    Args:
+        regions (list): regions returned by the PPStructure engine
+
+    Returns:
+        list: {'type', 'bbox', 'res'} per region, with 'layout' once sorted
+    """
+    regions_json = []
+    for region in regions:
+        region_json = {'type': region['type'], 'bbox': _plain(region['bbox']), 'res': _plain(region['res'])}
+        if 'layout' in region:
+            region_json['layout'] = region['layout']  # single or double column, set by sorted_layout_boxes
+        regions_json.append(region_json)
+    return regions_json
+
+
+def table_results(tables):
+    """JSON friendly recognized tables
+
+    Args:
+        tables (list): one recognized table or None per detected box
+
+    Returns:
+        list: {'bbox', 'html', 'cell_bbox'} per detected table, html and cells are None where no
+        structure was found
+    """
+    return [
+        {
+            'bbox': _plain(table.get('bbox')) if table is not None else None,
+            'html': table['html'] if table is not None else None,
+            'cell_bbox': _plain(table.get('cell_bbox')) if table is not None else None,
+        }
+        for table in tables
+    ]
+
+
+def encode_artifact(filename, media_type, buffer):
+    """Generated file embedded in a JSON response
+
+    Args:
+        filename (str): attachment name
+        media_type (str): media type of the file
+        buffer (io.BytesIO): the file
+
+    Returns:
+        dict: {'filename', 'media_type', 'content'} with the content in base64
+    """
+    return {
+        'filename': filename,
+        'media_type': media_type,
+        'content': base64.b64encode(buffer.getvalue()).decode('ascii'),
+    }
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+from utils.ImagePreprocess import estimate_orientation
+from utils.Metrics import OPTIONAL_STAGES
+
+# Angle classification of the text lines: "auto" only runs it on pages the orientation estimate does not
+# find upright and straight, "always" or "never"
+ANGLE_CLS = os.environ.get("ANGLE_CLS", "auto").lower()
+# Skew in degrees beyond which a page is not taken as straight by the "auto" angle classification
+MAX_SKEW_DEGREES = float(os.environ.get("MAX_SKEW_DEGREES", "2"))
+# Recognize the text of each layout region on a page-sized canvas as PPStructure recovery mode does, instead of
+# on the region crop. The regions and the .docx do not need it
+LAYOUT_RECOVERY = os.environ.get("LAYOUT_RECOVERY", "true").lower() in ("1", "true", "yes")
+# Recognize the structure of the tables found by layout analysis, their text is read as plain text otherwise
+LAYOUT_TABLES = os.environ.get("LAYOUT_TABLES", "true").lower() in ("1", "true", "yes")
+
+# Optional stages asked for by a request, None leaves the decision to the settings above
+StageOptions = namedtuple('StageOptions', ['cls', 'recovery', 'table'], defaults=(None, None, None))
+
+
+def layout_options(cls: Optional[bool] = None, recovery: Optional[bool] = None,
+                   table: Optional[bool] = None) -> StageOptions:
+    """Stage options of a layout request, from its `cls`, `recovery` and `table` query parameters"""
+    return StageOptions(cls, recovery, table)
+
+
+def layout_stage_options(options, strategy='skip'):
+    """The stage options of a layout request that apply to the detection `strategy`
+
+    The PPStructure text system is built without the angle classifier, so `cls`
+    only applies to the `regions` strategy and to the tables read as plain text.
+    It is dropped otherwise, and with it from the result cache namespace.
+    """
+    table = LAYOUT_TABLES if options.table is None else options.table
+    if strategy != 'regions' and table:
+        return options._replace(cls=None)
+    return options
+
+
+def options_cache_name(name, options):
+    """Result cache namespace of a pipeline run with the stage options of a request"""
+    flags = [f'{field}={int(value)}' for field, value in zip(options._fields, options) if value is not None]
+    return f"{name}-{','.join(flags)}" if flags else name
+
+
+class StageDecisions:
+    """Process-wide count of the pages each optional stage ran on or was skipped for."""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, run):
+        OPTIONAL_STAGES.labels(stage, 'run' if run else 'skipped').inc()
+        with self._lock:
+            counts = self._counts.setdefault(stage, [0, 0])
+            counts[0 if run else 1] += 1
+        return run
+
+    def stats(self):
+        with self._lock:
+            items = sorted((stage, list(counts)) for stage, counts in self._counts.items())
+        return [
+            {'stage': stage, 'run': run, 'skipped': skipped, 'skip_rate': round(skipped / (run + skipped), 4)}
+            for stage, (run, skipped) in items
+        ]
+
+
+stage_decisions = StageDecisions()
+
+
+def use_angle_cls(img, requested=None, timer=None):
+    """Whether the text lines of a page go through the angle classifier
+
+    A choice made by the request wins over ANGLE_CLS. In "auto" mode the
+    classifier is skipped on pages estimate_orientation finds upright with a
+    skew of at most MAX_SKEW_DEGREES, it runs whenever the estimate is unsure.
+
+    Args:
+        img (ndarray): BGR page image
+        requested (bool, optional): cls option of the request
+        timer (StageTimer, optional): times the orientation estimate
+    """
+    if requested is not None:
+        run = requested
+    elif ANGLE_CLS == 'auto':
+        with timer.stage('orientation') if timer is not None else nullcontext():
+            orientation = estimate_orientation(img)
+        run = not (orientation.upright and abs(orientation.skew) <= MAX_SKEW_DEGREES)
+    else:
+        run = ANGLE_CLS != 'never'
+    return stage_decisions.record('cls', run)
+
+
+def use_recovery(requested=None):
+    return stage_decisions.record('recovery', LAYOUT_RECOVERY if requested is None else requested)
+
+
+def use_table_structure(requested=None):
+    return stage_decisions.record('table', LAYOUT_TABLES if requested is None else requested)
+
+
+@contextmanager
+def structure_options(engine, recovery=True, table=True):
+    """Run a checked out PPStructure engine with or without recovery mode and table structure
+
+    The engine is only used by the caller while it is checked out, its
+    settings are restored on exit.
+    """
+    saved = engine.recovery, engine.table_system
+    engine.recovery = recovery
+    if not table:
+        engine.table_system = None
+    try:
+        yield engine
+    finally:
+        engine.recovery, engine.table_system = saved
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from contextlib import contextmanager
+
+from utils.Metrics import STAGE_SECONDS, request_timings
+
+
+class StageStats:
+    """Process-wide count, total and max duration of each (pipeline, stage)."""
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, pipeline, stage, seconds):
+        with self._lock:
+            entry = self._stats.get((pipeline, stage))
+            if entry is None:
+                entry = self._stats[(pipeline, stage)] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def stats(self):
+        with self._lock:
+            items = sorted(self._stats.items())
+        return [
+            {
+                'pipeline': pipeline,
+                'stage': stage,
+                'count': count,
+                'seconds_avg': round(total / count, 4),
+                'seconds_max': round(maximum, 4),
+                'seconds_total': round(total, 4),
+            }
+            for (pipeline, stage), (count, total, maximum) in items
+        ]
+
+
+stage_stats = StageStats()
+
+
+class StageTimer:
+    """Times the stages of one pipeline run, e.g. the decode, detect and recognize steps of an OCR request.
+
+    Durations go to `stage_stats`, the Prometheus stage histogram and the
+    Server-Timing header of the request the timer was created in, also when
+    a stage runs on another thread.
+
+    Args:
+        pipeline (str): name the stages are aggregated under, such as 'ocr/regions'
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.stages = []
+        self._request = request_timings.get()
+
+    def record(self, name, seconds):
+        self.stages.append((name, seconds))
+        stage_stats.record(self.pipeline, name, seconds)
+        STAGE_SECONDS.labels(self.pipeline, name).observe(seconds)
+        if self._request is not None:
+            self._request.append((f'{name};desc="{self.pipeline}"', seconds))
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+
+def timed_iter(timer, name, iterable):
+    """Iterate `iterable`, recording the time spent producing its items as the `name` stage of `timer`
+
+    Meant for generators streamed into a response body, whose work is
+    interleaved with sending what they already produced.
+    """
+    elapsed = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        timer.record(name, elapsed)
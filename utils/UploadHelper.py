@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+import os
+from collections import namedtuple
+from typing import Optional
+
+from fastapi import HTTPException, Request, status
+
+from utils.DocumentHelper import HTTP_413_CONTENT_TOO_LARGE, document_type
+from utils.ImagePreprocess import image_size
+from utils.Timing import StageTimer
+from utils.UrlFetcher import url_fetcher
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+# Largest image upload in bytes, overridden per router by OCR_MAX_UPLOAD_BYTES, LAYOUT_MAX_UPLOAD_BYTES
+# and TABLE_MAX_UPLOAD_BYTES
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(20 * 1024 ** 2)))
+# Largest image upload in pixels, checked on the image header before the rest of the body is read.
+# Overridden per router by OCR_MAX_UPLOAD_PIXELS, LAYOUT_MAX_UPLOAD_PIXELS and TABLE_MAX_UPLOAD_PIXELS
+MAX_UPLOAD_PIXELS = int(os.environ.get("MAX_UPLOAD_PIXELS", str(100 * 1000 ** 2)))
+
+# Multipart boundaries and part headers allowed on top of the image in a declared Content-Length
+_MULTIPART_OVERHEAD = 16 * 1024
+# Bytes of an upload searched for the image dimensions, JPEG frames can follow a large EXIF block
+_SIZE_PROBE_BYTES = 256 * 1024
+
+ImageInput = namedtuple('ImageInput', ['content', 'filename', 'from_url'])
+UploadLimits = namedtuple('UploadLimits', ['max_bytes', 'max_pixels'])
+
+
+def upload_limits(router):
+    """Upload limits of a router, MAX_UPLOAD_BYTES and MAX_UPLOAD_PIXELS unless overridden for it"""
+    prefix = router.upper()
+    return UploadLimits(int(os.environ.get(f"{prefix}_MAX_UPLOAD_BYTES", MAX_UPLOAD_BYTES)),
+                        int(os.environ.get(f"{prefix}_MAX_UPLOAD_PIXELS", MAX_UPLOAD_PIXELS)))
+
+
+def upload_openapi(required=True):
+    """OpenAPI request body of the endpoints reading their `file` upload with read_upload"""
+    return {'requestBody': {
+        'required': required,
+        'content': {'multipart/form-data': {'schema': {
+            'type': 'object',
+            'properties': {'file': {'type': 'string', 'format': 'binary'}},
+            'required': ['file'],
+        }}},
+    }}
+
+
+def _not_an_image():
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="Please upload images in .jpg or .png format"
+    )
+
+
+class _ImagePart:
+    """Collects the `field` part of a multipart body fed chunk by chunk to a MultipartParser"""
+
+    def __init__(self, field):
+        self.field = field
+        self.filename = None
+        self.chunks = []
+        self.size = 0
+        self.done = False
+        self.checked_type = False
+        self.dimensions = None
+        self._headers = {}
+        self._header_field = b''
+        self._header_value = b''
+        self._current = False
+
+    def callbacks(self):
+        return {
+            'on_part_begin': self._on_part_begin,
+            'on_header_field': self._on_header_field,
+            'on_header_value': self._on_header_value,
+            'on_header_end': self._on_header_end,
+            'on_headers_finished': self._on_headers_finished,
+            'on_part_data': self._on_part_data,
+            'on_part_end': self._on_part_end,
+        }
+
+    def _on_part_begin(self):
+        self._headers = {}
+        self._current = False
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b''
+        self._header_value = b''
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b'content-disposition', b''))
+        if self.filename is None and options.get(b'name') == self.field.encode() and b'filename' in options:
+            self.filename = options[b'filename'].decode('utf-8', 'replace')
+            self._current = True
+
+    def _on_part_data(self, data, start, end):
+        if self._current:
+            # A view of the received chunk, the image bytes are only copied when the views are joined
+            self.chunks.append(memoryview(data)[start:end])
+            self.size += end - start
+
+    def _on_part_end(self):
+        if self._current:
+            self._current = False
+            self.done = True
+
+    def check(self, limits: UploadLimits):
+        """Reject the upload as soon as what was received shows it is not acceptable
+
+        Raises:
+            HTTPException: 400 when the first bytes are not a JPEG or PNG, 413 above the limits
+        """
+        if self.size > limits.max_bytes:
+            raise HTTPException(
+                status_code=HTTP_413_CONTENT_TOO_LARGE,
+                detail=f"Images are limited to {limits.max_bytes} bytes"
+            )
+        if not self.chunks:
+            return
+        if not self.checked_type and (self.size >= 8 or self.done):
+            if document_type(b''.join(self.chunks)[:8]) != 'image':
+                raise _not_an_image()
+            self.checked_type = True
+        if self.checked_type and self.dimensions is None and (self.size <= _SIZE_PROBE_BYTES or self.done):
+            self.dimensions = image_size(b''.join(self.chunks))
+            if self.dimensions is not None and self.dimensions[0] * self.dimensions[1] > limits.max_pixels:
+                raise HTTPException(
+                    status_code=HTTP_413_CONTENT_TOO_LARGE,
+                    detail=f"Images are limited to {limits.max_pixels} pixels"
+                )
+
+
+async def read_upload(request: Request, limits: UploadLimits, field='file') -> ImageInput:
+    """Image uploaded in the `field` part of a multipart request, read as the body streams in
+
+    The body is neither spooled to disk nor parsed ahead of the endpoint: the
+    magic bytes are checked on the first chunk and the pixel count as soon as
+    the image header arrived, so an unacceptable upload is rejected before the
+    rest of it is received. The image part is kept as views of the received
+    chunks, joined once into the image bytes, which are then decoded in
+    place (np.frombuffer) without further copies.
+
+    Raises:
+        HTTPException: 400 without an image in `field` or for anything but a JPEG or PNG,
+            413 above `limits`
+    """
+    content_type, options = parse_options_header(request.headers.get('content-type', ''))
+    if content_type != b'multipart/form-data' or b'boundary' not in options:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Please upload an image as multipart/form-data in the `{field}` field"
+        )
+    declared = request.headers.get('content-length')
+    if declared and declared.isdigit() and int(declared) > limits.max_bytes + _MULTIPART_OVERHEAD:
+        raise HTTPException(
+            status_code=HTTP_413_CONTENT_TOO_LARGE,
+            detail=f"Images are limited to {limits.max_bytes} bytes"
+        )
+
+    part = _ImagePart(field)
+    parser = MultipartParser(options[b'boundary'], part.callbacks())
+    with StageTimer('upload').stage('read'):
+        async for chunk in request.stream():
+            parser.write(chunk)
+            part.check(limits)
+            if part.done:
+                # Whatever follows the image is not needed
+                break
+    if not part.done or not part.chunks:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Please upload an image in the `{field}` field"
+        )
+    part.check(limits)
+    return ImageInput(b''.join(part.chunks), part.filename, False)
+
+
+async def read_image(request: Request, url: Optional[str] = None, limits: UploadLimits = None) -> ImageInput:
+    """Image of an endpoint taking either an upload in the `file` field or a URL
+
+    Raises:
+        HTTPException: 400 unless exactly one of an upload and `url` is given, see read_upload for uploads
+    """
+    has_body = request.headers.get('content-type', '').startswith('multipart/form-data')
+    if has_body == bool(url):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Please provide either a file or a url"
+        )
+    if url:
+        fetched = await url_fetcher.fetch(url)
+        return ImageInput(fetched.content, fetched.filename, True)
+    return await read_upload(request, limits or UploadLimits(MAX_UPLOAD_BYTES, MAX_UPLOAD_PIXELS))
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import posixpath
+from collections import namedtuple
+from urllib.parse import unquote, urlparse
+
+import httpx
+from fastapi import HTTPException, status
+
+from utils.DocumentHelper import HTTP_413_CONTENT_TOO_LARGE, document_type
+from utils.Timing import StageTimer
+
+# Seconds allowed to open a connection to a remote host
+URL_CONNECT_TIMEOUT = float(os.environ.get("URL_CONNECT_TIMEOUT", "5"))
+# Seconds allowed between two chunks of a download
+URL_READ_TIMEOUT = float(os.environ.get("URL_READ_TIMEOUT", "30"))
+# Largest download in bytes, enforced while the body streams in
+URL_MAX_BYTES = int(os.environ.get("URL_MAX_BYTES", str(20 * 1024 ** 2)))
+# Connections kept open across requests by the shared client
+URL_MAX_CONNECTIONS = int(os.environ.get("URL_MAX_CONNECTIONS", "20"))
+# Downloads running at the same time when several URLs are prefetched
+URL_PREFETCH_CONCURRENCY = int(os.environ.get("URL_PREFETCH_CONCURRENCY", "4"))
+
+FetchedFile = namedtuple('FetchedFile', ['url', 'content', 'kind', 'filename'])
+
+
+def url_filename(url):
+    """Last path segment of a URL, without its query string"""
+    return posixpath.basename(unquote(urlparse(url).path)) or 'download'
+
+
+class UrlFetcher:
+    """Downloads remote files with a shared, pooled async HTTP client.
+
+    Bodies are streamed and abandoned as soon as they exceed `max_bytes`, the
+    file type is sniffed from its first bytes instead of trusting the URL.
+    `transport` lets a stub server or httpx.MockTransport stand in for the network.
+    """
+
+    def __init__(self, connect_timeout=URL_CONNECT_TIMEOUT, read_timeout=URL_READ_TIMEOUT, max_bytes=URL_MAX_BYTES,
+                 max_connections=URL_MAX_CONNECTIONS, concurrency=URL_PREFETCH_CONCURRENCY, transport=None):
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.max_bytes = max_bytes
+        self.concurrency = concurrency
+        self.transport = transport
+        self._client = None
+        self._loop = None
+
+    def _get_client(self):
+        # The client is bound to the event loop it was created in
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits, follow_redirects=True,
+                                             transport=self.transport)
+            self._loop = loop
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def fetch(self, url, kinds=('image',)) -> FetchedFile:
+        """Download a file into memory
+
+        Args:
+            url (str): http or https URL
+            kinds (tuple): accepted types, see DocumentHelper.document_type
+
+        Raises:
+            HTTPException: 400 when the URL cannot be fetched or is not an accepted type,
+                413 above max_bytes, 504 on timeouts
+        """
+        with StageTimer('upload').stage('fetch'):
+            return await self._download(url, kinds)
+
+    async def _download(self, url, kinds):
+        if urlparse(url).scheme not in ('http', 'https'):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Only http and https URLs are supported"
+            )
+
+        try:
+            async with self._get_client().stream('GET', url) as response:
+                if response.status_code != 200:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail="Unable to access the provided URL"
+                    )
+                length = response.headers.get('Content-Length')
+                if length is not None and length.isdigit() and int(length) > self.max_bytes:
+                    raise self._too_large()
+
+                body = bytearray()
+                kind = None
+                async for chunk in response.aiter_bytes():
+                    body += chunk
+                    if len(body) > self.max_bytes:
+                        raise self._too_large()
+                    if kind is None and len(body) >= 8:
+                        # Stop before downloading the rest of something we cannot process
+                        kind = self._check_kind(body, kinds)
+                if kind is None:
+                    self._check_kind(body, kinds)
+        except httpx.TimeoutException:
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail="Timed out downloading the provided URL"
+            )
+        except httpx.HTTPError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Unable to access the provided URL"
+            )
+        return FetchedFile(url, bytes(body), kind or document_type(bytes(body[:8])), url_filename(url))
+
+    async def fetch_many(self, urls, kinds=('image',)):
+        """Prefetch several URLs concurrently, at most `concurrency` at a time
+
+        Returns:
+            list: a FetchedFile or the HTTPException raised for each URL, in order
+        """
+        semaphore = asyncio.Semaphore(max(self.concurrency, 1))
+
+        async def fetch_one(url):
+            async with semaphore:
+                try:
+                    return await self.fetch(url, kinds)
+                except HTTPException as exc:
+                    return exc
+
+        return await asyncio.gather(*(fetch_one(url) for url in urls))
+
+    def _check_kind(self, head, kinds):
+        kind = document_type(bytes(head[:8]))
+        if kind not in kinds:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="The provided URL is not a .jpg or .png image" if kinds == ('image',)
+                else "The provided URL is not a supported document"
+            )
+        return kind
+
+    def _too_large(self):
+        return HTTPException(
+            status_code=HTTP_413_CONTENT_TOO_LARGE,
+            detail=f"The provided URL is larger than {self.max_bytes} bytes"
+        )
+
+
+url_fetcher = UrlFetcher()
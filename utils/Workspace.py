@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from fastapi import BackgroundTasks
+
+logger = logging.getLogger(__name__)
+
+# Root of the per-request scratch directories
+TEMP_DIR = os.environ.get("TEMP_DIR", "./temp")
+# Put the scratch directories on tmpfs (/dev/shm) when it is available
+WORKSPACE_TMPFS = os.environ.get("WORKSPACE_TMPFS", "false").lower() in ("1", "true", "yes")
+# Workspaces older than this many seconds are removed by the sweeper
+WORKSPACE_MAX_AGE = int(os.environ.get("WORKSPACE_MAX_AGE", "3600"))
+# Oldest idle workspaces are removed while the root holds more than this many bytes
+WORKSPACE_MAX_BYTES = int(os.environ.get("WORKSPACE_MAX_BYTES", str(2 * 1024 ** 3)))
+# Seconds between two sweeps
+WORKSPACE_SWEEP_INTERVAL = int(os.environ.get("WORKSPACE_SWEEP_INTERVAL", "300"))
+
+WORKSPACE_PREFIX = 'ws-'
+
+
+def _default_root():
+    if WORKSPACE_TMPFS and os.path.isdir('/dev/shm'):
+        return os.path.join('/dev/shm', 'ppstructure')
+    return TEMP_DIR
+
+
+def _owner_alive(name):
+    # Workspaces are named ws-<pid>-..., other worker processes may share the root
+    try:
+        pid = int(name[len(WORKSPACE_PREFIX):].split('-', 1)[0])
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _dir_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+
+class WorkspaceManager:
+    """Hands out one private scratch directory per request.
+
+    Each workspace is removed on its own when its request is done, so
+    concurrent requests never touch each other's files. A sweeper removes
+    workspaces left behind by crashed requests and processes, by age and by
+    total size, never those of another live process.
+    """
+
+    def __init__(self, root=None, max_age=WORKSPACE_MAX_AGE, max_bytes=WORKSPACE_MAX_BYTES):
+        self.root = os.path.abspath(root or _default_root())
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def create(self) -> str:
+        os.makedirs(self.root, exist_ok=True)
+        path = tempfile.mkdtemp(prefix=f'{WORKSPACE_PREFIX}{os.getpid()}-', dir=self.root)
+        with self._lock:
+            self._active.add(path)
+        return path
+
+    def release(self, path):
+        with self._lock:
+            self._active.discard(path)
+        if os.path.dirname(os.path.abspath(path)) != self.root:
+            logger.warning('Refusing to remove %s, it is not a workspace of %s', path, self.root)
+            return
+        shutil.rmtree(path, ignore_errors=True)
+
+    @contextmanager
+    def workspace(self):
+        path = self.create()
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def sweep(self):
+        """Remove expired orphaned workspaces, then the oldest orphaned ones while over the size budget
+
+        A workspace is orphaned when no live process owns it, or when it is
+        owned by this process but belongs to none of its requests.
+
+        Returns:
+            int: number of removed workspaces
+        """
+        if not os.path.isdir(self.root):
+            return 0
+
+        with self._lock:
+            active = set(self._active)
+        now = time.time()
+        idle = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not name.startswith(WORKSPACE_PREFIX) or not os.path.isdir(path) or path in active:
+                continue
+            try:
+                idle.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+
+        removed = 0
+        remaining = []
+        in_use = 0
+        for mtime, path in sorted(idle):
+            # The mtime of a workspace only changes when an entry is added, one owned by a live sibling
+            # process may be in use by a long request whatever its age
+            if _owner_alive(os.path.basename(path)):
+                in_use += _dir_size(path)
+            elif now - mtime > self.max_age:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+            else:
+                remaining.append((path, _dir_size(path)))
+
+        total = sum(size for _, size in remaining) + in_use + sum(_dir_size(path) for path in active)
+        for path, size in remaining:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+
+        if removed:
+            logger.info('Removed %d stale workspaces from %s', removed, self.root)
+        return removed
+
+    async def run_sweeper(self, interval=WORKSPACE_SWEEP_INTERVAL):
+        while True:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.sweep)
+            except Exception:
+                logger.exception('Workspace sweep failed')
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        with self._lock:
+            active = len(self._active)
+        return {
+            'root': self.root,
+            'active': active,
+            'max_age': self.max_age,
+            'max_bytes': self.max_bytes,
+        }
+
+
+workspace_manager = WorkspaceManager()
+
+
+def request_workspace(background_tasks: BackgroundTasks):
+    """FastAPI dependency giving the request its own scratch directory
+
+    The directory is removed by a background task once the response has been sent,
+    or right away when the request fails.
+    """
+    path = workspace_manager.create()
+    background_tasks.add_task(workspace_manager.release, path)
+    try:
+        yield path
+    except Exception:
+        workspace_manager.release(path)
+        raise
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Job worker, runs the documents queued through /jobs.
+
+Workers only share the job directory with the API, start as many as the
+inference hardware allows, independently of the HTTP front end:
+
+    python worker.py
+"""
+
+import logging
+import os
+import signal
+import socket
+import time
+
+from routers.layout import layout_document_pipeline
+from routers.ocr import ocr_document_pipeline
+from routers.table import table_document_pipeline
+from utils.DocumentHelper import PagedDocument, PagePrefetcher, ndjson_line, page_error, page_record
+from utils.JobQueue import job_queue
+from utils.ModelRegistry import PRELOAD_MODELS, registry
+
+logger = logging.getLogger('worker')
+
+# Seconds between two polls of an empty queue
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1"))
+# Seconds between two removals of expired jobs
+JOB_PURGE_INTERVAL = int(os.environ.get("JOB_PURGE_INTERVAL", "300"))
+
+PIPELINES = {
+    'ocr': ocr_document_pipeline,
+    'layout': layout_document_pipeline,
+    'table': table_document_pipeline,
+}
+
+
+class Worker:
+    def __init__(self, queue=job_queue):
+        self.queue = queue
+        self.name = f'{socket.gethostname()}-{os.getpid()}'
+        self.stopping = False
+
+    def stop(self, *args):
+        logger.info('Stopping after the current page')
+        self.stopping = True
+
+    def run_job(self, job):
+        """Recognize every page of a claimed job, write its page results and its artifact"""
+        pipeline = PIPELINES[job['kind']]
+        directory = self.queue.job_dir(job['id'])
+        document = PagedDocument(os.path.join(directory, 'document.' + job['document_kind']),
+                                 job['document_kind'], job['pages'])
+        builder = pipeline.builder()
+
+        prefetcher = PagePrefetcher(document)
+        try:
+            with open(self.queue.pages_path(job['id']), 'wb') as out:
+                page_no = 0
+                while True:
+                    image = prefetcher.get()
+                    if image is None:
+                        break
+                    page_no += 1
+                    try:
+                        raw = pipeline.process(image, lang=job['lang'])
+                        record = page_record(page_no, document.pages, result=pipeline.serialize(raw))
+                        pipeline.render(builder, page_no, raw)
+                    except Exception as exc:
+                        logger.warning('Page %d of job %s failed', page_no, job['id'], exc_info=True)
+                        record = page_record(page_no, document.pages, error=page_error(exc))
+                    del image
+                    out.write(ndjson_line(record))
+                    out.flush()
+
+                    if not self.queue.progress(job, page_no):
+                        logger.info('Job %s was cancelled', job['id'])
+                        self.queue.cancelled(job)
+                        return
+                    if self.stopping:
+                        self.queue.fail(job, 'Worker stopped before the job was done')
+                        return
+        finally:
+            prefetcher.close()
+
+        filename_base = os.path.basename(job['filename']).split('.')[0] or 'document'
+        artifact = os.path.join(directory, f'{filename_base}.{pipeline.extension}')
+        with open(artifact, 'wb') as f:
+            f.write(builder.save().getvalue())
+        self.queue.succeed(job, artifact)
+
+    def run(self):
+        if PRELOAD_MODELS:
+            registry.warm_up_hot(PRELOAD_MODELS)
+        logger.info('Worker %s waiting for jobs in %s', self.name, self.queue.directory)
+
+        next_purge = 0
+        while not self.stopping:
+            if time.monotonic() >= next_purge:
+                self.queue.purge()
+                next_purge = time.monotonic() + JOB_PURGE_INTERVAL
+
+            job = self.queue.claim(self.name)
+            if job is None:
+                time.sleep(JOB_POLL_INTERVAL)
+                continue
+
+            logger.info('Running %s job %s (%d pages, attempt %d)', job['kind'], job['id'], job['pages'],
+                        job['attempts'])
+            try:
+                self.run_job(job)
+            except Exception as exc:
+                logger.exception('Job %s failed', job['id'])
+                self.queue.fail(job, str(exc) or type(exc).__name__)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    worker = Worker()
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()
+
+
+if __name__ == '__main__':
+    main()